@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+""" Offline benchmark of the blue/green deploy against the simulated AWS in fakeaws.py.
+
+Runs deploy() (_create_ami_image + _do_deploy) and cleanup() of sample.py
+end-to-end with every region's session replaced by a FakeAWS session. AWS
+latencies and the poller delays / timeouts / sleeps of sample.py are scaled
+by --scale, and every reported time is scaled back, so results read in real
+AWS seconds.
+
+Reports total wall time, API calls (per service, retries, throttles) and the
+time spent sleeping or blocked in waits. With --baseline (the --out of an
+earlier run) or --max-* thresholds, exits 1 on a regression.
+
+    ./bench.py --scale 0.01 --regions 4 --throttle 0.05 --out bench.json
+    ./bench.py --scale 0.01 --regions 4 --throttle 0.05 --baseline bench.json
+"""
+import argparse
+import json
+import logging
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import environments
+import fakeaws
+import sample
+from clients import ClientRegistry
+from poller import Poller
+from tracing import Tracer
+
+_EXTRA_REGIONS = ['ap-southeast-2', 'us-east-1', 'eu-west-1', 'ap-northeast-1', 'sa-east-1']
+
+
+class _ScaledPoller(Poller):
+    """ The sample poller with every delay and timeout scaled. """
+
+    def __init__(self, poller, scale):
+        super(_ScaledPoller, self).__init__(
+            initial_delay=poller.initial_delay * scale, max_delay=poller.max_delay * scale,
+            backoff=poller.backoff, jitter=poller.jitter, workers=poller.workers)
+        self.scale = scale
+
+    def wait(self, name, check, timeout, initial_delay=None, max_delay=None):
+        return super(_ScaledPoller, self).wait(
+            name, check, timeout * self.scale,
+            None if initial_delay is None else initial_delay * self.scale,
+            None if max_delay is None else max_delay * self.scale)
+
+
+class _ScaledTime(object):
+    """ Stands in for the time module in sample.py: scales and sums up sleeps. """
+
+    def __init__(self, scale):
+        self.scale = scale
+        self.slept = 0.0
+        self._lock = threading.Lock()
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        with self._lock:
+            self.slept += seconds
+        time.sleep(seconds * self.scale)
+
+
+def run(args):
+    latencies = dict((k, float(v)) for k, v in (l.split('=', 1) for l in args.latency))
+    aws = fakeaws.FakeAWS(scale=args.scale, throttle_rate=args.throttle, seed=args.seed, latencies=latencies,
+                          base_instance_id=sample._base_instance_id)
+    clock = _ScaledTime(args.scale)
+    sample.time = clock
+    sample._tracer = Tracer()
+    sample._clients = ClientRegistry(max_pool_connections=20, max_attempts=10)
+    sample._clients.on_create(sample._tracer.instrument)
+    sample._poller = _ScaledPoller(sample._poller, args.scale)
+    sample._journal_dir = tempfile.mkdtemp(prefix='bench-journal-')
+    sample._keep_deploys = args.keep
+    sample._gc_on_cleanup = args.keep is not None
+    sample._ami_cache = not args.no_ami_cache
+    sample._warm_standby = args.warm
+    sample._surge = args.surge
+    sample._shift_batches = args.shift_batches
+
+    if args.environments:
+        sample._config = environments.load(args.environments)
+    # extra regions are copies of prod
+    configured = len(sample._config)
+    for i in range(configured, args.regions):
+        key = 'region%s' % i
+        sample._config[key] = environments.Environment(sample._config['prod'], env=key,
+                                                       region=_EXTRA_REGIONS[i - configured])
+    for key in list(sample._config.keys()):
+        config = sample._config[key]
+        config['session'] = aws.session(config['region'])
+        if key in args.fail_region:
+            aws.failing_regions.add(config['region'])
+        for i in range(args.history, -1, -1):
+            aws.seed_deploy(config['region'], 'prefix-bench-2000_01_01_00_00_%02d' % (60 - i),
+                            config['elb'], sample._asg_prefix, sample._lc_prefix,
+                            size=args.old_size, live=i == 0)
+
+    started = time.time()
+    errors = {}
+    deploy_times = []
+    cleanup_times = []
+    for i in range(args.deploys):
+        # repeat deploys of an unchanged base instance, the later ones can reuse the images
+        deploy_started = time.time()
+        try:
+            response = sample.deploy('bench%d' % i, args.max_concurrent_regions, args.canary)
+        except sample.DeployError as e:
+            response = e.response
+            errors = dict((k, str(v)) for k, v in e.errors.items())
+        deployed = time.time()
+        for key in response.keys():
+            sample.cleanup(key, response[key][0])
+        deploy_times.append((deployed - deploy_started) / args.scale)
+        cleanup_times.append((time.time() - deployed) / args.scale)
+    finished = time.time()
+    shutil.rmtree(sample._journal_dir)
+
+    api = sample._tracer.api_calls()
+    rollbacks = [p['dur'] / 1e6 for p in sample._tracer.chrome_trace()['traceEvents']
+                 if p['name'] == 'rollback']
+    waits = sample._tracer.waits()
+    per_service = {}
+    for services in api.values():
+        for service, counts in services.items():
+            total = per_service.setdefault(service, {'calls': 0, 'retries': 0, 'throttled': 0})
+            for key in total:
+                total[key] += counts[key]
+    return {
+        'regions': len(sample._config),
+        'errors': errors,
+        'wall': {
+            'deploy': sum(deploy_times),
+            'cleanup': sum(cleanup_times),
+            'total': (finished - started) / args.scale,
+            'deploys': deploy_times,
+        },
+        'api_calls': sum(s['calls'] for s in per_service.values()),
+        'api_retries': sum(s['retries'] for s in per_service.values()),
+        'api_throttled': sum(s['throttled'] for s in per_service.values()),
+        'api_by_service': per_service,
+        'slept': clock.slept,
+        'waited': sum(end - start for _, _, _, start, end in waits) / args.scale,
+        'wait_checks': sum(checks for _, _, checks, _, _ in waits),
+        'clients': sample._clients.stats()['created'],
+        'rollback': max(rollbacks) / args.scale if rollbacks else None,
+        'images_built': sum(s['ec2']['operations'].get(op, 0) for s in api.values() if 'ec2' in s
+                            for op in ('CreateImage', 'CopyImage')),
+        'base_starts': aws.base.starts,
+    }
+
+
+def check(result, args):
+    """ Returns: list of the regressions (str) of the result against the thresholds / baseline """
+    failures = []
+    limits = [('wall total', result['wall']['total'], args.max_wall),
+              ('api calls', result['api_calls'], args.max_calls)]
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        limits.append(('wall total vs baseline', result['wall']['total'],
+                       baseline['wall']['total'] * (1 + args.tolerance)))
+        limits.append(('api calls vs baseline', result['api_calls'],
+                       baseline['api_calls'] * (1 + args.tolerance)))
+    for name, value, limit in limits:
+        if limit is not None and value > limit:
+            failures.append('%s: %.1f > %.1f' % (name, value, limit))
+    expected = set(args.fail_region)
+    if (args.canary or sample._canary_region) in expected:
+        expected.update(sample._config.keys()) # the other regions are skipped once the canary failed
+    unexpected = dict((k, v) for k, v in result['errors'].items() if k not in expected)
+    if unexpected:
+        failures.append('deploy errors: %s' % unexpected)
+    return failures
+
+
+def report(result):
+    lines = ['regions:          %d' % result['regions'],
+             'wall deploy:      %.0fs' % result['wall']['deploy'],
+             'wall cleanup:     %.0fs' % result['wall']['cleanup'],
+             'wall total:       %.0fs' % result['wall']['total'],
+             'wall per deploy:  %s' % ' '.join('%.0fs' % t for t in result['wall']['deploys']),
+             'images built:     %d (base instance started %d times)' % (
+                 result['images_built'], result['base_starts']),
+             'api calls:        %d (retries %d, throttled %d)' % (
+                 result['api_calls'], result['api_retries'], result['api_throttled']),
+             'slept:            %.0fs' % result['slept'],
+             'waited:           %.0fs in %d checks' % (result['waited'], result['wait_checks']),
+             'clients created:  %d' % result['clients']]
+    if result['rollback'] is not None:
+        lines.append('slowest rollback: %.0fs' % result['rollback'])
+    for service in sorted(result['api_by_service'].keys()):
+        counts = result['api_by_service'][service]
+        lines.append('  %-12s %5d calls %4d retries %4d throttled' % (
+            service, counts['calls'], counts['retries'], counts['throttled']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scale', type=float, default=0.01, help='time scale of the simulation (default 0.01)')
+    parser.add_argument('--regions', type=int, default=2, help='number of regions to deploy to (default 2)')
+    parser.add_argument('--throttle', type=float, default=0.0, help='probability of an API call being throttled')
+    parser.add_argument('--latency', action='append', default=[], metavar='NAME=SECONDS',
+                        help='override a fakeaws.DEFAULT_LATENCIES entry, eg: image_copy=2400')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--max-concurrent-regions', type=int, default=None)
+    parser.add_argument('--canary', default=None, help='canary region env key')
+    parser.add_argument('--fail-region', action='append', default=[], metavar='ENV',
+                        help='env key where the new instances never get healthy in the elb (rollback)')
+    parser.add_argument('--out', help='write the result json to this file')
+    parser.add_argument('--baseline', help='result json of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed regression vs the baseline (default 0.2)')
+    parser.add_argument('--max-wall', type=float, default=None, help='fail above this total wall time (AWS seconds)')
+    parser.add_argument('--max-calls', type=int, default=None, help='fail above this number of API calls')
+    parser.add_argument('--history', type=int, default=0,
+                        help='number of older (scaled down) deploys per region, for the garbage collection')
+    parser.add_argument('--keep', type=int, default=None,
+                        help='deploys to keep per region, deleting the others when cleaning up '
+                             '(default: no garbage collection)')
+    parser.add_argument('--deploys', type=int, default=1, help='number of deploys in a row (default 1)')
+    parser.add_argument('--no-ami-cache', action='store_true', help='build new images on every deploy')
+    parser.add_argument('--warm', action='store_true', help='keep the base instance running between deploys')
+    parser.add_argument('--old-size', type=int, default=2, help='instances of the asg being replaced (default 2)')
+    parser.add_argument('--surge', type=float, default=0.0, help='extra capacity of the new asg, eg: 0.25')
+    parser.add_argument('--shift-batches', type=int, default=1,
+                        help='batches the traffic is moved to the new asg in (default 1: all at once)')
+    parser.add_argument('--environments', help='environments file to deploy to instead of the sample.py one')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the deploy debug logs')
+    args = parser.parse_args(argv)
+    configured = len(environments.load(args.environments)) if args.environments else len(sample._config)
+    if args.regions > len(_EXTRA_REGIONS) + configured:
+        parser.error('at most %d regions' % (len(_EXTRA_REGIONS) + configured))
+
+    sample._LOG.setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+    result = run(args)
+    print(report(result))
+    if args.out:
+        with open(args.out, 'w') as fh:
+            json.dump(result, fh, indent=1, sort_keys=True)
+    failures = check(result, args)
+    for failure in failures:
+        print('REGRESSION %s' % failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+""" Small TTL cache for the per-deploy, per-region AWS state (AZs, ASG
+membership, ELB health).
+
+Keys are tuples whose first item is the kind of state, eg: ('asg', asg_name),
+so a whole kind can be dropped at once with invalidate(('asg',)).
+"""
+import threading
+import time
+
+FOREVER = None
+
+
+class StateCache(object):
+    """ Thread safe key -> value cache with a per-entry time to live.
+
+    Args:
+        default_ttl (float): seconds an entry is kept when put/get does not give a ttl
+    """
+
+    def __init__(self, default_ttl=30):
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, load=None, ttl=0):
+        """ Return the cached value of key, loading (and caching) it with load() when missing or expired.
+
+        Args:
+            key (tuple): cache key
+            load (callable): no-arg callable returning the value, None to only look up
+            ttl (float): seconds to keep the loaded value, FOREVER (None) to never
+                expire, 0 (default) for the default_ttl
+        Returns:
+            the value, or None when missing and no load was given
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > time.time()):
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        if load is None:
+            return None
+        value = load()
+        self.put(key, value, ttl)
+        return value
+
+    def put(self, key, value, ttl=0):
+        if ttl == 0:
+            ttl = self.default_ttl
+        with self._lock:
+            self._entries[key] = (None if ttl is FOREVER else time.time() + ttl, value)
+
+    def invalidate(self, *keys):
+        """ Drop the given keys. A key also drops every longer key it is a prefix of. """
+        with self._lock:
+            for cached_key in list(self._entries.keys()):
+                for key in keys:
+                    if cached_key[:len(key)] == key:
+                        del self._entries[cached_key]
+                        break
+
+    def clear(self, keep=()):
+        """ Drop every key, but the ones a key of keep is a prefix of. """
+        with self._lock:
+            for cached_key in list(self._entries.keys()):
+                if not any(cached_key[:len(key)] == key for key in keep):
+                    del self._entries[cached_key]
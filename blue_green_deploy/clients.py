@@ -0,0 +1,67 @@
+""" Shared boto3 clients for the blue/green deploy.
+
+Building a boto3 client loads and parses the service model, so instead of
+calling session.client(...) in every helper, clients are created once per
+(region, service), lazily, and shared by every deploy step and region thread.
+boto3 clients are thread safe, sessions are not, hence the creation lock.
+"""
+import threading
+
+from botocore.config import Config
+
+
+class ClientRegistry(object):
+    """ Lazily created, shared clients keyed by (region, service).
+
+    Args:
+        max_pool_connections (int): size of the http connection pool of every client,
+            should cover the threads that can use one client at a time (regions + poller workers)
+        max_attempts (int): botocore retry attempts, throttling included
+        retry_mode (str): botocore retry mode ('legacy'|'standard'|'adaptive')
+    """
+
+    def __init__(self, max_pool_connections=20, max_attempts=10, retry_mode='standard'):
+        self.config = Config(
+            max_pool_connections=max_pool_connections,
+            retries={'max_attempts': max_attempts, 'mode': retry_mode}
+        )
+        self._clients = {}
+        self._uses = {}
+        self._created = 0
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def client(self, session, service):
+        key = (session.region_name, service)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = session.client(service, config=self.config)
+                self._clients[key] = client
+                self._created += 1
+                for listener in self._listeners:
+                    listener(client)
+            self._uses[key] = self._uses.get(key, 0) + 1
+            return client
+
+    def resource(self, session, service):
+        """ A resource sharing the registry config. Resources are NOT thread safe, so they
+            are not pooled: only use them from the thread that asked for them.
+        """
+        return session.resource(service, config=self.config)
+
+    def on_create(self, listener):
+        """ Call listener(client) for every client created from now on, eg: to instrument it. """
+        with self._lock:
+            self._listeners.append(listener)
+
+    def stats(self):
+        """
+        Returns:
+            dict: 'created' clients, 'reused' (calls served by an existing client),
+                and 'uses' per 'region/service'
+        """
+        with self._lock:
+            uses = dict(('%s/%s' % key, count) for key, count in self._uses.items())
+            total = sum(self._uses.values())
+            return {'created': self._created, 'reused': total - self._created, 'uses': uses}
@@ -0,0 +1,61 @@
+""" Registry of the environments (regions) to deploy to, loaded from a JSON file:
+
+    {
+        "defaults": {"instance_type": "m3.large", "elb": "elb_name", ...},
+        "environments": {
+            "prod": {"region": "us-west-2", "subnets": "...", "sg_group": "sg-1234", "iam": "prod-iam"},
+            "frankfurt": {"region": "eu-central-1", "instance_type": "m4.large", ...}
+        }
+    }
+
+Every environment is its "defaults" overridden by its own entry, with its key
+as 'env'. Adding a region is adding an entry. The boto3 session of an
+environment is only created the first time config['session'] is looked up.
+"""
+import json
+import threading
+
+import boto3
+
+REQUIRED = ('region', 'subnets', 'sg_group', 'iam')
+
+
+class Environment(dict):
+    """ Config dict of an environment, creating its 'session' on first use. """
+
+    _lock = threading.Lock()
+
+    def __missing__(self, key):
+        if key != 'session':
+            raise KeyError(key)
+        with self._lock:
+            if 'session' not in self:
+                self['session'] = boto3.session.Session(region_name=self['region'])
+            return dict.__getitem__(self, 'session')
+
+
+def load(path):
+    """
+    Args:
+        path (str): the JSON environments file
+    Returns:
+        dict: env key -> Environment
+    Raises:
+        ValueError when an environment misses a REQUIRED setting or there is no 'prod',
+            the region images are created in
+    """
+    with open(path) as fh:
+        registry = json.load(fh)
+    defaults = registry.get('defaults', {})
+    environments = {}
+    for key, overrides in registry['environments'].items():
+        key = str(key)
+        config = Environment(defaults, env=key)
+        config.update(overrides)
+        missing = [name for name in REQUIRED if name not in config]
+        if missing:
+            raise ValueError('environment %s in %s misses %s' % (key, path, ', '.join(missing)))
+        environments[key] = config
+    if 'prod' not in environments:
+        raise ValueError('no prod environment in %s' % path)
+    return environments
@@ -0,0 +1,778 @@
+""" In-memory stand-in for the AWS APIs used by the blue/green deploy, for bench.py.
+
+FakeAWS keeps the state of every region (images, launch configs, ASGs,
+instances, ELB registrations) and derives resource states from the wall clock
+and the configured latencies, eg: an image is 'pending' for
+latency['image_create'] seconds after create_image, then 'available'.
+FakeAWS.session(region) returns an object that can replace a
+boto3.session.Session: its clients accept the same keyword arguments and
+return the same response shapes (only the fields the deploy reads), raise
+botocore ClientErrors, retry throttling and emit botocore 'needs-retry' (on
+throttled attempts) and 'after-call' events so the Tracer can count the calls.
+"""
+import copy
+import datetime
+import fnmatch
+import itertools
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError, WaiterError
+
+# seconds, as on real AWS, scaled by FakeAWS(scale=...)
+DEFAULT_LATENCIES = {
+    'api': 0.1,             # every API call
+    'image_create': 900,    # create_image of the (windows) base instance
+    'image_copy': 1500,     # copy_image to another region
+    'boot': 120,            # instance pending -> running
+    'status_ok': 120,       # running -> system status ok
+    'inservice': 60,        # running -> ASG Healthy / InService
+    'elb_register': 60,     # registered -> ELB InService
+    'elb_deregister': 20,   # deregistered -> ELB OutOfService
+    'elb_drain': 300,       # deregistered -> gone from the ELB (connection draining)
+    'terminate': 60,        # terminating -> terminated
+    'retry_backoff': 1,     # between throttled attempts
+}
+
+_lock = threading.RLock()
+_ids = itertools.count(0x10000000)
+
+
+def _new_id(prefix):
+    return '%s-%08x' % (prefix, next(_ids))
+
+
+def _error(code, message, operation):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+class _Instance(object):
+
+    def __init__(self, aws, region_name, asg_name, launched):
+        self.id = _new_id('i')
+        self.aws = aws
+        self.region_name = region_name
+        self.asg_name = asg_name
+        self.launched = launched
+        self.terminated_at = None
+        self.protected = True
+        self.standby = False
+
+    def ready_at(self):
+        return self.launched + self.aws.latency['boot']
+
+    def state(self, now):
+        if self.terminated_at is not None:
+            return 'terminated' if now >= self.terminated_at + self.aws.latency['terminate'] else 'shutting-down'
+        return 'running' if now >= self.ready_at() else 'pending'
+
+    def lifecycle(self, now):
+        if self.terminated_at is not None:
+            return 'Terminating'
+        if self.standby:
+            return 'Standby'
+        if now >= self.ready_at() + self.aws.latency['inservice']:
+            return 'InService'
+        return 'Pending'
+
+    def healthy(self, now):
+        return (self.region_name, self.asg_name) not in self.aws.unhealthy_asgs
+
+
+class _BaseInstance(object):
+    """ The instance images are created from, stopped until started through the ec2 resource. """
+
+    def __init__(self, aws, instance_id):
+        self.id = instance_id
+        self.aws = aws
+        self.instance_type = 'm3.large'
+        self.build_rev = '1' # the build-rev tag, None for no tag
+        self.volume_id = _new_id('vol')
+        self.started_at = None
+        self.starts = 0
+
+    def ready_at(self):
+        return self.started_at + self.aws.latency['boot']
+
+    def state(self, now):
+        if self.started_at is None:
+            return 'stopped'
+        return 'running' if now >= self.ready_at() else 'pending'
+
+    def describe(self, now):
+        tags = [{'Key': 'build-rev', 'Value': self.build_rev}] if self.build_rev else []
+        return {'InstanceId': self.id, 'InstanceType': self.instance_type, 'State': {'Name': self.state(now)},
+                'Tags': tags, 'BlockDeviceMappings': [{'DeviceName': '/dev/sda1', 'Ebs': {'VolumeId': self.volume_id}}]}
+
+
+class _Region(object):
+
+    def __init__(self, aws, name):
+        self.aws = aws
+        self.name = name
+        self.images = {}
+        self.snapshots = {}
+        self.lcs = {}
+        self.asgs = {}
+        self.instances = {}
+        self.registrations = {} # elb name -> instance id -> [registered_at, deregistered_at]
+        self.policies = {}
+        self.alarms = {}
+
+    # --- asg reconciliation ---
+
+    def members(self, asg_name, now):
+        return [i for i in self.instances.values()
+                if i.asg_name == asg_name and i.state(now) != 'terminated']
+
+    def reconcile(self, asg_name, now):
+        """ Launch / terminate instances until the group matches its desired capacity. Standby instances
+        are not counted. """
+        asg = self.asgs[asg_name]
+        alive = [i for i in self.members(asg_name, now) if i.terminated_at is None and not i.standby]
+        for _ in range(asg['DesiredCapacity'] - len(alive)):
+            ins = _Instance(self.aws, self.name, asg_name, now)
+            ins.protected = asg['NewInstancesProtectedFromScaleIn']
+            self.instances[ins.id] = ins
+            for elb in asg['LoadBalancerNames']:
+                self.registrations.setdefault(elb, {})[ins.id] = [now, None]
+        extra = len(alive) - asg['DesiredCapacity']
+        for ins in sorted(alive, key=lambda i: i.launched):
+            if extra <= 0:
+                break
+            if not ins.protected:
+                self.terminate(ins, now)
+                extra -= 1
+
+    def replace_unhealthy(self, now):
+        """ Terminate and replace the instances of the elb health checked groups deregistered from one
+        of their elbs (OutOfService for the health check), as the asgs do at any time. """
+        for asg_name, asg in self.asgs.items():
+            if asg['HealthCheckType'] != 'ELB':
+                continue
+            unhealthy = [i for i in self.members(asg_name, now) if i.terminated_at is None and not i.standby and any(
+                self.registrations.get(elb, {}).get(i.id, [0, None])[1] is not None for elb in asg['LoadBalancerNames'])]
+            for ins in unhealthy:
+                self.terminate(ins, now)
+            if unhealthy:
+                self.reconcile(asg_name, now)
+
+    def terminate(self, ins, now):
+        ins.terminated_at = now
+        for regs in self.registrations.values():
+            if ins.id in regs and regs[ins.id][1] is None:
+                regs[ins.id][1] = now
+
+    def elb_state(self, elb, instance_id, now):
+        """ InService / OutOfService, or None when the instance is not registered (anymore). """
+        reg = self.registrations.get(elb, {}).get(instance_id)
+        if reg is None:
+            return None
+        registered_at, deregistered_at = reg
+        lat = self.aws.latency
+        if deregistered_at is not None:
+            if now >= deregistered_at + lat['elb_drain']:
+                return None
+            if now >= deregistered_at + lat['elb_deregister']:
+                return 'OutOfService'
+        ins = self.instances[instance_id]
+        if ins.state(now) == 'running' and ins.healthy(now) and \
+                now >= max(registered_at, ins.ready_at() + lat['inservice']) + lat['elb_register']:
+            return 'InService'
+        return 'OutOfService'
+
+
+class FakeAWS(object):
+    """ Simulated AWS account.
+
+    Args:
+        latencies (dict): overrides of DEFAULT_LATENCIES, in (real AWS) seconds
+        scale (float): factor applied to every latency, eg: 0.01 to run 100x faster
+        throttle_rate (float): probability of any API call attempt to be throttled
+        seed (int): random seed for the throttling
+        base_instance_id (str): id of the base instance, in every region
+    """
+
+    def __init__(self, latencies=None, scale=1.0, throttle_rate=0.0, seed=None, base_instance_id='i-base'):
+        self.latency = dict(DEFAULT_LATENCIES)
+        self.latency.update(latencies or {})
+        for key in self.latency:
+            self.latency[key] *= scale
+        self.scale = scale
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.unhealthy_asgs = set() # (region name, asg name) of the asgs whose instances never pass the elb health check
+        self.failing_regions = set() # region names where every new asg is unhealthy
+        self.base = _BaseInstance(self, base_instance_id)
+        self._regions = {}
+
+    def region(self, name):
+        with _lock:
+            if name not in self._regions:
+                self._regions[name] = _Region(self, name)
+            return self._regions[name]
+
+    def session(self, region_name):
+        return FakeSession(self, region_name)
+
+    def seed_deploy(self, region_name, image_name, elb_name, asg_prefix, lc_prefix, size=2, live=True):
+        """ Create a previous deploy (ami, lc, asg with healthy instances behind the elb).
+            A deploy that is not live has an empty asg, without elb, as left by cleanup.
+        """
+        region = self.region(region_name)
+        long_ago = time.time() - 86400
+        if not live:
+            size = 0
+        with _lock:
+            image_id = _new_id('ami')
+            snapshot_id = _new_id('snap')
+            region.snapshots[snapshot_id] = {'SnapshotId': snapshot_id, 'VolumeSize': 50, 'StartTime': long_ago}
+            region.images[image_id] = _image(image_id, image_name, snapshot_id, long_ago, 0)
+            lc_name = '-'.join((lc_prefix, image_name))
+            region.lcs[lc_name] = {'LaunchConfigurationName': lc_name, 'ImageId': image_id,
+                                   'CreatedTime': _dt(long_ago)}
+            asg_name = '-'.join((asg_prefix, image_name))
+            region.asgs[asg_name] = _asg(asg_name, lc_name, size, size, size * 2, [elb_name] if live else [],
+                                         False, long_ago)
+            region.asgs[asg_name]['HealthCheckType'] = 'ELB'
+            region.reconcile(asg_name, long_ago)
+        return asg_name
+
+
+class FakeSession(object):
+
+    def __init__(self, aws, region_name):
+        self.aws = aws
+        self.region_name = region_name
+
+    def client(self, service, config=None):
+        max_attempts = 5
+        if config is not None and config.retries:
+            max_attempts = config.retries.get('max_attempts', max_attempts)
+        return FakeClient(self.aws, self.region_name, service, max_attempts)
+
+    def resource(self, service, config=None):
+        return _FakeEC2Resource(self.client(service, config))
+
+
+class _Events(object):
+
+    def __init__(self):
+        self._handlers = []
+
+    def register(self, event_name, handler, unique_id=None):
+        self._handlers.append((event_name, handler))
+
+    def emit(self, event_name, **kwargs):
+        for name, handler in self._handlers:
+            if event_name == name or event_name.startswith(name + '.'):
+                handler(event_name=event_name, **kwargs)
+
+
+class _Meta(object):
+
+    def __init__(self, region_name):
+        self.region_name = region_name
+        self.events = _Events()
+
+
+class _ServiceModel(object):
+
+    def __init__(self, service_name):
+        self.service_name = service_name
+
+
+class _OperationModel(object):
+
+    def __init__(self, service_name, name):
+        self.service_model = _ServiceModel(service_name)
+        self.name = name
+
+
+class FakeClient(object):
+
+    def __init__(self, aws, region_name, service, max_attempts):
+        self.aws = aws
+        self.region_name = region_name
+        self.service = service
+        self.max_attempts = max_attempts
+        self.meta = _Meta(region_name)
+        self._api = _SERVICES[service](aws, aws.region(region_name))
+
+    def __getattr__(self, name):
+        handler = getattr(self._api, name, None)
+        if name.startswith('_') or handler is None:
+            raise AttributeError(name)
+        operation = ''.join(part.capitalize() for part in name.split('_'))
+
+        def _call(**kwargs):
+            return self._call(operation, handler, kwargs)
+        return _call
+
+    def _call(self, operation, handler, kwargs):
+        model = _OperationModel(self.service, operation)
+        for attempt in range(self.max_attempts):
+            time.sleep(self.aws.latency['api'])
+            if self.aws.random.random() >= self.aws.throttle_rate:
+                break
+            parsed = {'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'},
+                      'ResponseMetadata': {'RetryAttempts': attempt}}
+            # as botocore, on every attempt
+            self.meta.events.emit('needs-retry.%s.%s' % (self.service, operation), response=(None, parsed),
+                                  operation=model, attempts=attempt + 1, caught_exception=None)
+            if attempt + 1 == self.max_attempts:
+                self.meta.events.emit('after-call.%s.%s' % (self.service, operation), parsed=parsed, model=model)
+                raise ClientError(parsed, operation)
+            time.sleep(self.aws.latency['retry_backoff'] * (2 ** attempt))
+        try:
+            with _lock:
+                now = time.time()
+                self._api.region.replace_unhealthy(now)
+                response = copy.deepcopy(handler(now, **kwargs))
+        except ClientError as e:
+            e.response['ResponseMetadata'] = {'RetryAttempts': attempt}
+            self.meta.events.emit('after-call.%s.%s' % (self.service, operation), parsed=e.response, model=model)
+            raise
+        response['ResponseMetadata'] = {'RetryAttempts': attempt}
+        self.meta.events.emit('after-call.%s.%s' % (self.service, operation), parsed=response, model=model)
+        return response
+
+    def get_paginator(self, name):
+        return _Paginator(getattr(self, name))
+
+    def get_waiter(self, name):
+        return _Waiter(self, name)
+
+
+class _Paginator(object):
+
+    def __init__(self, operation):
+        self._operation = operation
+
+    def paginate(self, **kwargs):
+        # everything fits in one page
+        yield self._operation(**kwargs)
+
+
+class _Waiter(object):
+    """ Only used on the base instance (system_status_ok). """
+
+    def __init__(self, client, name):
+        self._client = client
+
+    def wait(self, **kwargs):
+        base = self._client.aws.base
+        if base.started_at is None:
+            raise WaiterError(name='SystemStatusOk', reason='base instance %s is stopped' % base.id,
+                              last_response={})
+        time.sleep(max(0, base.ready_at() + self._client.aws.latency['status_ok'] - time.time()))
+
+
+class _FakeEC2Resource(object):
+
+    def __init__(self, client):
+        self._client = client
+
+    def Instance(self, instance_id):
+        return _FakeBaseInstance(self._client.aws, instance_id)
+
+
+class _FakeBaseInstance(object):
+
+    def __init__(self, aws, instance_id):
+        self.aws = aws
+        self.id = instance_id
+
+    @property
+    def state(self):
+        time.sleep(self.aws.latency['api'])
+        return {'Name': self.aws.base.state(time.time())}
+
+    def start(self):
+        time.sleep(self.aws.latency['api'])
+        with _lock:
+            if self.aws.base.started_at is None:
+                self.aws.base.started_at = time.time()
+                self.aws.base.starts += 1
+
+    def stop(self):
+        time.sleep(self.aws.latency['api'])
+        with _lock:
+            self.aws.base.started_at = None
+
+    def wait_until_running(self):
+        time.sleep(max(0, self.aws.base.ready_at() - time.time()))
+
+    def wait_until_stopped(self):
+        pass
+
+
+def _dt(ts):
+    return datetime.datetime.utcfromtimestamp(ts)
+
+
+def _image(image_id, name, snapshot_id, created, latency):
+    return {'ImageId': image_id, 'Name': name, 'Tags': [], 'ready_at': created + latency,
+            'CreationDate': _dt(created).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            'BlockDeviceMappings': [{'DeviceName': '/dev/sda1', 'Ebs': {'SnapshotId': snapshot_id, 'VolumeSize': 50}}]}
+
+
+def _asg(name, lc_name, min_size, desired, max_size, elbs, protected, created):
+    return {'AutoScalingGroupName': name, 'LaunchConfigurationName': lc_name, 'MinSize': min_size,
+            'MaxSize': max_size, 'DesiredCapacity': desired, 'LoadBalancerNames': list(elbs),
+            'NewInstancesProtectedFromScaleIn': protected, 'SuspendedProcesses': [], 'Tags': [],
+            'HealthCheckType': 'EC2', 'CreatedTime': _dt(created)}
+
+
+class _EC2(object):
+
+    def __init__(self, aws, region):
+        self.aws = aws
+        self.region = region
+
+    def create_image(self, now, InstanceId, Name, Description=None, **kwargs):
+        image_id = _new_id('ami')
+        snapshot_id = _new_id('snap')
+        self.region.snapshots[snapshot_id] = {'SnapshotId': snapshot_id, 'VolumeSize': 50, 'StartTime': now}
+        self.region.images[image_id] = _image(image_id, Name, snapshot_id, now, self.aws.latency['image_create'])
+        return {'ImageId': image_id}
+
+    def copy_image(self, now, SourceRegion, SourceImageId, Name, **kwargs):
+        source = self.aws.region(SourceRegion).images.get(SourceImageId)
+        if source is None or now < source['ready_at']:
+            raise _error('IncorrectState', 'source image %s is not available' % SourceImageId, 'CopyImage')
+        image_id = _new_id('ami')
+        snapshot_id = _new_id('snap')
+        self.region.snapshots[snapshot_id] = {'SnapshotId': snapshot_id, 'VolumeSize': 50, 'StartTime': now}
+        self.region.images[image_id] = _image(image_id, Name, snapshot_id, now, self.aws.latency['image_copy'])
+        return {'ImageId': image_id}
+
+    def describe_images(self, now, ImageIds=None, Owners=None, Filters=None, **kwargs):
+        images = []
+        for image_id in ImageIds or []:
+            image = self.region.images.get(image_id)
+            if image is None:
+                raise _error('InvalidAMIID.NotFound', 'image %s does not exist' % image_id, 'DescribeImages')
+            images.append(self._image(image, now))
+        if ImageIds is None:
+            for image in self.region.images.values():
+                image = self._image(image, now)
+                if all(self._matches(image, f) for f in Filters or []):
+                    images.append(image)
+        return {'Images': images}
+
+    def _matches(self, image, image_filter):
+        """ Supports the name, state and tag:<key> filters. """
+        name = image_filter['Name']
+        if name.startswith('tag:'):
+            values = [t['Value'] for t in image['Tags'] if t['Key'] == name[len('tag:'):]]
+        else:
+            values = [image[name.capitalize()]]
+        return any(fnmatch.fnmatchcase(v, pattern) for v in values for pattern in image_filter['Values'])
+
+    def deregister_image(self, now, ImageId):
+        if self.region.images.pop(ImageId, None) is None:
+            raise _error('InvalidAMIID.NotFound', 'image %s does not exist' % ImageId, 'DeregisterImage')
+        return {}
+
+    def delete_snapshot(self, now, SnapshotId):
+        for image in self.region.images.values():
+            if any(bdm['Ebs']['SnapshotId'] == SnapshotId for bdm in image['BlockDeviceMappings']):
+                raise _error('InvalidSnapshot.InUse', 'snapshot %s is in use by %s' % (SnapshotId, image['ImageId']),
+                             'DeleteSnapshot')
+        if self.region.snapshots.pop(SnapshotId, None) is None:
+            raise _error('InvalidSnapshot.NotFound', 'snapshot %s does not exist' % SnapshotId, 'DeleteSnapshot')
+        return {}
+
+    def _image(self, image, now):
+        result = dict((k, v) for k, v in image.items() if k != 'ready_at')
+        result['State'] = 'available' if now >= image['ready_at'] else 'pending'
+        return result
+
+    def create_tags(self, now, Resources, Tags, **kwargs):
+        for resource_id in Resources:
+            if resource_id in self.region.images:
+                self.region.images[resource_id]['Tags'].extend(Tags)
+        return {}
+
+    def describe_availability_zones(self, now, **kwargs):
+        return {'AvailabilityZones': [{'ZoneName': self.region.name + zone} for zone in 'abc']}
+
+    def describe_instance_status(self, now, InstanceIds, IncludeAllInstances=False, **kwargs):
+        statuses = []
+        for instance_id in InstanceIds:
+            ins = self._instance(instance_id, 'DescribeInstanceStatus')
+            state = ins.state(now)
+            ok = state == 'running' and now >= ins.ready_at() + self.aws.latency['status_ok']
+            if state == 'running' or IncludeAllInstances:
+                statuses.append({'InstanceId': instance_id, 'InstanceState': {'Name': state},
+                                 'SystemStatus': {'Status': 'ok' if ok else 'initializing'},
+                                 'InstanceStatus': {'Status': 'ok' if ok else 'initializing'}})
+        return {'InstanceStatuses': statuses}
+
+    def describe_instances(self, now, InstanceIds, **kwargs):
+        instances = [self.aws.base.describe(now) if instance_id == self.aws.base.id else
+                     {'InstanceId': instance_id, 'State': {'Name': self._instance(instance_id, 'DescribeInstances').state(now)}}
+                     for instance_id in InstanceIds]
+        return {'Reservations': [{'Instances': instances}]}
+
+    def describe_volumes(self, now, VolumeIds, **kwargs):
+        volumes = []
+        for volume_id in VolumeIds:
+            if volume_id != self.aws.base.volume_id:
+                raise _error('InvalidVolume.NotFound', 'volume %s does not exist' % volume_id, 'DescribeVolumes')
+            volumes.append({'VolumeId': volume_id, 'Size': 50, 'SnapshotId': '', 'State': 'in-use'})
+        return {'Volumes': volumes}
+
+    def describe_tags(self, now, Filters, **kwargs):
+        filters = dict((f['Name'], f['Values']) for f in Filters)
+        if any(not values for values in filters.values()):
+            # unspecified by EC2 (ignored, or an error): strict, so callers must not send one
+            raise _error('InvalidParameterValue', 'filter without values', 'DescribeTags')
+        tags = []
+        for instance_id in filters.get('resource-id', []):
+            ins = self.region.instances.get(instance_id)
+            if ins is not None and 'aws:autoscaling:groupName' in filters.get('key', ['aws:autoscaling:groupName']):
+                tags.append({'ResourceId': instance_id, 'Key': 'aws:autoscaling:groupName', 'Value': ins.asg_name})
+        return {'Tags': tags}
+
+    def _instance(self, instance_id, operation):
+        ins = self.region.instances.get(instance_id)
+        if ins is None:
+            raise _error('InvalidInstanceID.NotFound', 'instance %s does not exist' % instance_id, operation)
+        return ins
+
+
+class _AutoScaling(object):
+
+    def __init__(self, aws, region):
+        self.aws = aws
+        self.region = region
+
+    def create_launch_configuration(self, now, LaunchConfigurationName, ImageId, **kwargs):
+        if LaunchConfigurationName in self.region.lcs:
+            raise _error('AlreadyExists', 'launch configuration %s already exists' % LaunchConfigurationName,
+                         'CreateLaunchConfiguration')
+        self.region.lcs[LaunchConfigurationName] = {'LaunchConfigurationName': LaunchConfigurationName,
+                                                    'ImageId': ImageId, 'CreatedTime': _dt(now)}
+        return {}
+
+    def create_auto_scaling_group(self, now, AutoScalingGroupName, LaunchConfigurationName, MinSize, MaxSize,
+                                  DesiredCapacity=None, NewInstancesProtectedFromScaleIn=False, **kwargs):
+        if AutoScalingGroupName in self.region.asgs:
+            raise _error('AlreadyExists', 'group %s already exists' % AutoScalingGroupName, 'CreateAutoScalingGroup')
+        self.region.asgs[AutoScalingGroupName] = _asg(
+            AutoScalingGroupName, LaunchConfigurationName, MinSize,
+            MinSize if DesiredCapacity is None else DesiredCapacity, MaxSize, [],
+            NewInstancesProtectedFromScaleIn, now)
+        self.region.asgs[AutoScalingGroupName]['Tags'] = kwargs.get('Tags', [])
+        self.region.asgs[AutoScalingGroupName]['HealthCheckType'] = kwargs.get('HealthCheckType', 'EC2')
+        if self.region.name in self.aws.failing_regions:
+            self.aws.unhealthy_asgs.add((self.region.name, AutoScalingGroupName))
+        self.region.reconcile(AutoScalingGroupName, now)
+        return {}
+
+    def put_scaling_policy(self, now, AutoScalingGroupName, PolicyName, **kwargs):
+        arn = 'arn:aws:autoscaling:%s:policy/%s/%s' % (self.region.name, AutoScalingGroupName, PolicyName)
+        self.region.policies[arn] = dict(kwargs, AutoScalingGroupName=AutoScalingGroupName,
+                                         PolicyName=PolicyName, PolicyARN=arn)
+        return {'PolicyARN': arn}
+
+    def describe_auto_scaling_groups(self, now, AutoScalingGroupNames=None, **kwargs):
+        groups = []
+        for name in AutoScalingGroupNames or sorted(self.region.asgs.keys()):
+            if name in self.region.asgs:
+                self.region.reconcile(name, now)
+                group = dict(self.region.asgs[name])
+                group['Instances'] = [self._instance(i, now) for i in self.region.members(name, now)]
+                groups.append(group)
+        return {'AutoScalingGroups': groups}
+
+    def delete_auto_scaling_group(self, now, AutoScalingGroupName, ForceDelete=False):
+        self._group(AutoScalingGroupName, 'DeleteAutoScalingGroup')
+        if self.region.members(AutoScalingGroupName, now) and not ForceDelete:
+            raise _error('ResourceInUse', 'group %s still has instances' % AutoScalingGroupName,
+                         'DeleteAutoScalingGroup')
+        del self.region.asgs[AutoScalingGroupName]
+        return {}
+
+    def describe_launch_configurations(self, now, LaunchConfigurationNames=None, **kwargs):
+        names = LaunchConfigurationNames or sorted(self.region.lcs.keys())
+        return {'LaunchConfigurations': [self.region.lcs[name] for name in names if name in self.region.lcs]}
+
+    def delete_launch_configuration(self, now, LaunchConfigurationName):
+        if any(asg['LaunchConfigurationName'] == LaunchConfigurationName for asg in self.region.asgs.values()):
+            raise _error('ResourceInUse', 'launch configuration %s is attached to a group' % LaunchConfigurationName,
+                         'DeleteLaunchConfiguration')
+        if self.region.lcs.pop(LaunchConfigurationName, None) is None:
+            raise _error('ValidationError', 'launch configuration %s not found' % LaunchConfigurationName,
+                         'DeleteLaunchConfiguration')
+        return {}
+
+    def describe_auto_scaling_instances(self, now, InstanceIds, **kwargs):
+        return {'AutoScalingInstances': [dict(self._instance(self.region.instances[i], now),
+                                              AutoScalingGroupName=self.region.instances[i].asg_name)
+                                         for i in InstanceIds if i in self.region.instances]}
+
+    def _instance(self, ins, now):
+        asg = self.region.asgs[ins.asg_name]
+        elb_checked = asg['HealthCheckType'] == 'ELB' and asg['LoadBalancerNames'] # the ec2 status until attached
+        healthy = ins.healthy(now) or not elb_checked
+        return {'InstanceId': ins.id, 'LifecycleState': ins.lifecycle(now),
+                'HealthStatus': 'HEALTHY' if healthy else 'UNHEALTHY', 'ProtectedFromScaleIn': ins.protected}
+
+    def set_instance_protection(self, now, AutoScalingGroupName, InstanceIds, ProtectedFromScaleIn):
+        for instance_id in InstanceIds:
+            self.region.instances[instance_id].protected = ProtectedFromScaleIn
+        self.region.reconcile(AutoScalingGroupName, now)
+        return {}
+
+    def attach_load_balancers(self, now, AutoScalingGroupName, LoadBalancerNames):
+        asg = self._group(AutoScalingGroupName, 'AttachLoadBalancers')
+        for elb in LoadBalancerNames:
+            if elb not in asg['LoadBalancerNames']:
+                asg['LoadBalancerNames'].append(elb)
+            regs = self.region.registrations.setdefault(elb, {})
+            for ins in self.region.members(AutoScalingGroupName, now):
+                if ins.standby:
+                    continue # registered by exit_standby
+                if ins.id not in regs or regs[ins.id][1] is not None:
+                    regs[ins.id] = [now, None]
+        return {}
+
+    def detach_load_balancers(self, now, AutoScalingGroupName, LoadBalancerNames):
+        asg = self._group(AutoScalingGroupName, 'DetachLoadBalancers')
+        for elb in LoadBalancerNames:
+            if elb in asg['LoadBalancerNames']:
+                asg['LoadBalancerNames'].remove(elb)
+            for ins in self.region.members(AutoScalingGroupName, now):
+                reg = self.region.registrations.get(elb, {}).get(ins.id)
+                if reg is not None and reg[1] is None:
+                    reg[1] = now
+        return {}
+
+    def update_auto_scaling_group(self, now, AutoScalingGroupName, **kwargs):
+        asg = self._group(AutoScalingGroupName, 'UpdateAutoScalingGroup')
+        for key in ('MinSize', 'MaxSize', 'DesiredCapacity', 'HealthCheckType'):
+            if key in kwargs:
+                asg[key] = kwargs[key]
+        self.region.reconcile(AutoScalingGroupName, now)
+        return {}
+
+    def suspend_processes(self, now, AutoScalingGroupName, ScalingProcesses=None):
+        asg = self._group(AutoScalingGroupName, 'SuspendProcesses')
+        asg['SuspendedProcesses'] = [{'ProcessName': p} for p in ScalingProcesses or []]
+        return {}
+
+    def terminate_instance_in_auto_scaling_group(self, now, InstanceId, ShouldDecrementDesiredCapacity):
+        ins = self.region.instances.get(InstanceId)
+        if ins is None or ins.terminated_at is not None:
+            raise _error('ValidationError', 'instance %s is not part of an active group' % InstanceId,
+                         'TerminateInstanceInAutoScalingGroup')
+        asg = self.region.asgs[ins.asg_name]
+        if ShouldDecrementDesiredCapacity and not ins.standby: # not counted in it
+            asg['DesiredCapacity'] = max(asg['MinSize'], asg['DesiredCapacity'] - 1)
+        self.region.terminate(ins, now)
+        return {'Activity': {'ActivityId': _new_id('activity'), 'StatusCode': 'InProgress'}}
+
+    def enter_standby(self, now, AutoScalingGroupName, InstanceIds, ShouldDecrementDesiredCapacity):
+        asg = self._group(AutoScalingGroupName, 'EnterStandby')
+        instances = [self._member(asg, instance_id, 'InService', now, 'EnterStandby') for instance_id in InstanceIds]
+        if ShouldDecrementDesiredCapacity:
+            if asg['DesiredCapacity'] - len(instances) < asg['MinSize']:
+                raise _error('ValidationError', 'desired capacity of %s would be below its min size' %
+                             AutoScalingGroupName, 'EnterStandby')
+            asg['DesiredCapacity'] -= len(instances)
+        for ins in instances:
+            ins.standby = True
+            for elb in asg['LoadBalancerNames']:
+                reg = self.region.registrations.get(elb, {}).get(ins.id)
+                if reg is not None and reg[1] is None:
+                    reg[1] = now
+        self.region.reconcile(AutoScalingGroupName, now)
+        return {'Activities': [{'ActivityId': _new_id('activity'), 'StatusCode': 'InProgress'} for _ in instances]}
+
+    def exit_standby(self, now, AutoScalingGroupName, InstanceIds):
+        asg = self._group(AutoScalingGroupName, 'ExitStandby')
+        instances = [self._member(asg, instance_id, 'Standby', now, 'ExitStandby') for instance_id in InstanceIds]
+        if asg['DesiredCapacity'] + len(instances) > asg['MaxSize']:
+            raise _error('ValidationError', 'desired capacity of %s would be above its max size' %
+                         AutoScalingGroupName, 'ExitStandby')
+        asg['DesiredCapacity'] += len(instances)
+        for ins in instances:
+            ins.standby = False
+            for elb in asg['LoadBalancerNames']:
+                self.region.registrations.setdefault(elb, {})[ins.id] = [now, None]
+        self.region.reconcile(AutoScalingGroupName, now)
+        return {'Activities': [{'ActivityId': _new_id('activity'), 'StatusCode': 'InProgress'} for _ in instances]}
+
+    def _member(self, asg, instance_id, lifecycle, now, operation):
+        ins = self.region.instances.get(instance_id)
+        if ins is None or ins.asg_name != asg['AutoScalingGroupName'] or ins.terminated_at is not None:
+            raise _error('ValidationError', 'instance %s is not part of %s' % (instance_id, asg['AutoScalingGroupName']),
+                         operation)
+        if ins.lifecycle(now) != lifecycle:
+            raise _error('ValidationError', 'instance %s is not in %s' % (instance_id, lifecycle), operation)
+        return ins
+
+    def _group(self, name, operation):
+        if name not in self.region.asgs:
+            raise _error('ValidationError', 'group %s not found' % name, operation)
+        return self.region.asgs[name]
+
+
+class _ELB(object):
+
+    def __init__(self, aws, region):
+        self.aws = aws
+        self.region = region
+
+    def describe_instance_health(self, now, LoadBalancerName, Instances=None):
+        regs = self.region.registrations.get(LoadBalancerName, {})
+        ids = [i['InstanceId'] for i in Instances] if Instances else sorted(regs.keys())
+        states = []
+        for instance_id in ids:
+            state = self.region.elb_state(LoadBalancerName, instance_id, now)
+            if state is None:
+                if Instances:
+                    raise _error('InvalidInstance', 'instance %s is not registered with %s' % (
+                        instance_id, LoadBalancerName), 'DescribeInstanceHealth')
+                continue
+            states.append({'InstanceId': instance_id, 'State': state})
+        return {'InstanceStates': states}
+
+
+    def register_instances_with_load_balancer(self, now, LoadBalancerName, Instances):
+        regs = self.region.registrations.setdefault(LoadBalancerName, {})
+        for instance in Instances:
+            reg = regs.get(instance['InstanceId'])
+            if reg is None or reg[1] is not None:
+                regs[instance['InstanceId']] = [now, None]
+        return {'Instances': Instances}
+
+    def deregister_instances_from_load_balancer(self, now, LoadBalancerName, Instances):
+        regs = self.region.registrations.get(LoadBalancerName, {})
+        for instance in Instances:
+            reg = regs.get(instance['InstanceId'])
+            if reg is not None and reg[1] is None:
+                reg[1] = now
+        return {'Instances': [{'InstanceId': i} for i, reg in regs.items() if reg[1] is None]}
+
+
+class _CloudWatch(object):
+
+    def __init__(self, aws, region):
+        self.region = region
+
+    def put_metric_alarm(self, now, AlarmName, **kwargs):
+        self.region.alarms[AlarmName] = dict(kwargs, AlarmName=AlarmName)
+        return {}
+
+    def delete_alarms(self, now, AlarmNames):
+        for name in AlarmNames:
+            self.region.alarms.pop(name, None)
+        return {}
+
+
+_SERVICES = {'ec2': _EC2, 'autoscaling': _AutoScaling, 'elb': _ELB, 'cloudwatch': _CloudWatch}
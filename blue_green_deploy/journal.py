@@ -0,0 +1,56 @@
+""" Checkpoint journal of a deploy, so a crashed / killed deploy can be resumed.
+
+The journal is a local file of JSON lines, one per completed step:
+    {"env": "frankfurt", "step": "create_asg", "outputs": {"asg_name": "asg-..."}, "ts": 1476000000.0}
+Lines are appended and fsync'ed as soon as a step is done. Loading a journal
+replays them, giving the completed steps and the merged outputs (image ids,
+lc / asg names, ...) of every env.
+"""
+import json
+import os
+import threading
+import time
+
+
+class Journal(object):
+    """
+    Args:
+        path (str): journal file, created (with its directory) when missing,
+            loaded when it exists
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._done = {}
+        self._outputs = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as fh:
+                for line in fh:
+                    if line.strip():
+                        self._apply(json.loads(line))
+        elif os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+    def _apply(self, entry):
+        self._done.setdefault(entry['env'], set()).add(entry['step'])
+        self._outputs.setdefault(entry['env'], {}).update(entry.get('outputs') or {})
+
+    def done(self, env, step):
+        with self._lock:
+            return step in self._done.get(env, ())
+
+    def outputs(self, env):
+        """ Returns: dict of the outputs of every completed step of env """
+        with self._lock:
+            return dict(self._outputs.get(env, {}))
+
+    def record(self, env, step, outputs=None):
+        """ Mark step of env as done with its outputs, durably. """
+        entry = {'env': env, 'step': step, 'outputs': outputs or {}, 'ts': time.time()}
+        with self._lock:
+            with open(self.path, 'a') as fh:
+                fh.write(json.dumps(entry, sort_keys=True) + '\n')
+                fh.flush()
+                os.fsync(fh.fileno())
+            self._apply(entry)
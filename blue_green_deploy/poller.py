@@ -0,0 +1,130 @@
+""" Shared polling scheduler for the blue/green deploy waits.
+
+Instead of every wait running its own sleep + retry-count loop, all waits
+(across resources and regions) register a check with one Poller. A single
+scheduler thread keeps the waits in a heap ordered by their next due time and
+hands due checks to a small worker pool. Each wait is polled right away, then
+with exponential backoff (plus jitter, so regions don't poll in lockstep),
+until the check returns something truthy or its deadline passes.
+"""
+import heapq
+import itertools
+import random
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from botocore.exceptions import WaiterError
+
+
+class _Wait(object):
+    __slots__ = ('name', 'check', 'deadline', 'delay', 'max_delay', 'attempts', 'result', 'error', 'done')
+
+    def __init__(self, name, check, deadline, delay, max_delay):
+        self.name = name
+        self.check = check
+        self.deadline = deadline
+        self.delay = delay
+        self.max_delay = max_delay
+        self.attempts = 0
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class Poller(object):
+    """ Poll many conditions from one scheduler thread.
+
+    Args:
+        initial_delay (float): seconds between the first and second check
+        max_delay (float): upper bound of the backoff between checks
+        backoff (float): multiplier applied to the delay after every failed check
+        jitter (float): +/- fraction of randomness applied to every delay
+        workers (int): number of threads running the checks, so one slow
+            describe call does not hold up the other waits
+    """
+
+    def __init__(self, initial_delay=2.0, max_delay=15.0, backoff=1.5, jitter=0.2, workers=4):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.jitter = jitter
+        self.workers = workers
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pool = None
+
+    def wait(self, name, check, timeout, initial_delay=None, max_delay=None):
+        """ Block until check() returns something truthy, and return it.
+
+        Args:
+            name (str): name of the wait, used in the WaiterError
+            check (callable): no-arg callable, falsy while the condition does not hold.
+                Any exception it raises is re-raised to the caller.
+            timeout (float): seconds from now after which the wait fails
+            initial_delay (float): overrides the Poller initial_delay for this wait
+            max_delay (float): overrides the Poller max_delay for this wait
+        Returns:
+            the (truthy) result of check(), and the number of checks made
+        Raises:
+            WaiterError when timeout is reached before the condition holds
+        """
+        w = _Wait(name, check, time.time() + timeout,
+                  self.initial_delay if initial_delay is None else initial_delay,
+                  self.max_delay if max_delay is None else max_delay)
+        self._schedule(w, time.time())
+        # wait in slices so KeyboardInterrupt still reaches the main thread on py2
+        while not w.done.wait(1):
+            pass
+        if w.error is not None:
+            raise w.error
+        return w.result, w.attempts
+
+    def _schedule(self, w, due):
+        with self._cond:
+            if self._thread is None:
+                self._pool = ThreadPool(self.workers)
+                self._thread = threading.Thread(target=self._run, name='poller')
+                self._thread.daemon = True
+                self._thread.start()
+            heapq.heappush(self._heap, (due, next(self._seq), w))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                due = self._heap[0][0]
+                now = time.time()
+                if due > now:
+                    self._cond.wait(due - now)
+                    continue
+                w = heapq.heappop(self._heap)[2]
+            self._pool.apply_async(self._poll, (w,))
+
+    def _poll(self, w):
+        w.attempts += 1
+        try:
+            result = w.check()
+        except Exception as e:
+            w.error = e
+            w.done.set()
+            return
+        if result:
+            w.result = result
+            w.done.set()
+            return
+
+        now = time.time()
+        if now >= w.deadline:
+            w.error = WaiterError(name=w.name, reason='Max wait time exceeded after %s attempts' % w.attempts,
+                                  last_response=None)
+            w.done.set()
+            return
+        delay = w.delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+        w.delay = min(w.max_delay, w.delay * self.backoff)
+        # always get one last check in right at the deadline
+        self._schedule(w, min(now + delay, w.deadline))
@@ -1,10 +1,21 @@
 import datetime
+import functools
+import hashlib
 import logging, sys
+import math
+import os
 import time
+from multiprocessing.pool import ThreadPool
 
-import boto3
 from botocore.exceptions import WaiterError, ClientError
 
+import environments
+from cache import StateCache
+from clients import ClientRegistry
+from journal import Journal
+from poller import Poller
+from tracing import Tracer
+
 _LOG = logging.getLogger(__name__) # NOTE: add 'extra=d' in any _LOG function)
 
 # extra format for env
@@ -22,23 +33,90 @@ _base_instance_id = 'i-1234' # hardcode? ever change? query by tag?
 _prefix = "prefix"
 _lc_prefix = "lc"
 _asg_prefix = "asg"
-_elb = "elb_name" # diff region share the same elb name, but it will be diff elb per region
-
-_config = {}
-_config['prod'] = {'env': 'prod', 'subnets': 'subnet-zone-a,subnet-zone-b,subnet-zone-c', 'sg_group': 'sg-1234', 'iam': 'prod-iam', 'session': boto3.session.Session(region_name='us-west-2')}
-_config['frankfurt'] = {'env': 'frankfurt', 'subnets': 'subnet-zone-a,subnet-zone-b,subnet-zone-c', 'sg_group': 'sg-5678', 'iam': 'ff-iam', 'session': boto3.session.Session(region_name='eu-central-1')}
-
+_max_concurrent_regions = None # None: deploy to every region at once
+_canary_region = None # eg: 'prod' to deploy there first and only fan out once it succeeded
+# ami build cache: images are tagged with a fingerprint of the base instance, a deploy reuses
+# the newest image with the same fingerprint in each region instead of creating / copying one.
+# Bump the _build_rev_tag tag of the base instance whenever its content changes, no tag: no caching
+_ami_cache = True
+_build_rev_tag = 'build-rev'
+_fingerprint_tag = 'base-fingerprint'
+_warm_standby = False # keep the base instance running between deploys instead of stopping it in cleanup
+# sizing of the new asg: 'fixed' for the 'capacity' of the env, 'match' for the current size of the old asg
+# (as left by its scaling policies) plus _surge, eg: 0.25 to launch 25% more instances than the old asg has
+_capacity_mode = 'match'
+_surge = 0.0
+# once the new asg is InService, old instances are deregistered from the elb in this many batches,
+# checking the new asg stays InService after each one, before the old asg is detached. 1: all at once
+_shift_batches = 1
+
+# clients shared by every step and region, the pool covers the region threads + poller workers
+_clients = ClientRegistry(max_pool_connections=20, max_attempts=10)
+# phase timings, waits and api calls of the run, see _traced
+_tracer = Tracer()
+_clients.on_create(_tracer.instrument)
+_trace_file = '/tmp/blue_green_deploy-%s.trace.json' # % timestamp, written by __main__
+# checkpoint journal of the running deploy, see deploy / resume
+_journal = None
+_journal_dir = os.path.expanduser('~/.blue_green_deploy')
+# one polling scheduler shared by every wait, in every region
+_poller = Poller(initial_delay=2, max_delay=15)
+# wait timeouts in seconds
+_image_timeout = 6000 # windows image creation and cross region copy can take a long time
+_instances_timeout = 600
+_elb_timeout = 600
+_terminate_timeout = 1800
+# number of deploys (asg -> lc -> ami -> snapshots chains) to keep per region, None to never collect
+_keep_deploys = 10
+# cleanup only reports (dry run) the deploys beyond _keep_deploys unless enabled, `sample.py gc --delete` deletes them
+_gc_on_cleanup = False
+_gc_workers = 4 # chains deleted at the same time, per region
+_asg_delete_timeout = 900
+# (initial, max) poll delay while rolling back: re-registering the old asg with the elb is urgent
+_rollback_poll_delays = (0.5, 3)
+# seconds to trust cached asg membership / elb health, refreshed on mutation anyway
+_state_ttl = 30
+_azs_ttl = 3600
+
+# env key -> config of every region deployed to, see environments.py. Images are created in prod
+_environments_file = os.environ.get('BLUE_GREEN_DEPLOY_ENVIRONMENTS',
+                                    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'environments.json'))
+_config = environments.load(_environments_file)
+
+def _traced(func):
+    """ Record every call of func as a phase of the env it works on, taken from its
+        first argument (a config or an env key), '-' otherwise.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        env = d['env']
+        if args and isinstance(args[0], dict):
+            env = args[0]['env']
+        elif args and isinstance(args[0], str) and args[0] in _config:
+            env = _config[args[0]]['env']
+        with _tracer.phase(env, func.__name__.lstrip('_')):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+@_traced
 def start_instance():
-    """ Start the base inatance.
+    """ Start the base inatance. Does not restart it when already running (warm standby).
 
     Raises:
         Caller to handle exception on failure.
     """
-    _ec2_r = _config['prod']['session'].resource('ec2')
-    _ec2_c = _config['prod']['session'].client('ec2')
+    _ec2_r = _clients.resource(_config['prod']['session'], 'ec2')
+    _ec2_c = _client(_config['prod'], 'ec2')
     base_instance = _ec2_r.Instance(_base_instance_id)
-    base_instance.start()
-    _LOG.debug('Base instance %s started. Waiting for it to come up.', _base_instance_id, extra=d)
+    state = base_instance.state['Name']
+    if state in ('pending', 'running'):
+        _LOG.debug('Base instance %s already %s.', _base_instance_id, state, extra=d)
+    else:
+        if state == 'stopping':
+            base_instance.wait_until_stopped()
+        base_instance.start()
+        _LOG.debug('Base instance %s started. Waiting for it to come up.', _base_instance_id, extra=d)
     base_instance.wait_until_running()
     _LOG.debug('Base instance %s up and running.', _base_instance_id, extra=d)
 
@@ -47,6 +125,7 @@ def start_instance():
     _LOG.debug('Base instance %s system_status_ok.', _base_instance_id, extra=d)
 
 
+@_traced
 def stop_instance(skip_wait):
     """ Stop the base instance.
 
@@ -59,9 +138,12 @@ def stop_instance(skip_wait):
     Raises:
         Caller to handle any exception on stopping failure.
     """
-    _ec2_r = _config['prod']['session'].resource('ec2')
-    _ec2_c = _config['prod']['session'].client('ec2')
+    _ec2_r = _clients.resource(_config['prod']['session'], 'ec2')
+    _ec2_c = _client(_config['prod'], 'ec2')
     base_instance = _ec2_r.Instance(_base_instance_id)
+    if base_instance.state['Name'] in ('stopping', 'stopped'):
+        _LOG.debug('Base instance %s already %s.', _base_instance_id, base_instance.state['Name'], extra=d)
+        return
     _LOG.debug('Waiting for base instance %s for system_status_ok.', _base_instance_id, extra=d)
     if not skip_wait:
         waiter = _ec2_c.get_waiter('system_status_ok')
@@ -77,105 +159,330 @@ def stop_instance(skip_wait):
     # base_instance.wait_until_stopped()
 
 
-def deploy(user_name):
-    image_name = _create_ami_image(user_name)
+class DeployError(Exception):
+    """ Raised when one or more regions failed to deploy.
+
+    Attributes:
+        response (dict): env key -> [old_asg_name, new_asg_name] for the regions that succeeded
+        errors (dict): env key -> exception for the regions that failed (or were skipped)
+    """
+    def __init__(self, response, errors):
+        self.response = response
+        self.errors = errors
+        super(DeployError, self).__init__('deploy failed in %s: %s' % (
+            ', '.join(sorted(errors.keys())), '; '.join('%s: %s' % (k, errors[k]) for k in sorted(errors.keys()))))
+
+
+def deploy(user_name, max_concurrent_regions=None, canary_region=None):
+    """ Deploy the base instance to every region. Every completed step is written to
+        the journal <_journal_dir>/<image_name>.journal, see resume.
+        The base instance is only started when no cached image matches it, see _create_ami_image.
+    """
+    current_datetime_s = datetime.datetime.strftime(datetime.datetime.now(), '%Y_%m_%d_%H_%M_%S')
+    image_name = _DELIMITER.join((_prefix, user_name, current_datetime_s))
+    journal = Journal(os.path.join(_journal_dir, image_name + '.journal'))
+    journal.record('-', 'start', {'image_name': image_name})
+    return _run_deploy(journal, image_name, max_concurrent_regions, canary_region)
+
+
+def resume(journal_path, max_concurrent_regions=None, canary_region=None):
+    """ Continue a crashed / killed deploy from its journal: steps already done (eg: ami
+        creation and copies, lc, asg, instances boot) are not repeated, their outputs
+        (image ids, lc / asg names) are read back from the journal instead.
+    """
+    journal = Journal(journal_path)
+    image_name = journal.outputs('-')['image_name']
+    return _run_deploy(journal, image_name, max_concurrent_regions, canary_region)
+
+
+def _run_deploy(journal, image_name, max_concurrent_regions, canary_region):
+    global _journal
+    _journal = journal
+    _LOG.debug('deploying %s, journal: %s', image_name, journal.path, extra=d)
+    _create_ami_image(image_name)
     launch_config_name = _DELIMITER.join((_lc_prefix, image_name))
-    return _do_deploy(launch_config_name)
+    return _do_deploy(launch_config_name, max_concurrent_regions, canary_region)
 
 
-def _create_ami_image(user_name):
+@_traced
+def _create_ami_image(image_name):
     """ Create an AMI based off the base instance.
 
-    This will create the ami image based on the username in us-west-2, and make a copy in frankfurt.
-    This method is blocked until image is available. The ami will be used for deploying new codes.
+    This will create the ami image in prod (us-west-2) and blocks until it is
+    available. Copies to every other env in _config are then started at once
+    and NOT waited on here: each region waits for its own copy as the first
+    step of _do_blue_green_deploy, so prod can roll out while the (slow) copies
+    are still in flight.
+    Images / copies already in the journal are not created again.
+    With _ami_cache, an image tagged with the fingerprint of the base instance is
+    reused in each region instead: no start of the base instance, no create_image
+    or copy_image when it has not changed since the last deploy.
     Args:
-        user_name (str): user_name from the caller, this is used to generated the image name
-    Returns:
-        str: image_name
+        image_name (str): name of the image, generated from the user name by deploy
     Raises:
         Caller to handle exception on failure.
     """
-    current_datetime_s = datetime.datetime.strftime(datetime.datetime.now(), '%Y_%m_%d_%H_%M_%S')
-    image_name = _DELIMITER.join((_prefix, user_name, current_datetime_s))
-
     global _config
+    fingerprint = _base_fingerprint() if _ami_cache else None
     # create image in prod
-    _ec2_c = _config['prod']['session'].client('ec2')
-    _LOG.debug('creating ami image %s in prod.', image_name, extra=d )
-    image_id = _ec2_c.create_image(
-        InstanceId=_base_instance_id,
-        Name=image_name,
-        Description=image_name,
-    )['ImageId']
-
-    _wait_image(_config['prod'], image_id)
+    prod = _config['prod']
+    cached = not _journal.done('prod', 'create_image') and _find_cached_image(prod, fingerprint)
+    if _journal.done('prod', 'create_image'):
+        image_id = _journal.outputs('prod')['image_id']
+    elif cached:
+        image_id = cached['ImageId']
+        _LOG.debug('reusing ami image %s for base fingerprint %s in prod.', image_id, fingerprint, extra=d)
+        _journal.record('prod', 'create_image', {'image_id': image_id, 'cached': True})
+    else:
+        start_instance()
+        _LOG.debug('creating ami image %s in prod.', image_name, extra=d )
+        try:
+            image_id = _client(prod, 'ec2').create_image(
+                InstanceId=_base_instance_id,
+                Name=image_name,
+                Description=image_name,
+            )['ImageId']
+        except ClientError as err:
+            # created by a run that died before writing the journal
+            image_id = _find_image_by_name(prod, image_name, err)
+        _tag_image(prod, image_id, image_name, fingerprint)
+        _journal.record('prod', 'create_image', {'image_id': image_id})
+
+    _wait_image(prod, image_id)
     _LOG.debug('created ami image %s: %s in prod.', image_id, image_name, extra=d )
+    prod['image_id'] = image_id
+    prod['image_pending'] = False
+
+    # copy to every other env, this is async and could be really slow, so only kick them off here
+    for key in _config.keys():
+        if key == 'prod':
+            continue
+        config = _config[key]
+        config['image_pending'] = True
+        if _journal.done(config['env'], 'copy_image'):
+            config['image_id'] = _journal.outputs(config['env'])['image_id']
+            continue
+        cached = _find_cached_image(config, fingerprint)
+        if cached:
+            config['image_id'] = cached['ImageId']
+            config['image_pending'] = cached['State'] != 'available'
+            _LOG.debug('reusing ami image %s for base fingerprint %s in %s.', cached['ImageId'], fingerprint, key,
+                       extra=d)
+            _journal.record(config['env'], 'copy_image', {'image_id': config['image_id'], 'cached': True})
+            continue
+        _LOG.debug('copying ami image %s to %s.', image_name, key, extra=d )
+        try:
+            config['image_id'] = _client(config, 'ec2').copy_image(
+                SourceRegion=prod['region'],
+                SourceImageId=image_id,
+                Name=image_name,
+                Description=image_name,
+                Encrypted=False
+            )['ImageId']
+        except ClientError as err:
+            config['image_id'] = _find_image_by_name(config, image_name, err)
+        _tag_image(config, config['image_id'], image_name, fingerprint)
+        _journal.record(config['env'], 'copy_image', {'image_id': config['image_id']})
+        _LOG.debug('copying ami image %s: %s to %s', config['image_id'], image_name, key, extra=d )
+
+
+def _find_image_by_name(config, image_name, err):
+    """ Id of our image named image_name, re-raising err when it is not a duplicate name error. """
+    if err.response['Error']['Code'] != 'InvalidAMIName.Duplicate':
+        raise err
+    images = _client(config, 'ec2').describe_images(
+        Owners=['self'],
+        Filters=[{'Name': 'name', 'Values': [image_name]}]
+    )['Images']
+    if not images:
+        raise err
+    return images[0]['ImageId']
+
+
+def _tag_image(config, image_id, image_name, fingerprint=None):
+    tags = [
+        {'Key': 'Name', 'Value': image_name},
+        {'Key': 'role', 'Value': _prefix},
+        {'Key': 'Environment', 'Value': config['env']}
+    ]
+    if fingerprint:
+        tags.append({'Key': _fingerprint_tag, 'Value': fingerprint})
+    _client(config, 'ec2').create_tags(
+        Resources=[image_id],
+        Tags=tags
+    )
+
 
-    # copy to frankfurt, this is async, could be really slow
-    # TODO: what if we have another env? should loop every thing but prod in the _config
-    _LOG.debug('copying ami image %s to frankfurt.', image_name, extra=d )
-    image_id_ff = _config['frankfurt']['session'].client('ec2').copy_image(
-        SourceRegion='us-west-2',
-        SourceImageId=image_id,
-        Name=image_name,
-        Description=image_name,
-        Encrypted=False
-    )['ImageId']
+def _base_fingerprint():
+    """ Fingerprint of what an image of the base instance would contain: its instance type,
+        its volumes (id, size, snapshot it was created from) and its _build_rev_tag tag.
+        The content of a volume is not visible through the api, hence the tag.
+
+    Returns:
+        str: the fingerprint, None when the base instance has no _build_rev_tag tag (no caching)
+    """
+    _ec2_c = _client(_config['prod'], 'ec2')
+    instance = _ec2_c.describe_instances(InstanceIds=[_base_instance_id])['Reservations'][0]['Instances'][0]
+    tags = dict((tag['Key'], tag['Value']) for tag in instance.get('Tags', []))
+    if not tags.get(_build_rev_tag):
+        _LOG.debug('base instance %s has no %s tag, not using the ami cache', _base_instance_id, _build_rev_tag,
+                   extra=d)
+        return None
+    volume_ids = [m['Ebs']['VolumeId'] for m in instance.get('BlockDeviceMappings', []) if 'Ebs' in m]
+    volumes = _ec2_c.describe_volumes(VolumeIds=volume_ids)['Volumes'] if volume_ids else []
+    parts = [instance['InstanceType'], tags[_build_rev_tag]]
+    parts.extend(sorted('%s:%s:%s' % (v['VolumeId'], v['Size'], v.get('SnapshotId', '')) for v in volumes))
+    fingerprint = hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()[:16]
+    _LOG.debug('base instance %s fingerprint: %s (%s)', _base_instance_id, fingerprint, parts, extra=d)
+    return fingerprint
+
+
+def _find_cached_image(config, fingerprint):
+    """ Newest available or pending image of ours tagged with fingerprint, None when there is none. """
+    if not fingerprint:
+        return None
+    images = _client(config, 'ec2').describe_images(
+        Owners=['self'],
+        Filters=[
+            {'Name': 'tag:' + _fingerprint_tag, 'Values': [fingerprint]},
+            {'Name': 'state', 'Values': ['available', 'pending']},
+        ]
+    )['Images']
+    return max(images, key=lambda image: image['CreationDate']) if images else None
 
-    _wait_image(_config['frankfurt'], image_id_ff)
-    _LOG.debug('copied ami image %s: %s to frankfurt', image_id_ff, image_name, extra=d )
 
-    # TODO: tag both prod and ff images
-    
-    # update the global config
-    _config['prod']['image_id'] = image_id
-    _config['frankfurt']['image_id'] = image_id_ff
-    return image_name
+@_traced
+def _wait_region_image(config):
+    """ Block until the ami of this region (eg: a copy from prod) is available. """
+    d = {'env': config['env']}
+    if config.get('image_pending'):
+        _wait_image(config, config['image_id'])
+        config['image_pending'] = False
+        _LOG.debug('ami image %s available', config['image_id'], extra=d)
 
 
 def _wait_image(config, image_id):
     d = {'env': config['env']}
-    # hacky workaround for boto3 bug/err
-    # (eg: botocore.exceptions.WaiterError: Waiter ImageAvailable failed: Waiter encountered a terminal failure state)
-    time.sleep(10)
-
-    _ec2_c = config['session'].client('ec2')
-    waiter = _ec2_c.get_waiter('image_available')
-    # image creation for windows can take a long time, wait longer and only consider failure afterward
-    # copy image to ff is even slower, so increase wait even longer
-    for i in range(1, 11):
+    _ec2_c = _client(config, 'ec2')
+
+    def _image_available():
         try:
-            _LOG.debug('Waiting for image %s to be available. Trying %s...', image_id, i, extra=d)
-            waiter.wait(ImageIds=[image_id])
-            break
-        except WaiterError as e:
-            if i == 10:
-                raise e
-            continue
+            images = _ec2_c.describe_images(ImageIds=[image_id])['Images']
+        except ClientError as err:
+            # a just created/copied image may not be visible yet (InvalidAMIID.NotFound)
+            _LOG.debug('image %s not found yet: %s', image_id, err, extra=d)
+            return False
+        state = images[0]['State'] if images else 'pending'
+        if state in ('failed', 'invalid', 'deregistered', 'error'):
+            raise WaiterError(name='ImageAvailable', reason='image %s is %s' % (image_id, state), last_response=images)
+        _LOG.debug('image %s is %s', image_id, state, extra=d)
+        return state == 'available'
+
+    _LOG.debug('Waiting for image %s to be available.', image_id, extra=d)
+    # image creation for windows can take a long time, copy image to ff is even slower
+    _wait_until(config, 'ImageAvailable', _image_available, _image_timeout, max_delay=30)
+
+
+def _wait_until(config, name, check, timeout, initial_delay=None, max_delay=None):
+    """ Wait on the shared poller until check() holds. Returns what check() returned. """
+    d = {'env': config['env']}
+    start = time.time()
+    result, attempts = _poller.wait(name, check, timeout, initial_delay=initial_delay, max_delay=max_delay)
+    _tracer.wait(config['env'], name, attempts, start, time.time())
+    _LOG.debug('%s done after %s checks', name, attempts, extra=d)
+    return result
 
 
-def _do_deploy(launch_config_name):
+def _do_deploy(launch_config_name, max_concurrent_regions=None, canary_region=None):
+    """ Run _do_blue_green_deploy for every region in _config concurrently.
+
+    Every region gets its own worker thread (up to max_concurrent_regions), so a
+    slow region does not hold up the others. When canary_region is given, that
+    region is deployed on its own first and the rest only fan out once it
+    succeeded.
+
+    Args:
+        launch_config_name (str): the name of the LC to be created in every region
+        max_concurrent_regions (int): cap of regions deploying at the same time,
+            defaults to _max_concurrent_regions (None: all of them)
+        canary_region (str): env key to deploy first, defaults to _canary_region
+    Returns:
+        dict: env key -> [old_asg_name, new_asg_name]
+    Raises:
+        DeployError when any region failed, carrying the per-region results and exceptions.
+    """
+    max_concurrent_regions = max_concurrent_regions or _max_concurrent_regions
+    canary_region = canary_region or _canary_region
+    if canary_region and canary_region not in _config:
+        raise Exception("canary region %s is not in the config" % canary_region)
+
     response = {}
-    for key in _config.keys():
-        old_asg_name, new_asg_name = _do_blue_green_deploy(_config[key], launch_config_name)
-        response[key] = [old_asg_name, new_asg_name]
+    errors = {}
+    keys = list(_config.keys())
+    for key in keys:
+        # fresh state for every deploy, but the AZs: they hardly ever change
+        _state(_config[key]).clear(keep=[('azs',)])
+    if canary_region:
+        keys.remove(canary_region)
+        _LOG.debug('deploying canary region %s first', canary_region, extra=d)
+        _deploy_regions([canary_region], launch_config_name, 1, response, errors)
+        if errors:
+            for key in keys:
+                errors[key] = Exception('skipped, canary region %s failed' % canary_region)
+            raise DeployError(response, errors)
+
+    _deploy_regions(keys, launch_config_name, max_concurrent_regions, response, errors)
+    if errors:
+        raise DeployError(response, errors)
     return response
 
 
+def _deploy_regions(keys, launch_config_name, max_concurrent_regions, response, errors):
+    """ Deploy the given regions on a thread pool, collecting into response / errors. """
+    if not keys:
+        return
+
+    def _deploy_region(key):
+        try:
+            return key, _do_blue_green_deploy(_config[key], launch_config_name), None
+        except Exception as e:
+            _LOG.exception('deploy failed', extra={'env': _config[key]['env']})
+            return key, None, e
+
+    pool = ThreadPool(min(len(keys), max_concurrent_regions or len(keys)))
+    try:
+        for key, result, err in pool.imap_unordered(_deploy_region, keys):
+            if err is None:
+                response[key] = list(result)
+            else:
+                errors[key] = err
+    finally:
+        pool.close()
+        pool.join()
+
+
+@_traced
 def _do_blue_green_deploy(config, launch_config_name):
     d = {'env': config['env']}
     """ Trigger blue/green deployment via swapping ASG with same ELB.
-        1. create new lc
-        2. create new asg  with new lc, but no elb.
-        3. wait for new instances Healthy and InService
-        4. remove scale in protection on new instances on new asg
-        5. attach elb to new asg and update asg health check to elb
-        5. wait for instance registered with elb
-        6. find old asg
-        7. deatach elb from old asg
-        8. wait
-
-        #TODO potential rollback step(s): Note: cleanup steps should be similar removing the oldest set (asg-lc-ami-snapshot)
+        0. wait for the ami of this region to be available (copies may still be in flight)
+        1. find old asg
+        2. create new lc
+        3. create new asg  with new lc, but no elb, sized after the old asg, see _new_asg_capacity
+        4. wait for new instances Healthy and InService
+        5. remove scale in protection on new instances on new asg
+        6. attach elb to new asg and update asg health check to elb
+        7. wait for instance registered with elb
+        8. deregister the old instances from the elb in batches, see _shift_traffic
+        9. deatach elb from old asg
+        10. wait
+
+        Every step is an entry of _DEPLOY_STEPS, recorded in the journal once done
+        and skipped when the journal says it is done already (resume).
+        When the new instances do not get healthy / InService (_ROLLBACK_STEPS),
+        the deploy of the region is rolled back automatically, see _rollback.
+
+        Manual rollback step(s), after the old asg was detached: Note: cleanup steps should be similar removing the oldest set (asg-lc-ami-snapshot)
         aws autoscaling update-auto-scaling-group --auto-scaling-group-name <old_asg_name> ...
         aws autoscaling attach-load-balancers --auto-scaling-group-name <old_asg_name>
         aws autoscaling detach-load-balancers --auto-scaling-group-name <new_asg_name> --load-balancer-names <elb_name> #Need wait?
@@ -198,35 +505,232 @@ def _do_blue_green_deploy(config, launch_config_name):
     Returns:
         str, str : previous autoscaling group name (or None), new autoscaling group name
     """
-    _create_lc(config, launch_config_name)
-    asg_name = _create_asg(config, launch_config_name)
-    _wait_for_instances_healthy(config, asg_name)
-    _remove_protection(config, asg_name)
-    _attach_elb_to_asg(config, asg_name)
+    if _journal.done(config['env'], 'rolled_back'):
+        raise Exception('deploy to %s was rolled back, start a new deploy' % config['env'])
+    state = {'launch_config_name': launch_config_name}
+    state.update(_journal.outputs(config['env']))
+    for step, run in _DEPLOY_STEPS:
+        if _journal.done(config['env'], step):
+            _LOG.debug('%s already done', step, extra=d)
+            continue
+        try:
+            outputs = run(config, state) or {}
+        except Exception:
+            if step not in _ROLLBACK_STEPS:
+                raise
+            _LOG.exception('%s failed, rolling back', step, extra=d)
+            _rollback(config, state)
+            _journal.record(config['env'], 'rolled_back')
+            raise
+        state.update(outputs)
+        _journal.record(config['env'], step, outputs)
+    return state['old_asg_name'], state['asg_name']
+
+
+# the steps of _do_blue_green_deploy: (name, callable(config, state) returning a dict
+# of outputs to be added to the state, or None)
+_DEPLOY_STEPS = [
+    ('wait_image', lambda config, state: _wait_region_image(config)), # copied amis may still be in flight
+    # found before creating the new asg, to size it after the old one and so a rollback knows
+    # which asg to fall back to
+    ('find_old_asg', lambda config, state: {'old_asg_name': _find_old_asg_name(config, config['elb'], None)}),
+    ('create_lc', lambda config, state: _create_lc(config, state['launch_config_name'])),
+    ('create_asg', lambda config, state: {'asg_name': _create_asg(config, state['launch_config_name'], state['old_asg_name'])}),
+    ('instances_healthy', lambda config, state: _wait_for_instances_healthy(config, state['asg_name'])),
+    ('remove_protection', lambda config, state: _remove_protection(config, state['asg_name'])),
+    ('attach_elb', lambda config, state: _attach_elb_to_asg(config, state['asg_name'])),
     # traffic starts flowing to new asg / instances after here
-    # TODO: roll back instead of continue below if new instances failed ELB health check
-    _wait_for_elb(config, _elb, asg_name, "InService")
-    old_asg_name = _find_old_asg_name(config, _elb, asg_name)
+    ('elb_inservice', lambda config, state: _wait_for_elb(config, config['elb'], state['asg_name'], "InService")),
+    ('shift_traffic', lambda config, state: state['old_asg_name'] and _shift_traffic(config, state)),
+    ('detach_old_asg', lambda config, state: state['old_asg_name'] and _detach_elb_from_old_asg(config, state['old_asg_name'])),
+    ('old_asg_outofservice', lambda config, state: state['old_asg_name'] and _wait_for_old_asg_outofservice(config, state)),
+]
+
+
+# a failure of these steps rolls the region back
+_ROLLBACK_STEPS = ('instances_healthy', 'elb_inservice', 'shift_traffic')
+
+
+@_traced
+def _rollback(config, state):
+    """ Put the old asg back in front of the elb and tear the new asg down, all at once:
+        1. (re-)attach the elb to the old asg and wait for its instances InService, polling fast
+        2. detach the elb from the new asg
+        3. scale the new asg to 0 and terminate its instances
+        The new asg / lc are left for cleanup. Terminated instances are not waited on.
+    """
+    d = {'env': config['env']}
+    asg_name = state['asg_name']
+    old_asg_name = state.get('old_asg_name')
+    _LOG.warning('rolling back new asg %s to old asg %s', asg_name, old_asg_name, extra=d)
+    calls = [
+        functools.partial(_detach_elb_from_new_asg, config, asg_name),
+        functools.partial(_drain_asg, config, asg_name),
+    ]
     if old_asg_name:
-        _detach_elb_from_old_asg(config, old_asg_name)
-        _wait_for_elb(config, _elb, old_asg_name, "OutOfService")
-    return old_asg_name, asg_name
+        calls.insert(0, functools.partial(_reattach_old_asg, config, old_asg_name, state.get('old_min_size')))
+    _in_parallel(calls)
+    _LOG.warning('rolled back new asg %s to old asg %s', asg_name, old_asg_name, extra=d)
+
+
+def _reattach_old_asg(config, old_asg_name, min_size=None):
+    """ min_size (int): of the old asg before _shift_traffic lowered it, restored when given """
+    d = {'env': config['env']}
+    _LOG.debug('re-attaching elb %s to old asg %s', config['elb'], old_asg_name, extra=d)
+    _asg = _client(config, 'autoscaling')
+    _asg.attach_load_balancers(
+        AutoScalingGroupName=old_asg_name,
+        LoadBalancerNames=[config['elb']]
+    )
+    old_asg = _describe_asgs(config, [old_asg_name], fresh=True).get(old_asg_name)
+    standby_ids = [ins['InstanceId'] for ins in old_asg['Instances'] if ins['LifecycleState'] == 'Standby'] \
+        if old_asg else []
+    if standby_ids:
+        # the ones put in standby by _shift_traffic: back in the desired capacity and the elb
+        _LOG.debug('exiting standby for old instances %s', standby_ids, extra=d)
+        _asg.exit_standby(
+            InstanceIds=standby_ids,
+            AutoScalingGroupName=old_asg_name
+        )
+    if min_size:
+        _asg.update_auto_scaling_group(
+            AutoScalingGroupName=old_asg_name,
+            MinSize=min_size
+        )
+    _invalidate_asg(config, old_asg_name)
+    _state(config).invalidate(('elb_health', config['elb']))
+    _wait_for_elb(config, config['elb'], old_asg_name, "InService", poll_delays=_rollback_poll_delays)
+
+
+def _detach_elb_from_new_asg(config, asg_name):
+    d = {'env': config['env']}
+    _LOG.debug('detaching elb %s from new asg %s', config['elb'], asg_name, extra=d)
+    _client(config, 'autoscaling').detach_load_balancers(
+        AutoScalingGroupName=asg_name,
+        LoadBalancerNames=[config['elb']]
+    )
+    _state(config).invalidate(('elb_health', config['elb']))
 
 
+def _drain_asg(config, asg_name):
+    """ Scale the asg to 0 and terminate its instances concurrently. """
+    d = {'env': config['env']}
+    _asg = _client(config, 'autoscaling')
+    _LOG.debug('scaling asg %s to 0', asg_name, extra=d)
+    _asg.update_auto_scaling_group(
+        AutoScalingGroupName=asg_name,
+        MinSize=0,
+        MaxSize=0,
+        DesiredCapacity=0
+    )
+    _invalidate_asg(config, asg_name)
+    instance_ids = _get_instance_ids(config, asg_name)
+    if not instance_ids:
+        return
+    _remove_protection(config, asg_name) # protected instances are not terminated by the scale in
+    _in_parallel([functools.partial(_terminate_instance, config, instance_id) for instance_id in instance_ids])
+    _invalidate_asg(config, asg_name)
+
+
+def _terminate_instance(config, instance_id):
+    try:
+        _client(config, 'autoscaling').terminate_instance_in_auto_scaling_group(
+            InstanceId=instance_id,
+            ShouldDecrementDesiredCapacity=True
+        )
+    except ClientError as err:
+        # already terminating, eg: by the scale in
+        if err.response['Error']['Code'] != 'ValidationError':
+            raise
+        _LOG.debug('instance %s not terminated: %s', instance_id, err, extra={'env': config['env']})
+
+
+def _in_parallel(calls):
+    """ Run the no-arg callables on their own threads, returning their results in order.
+        Every call runs to the end, then the first exception (if any) is raised.
+    """
+    pool = ThreadPool(len(calls))
+    try:
+        results = [pool.apply_async(call) for call in calls]
+        for result in results:
+            result.wait()
+        return [result.get() for result in results]
+    finally:
+        pool.close()
+        pool.join()
+
+
+@_traced
+def _shift_traffic(config, state):
+    """ Move the traffic from the old to the new asg in _shift_batches steps, by putting the old
+        instances in standby a batch at a time: out of the elb, and out of the desired capacity so
+        the old asg does not replace them (as it would instances deregistered from its elb while
+        elb health checked). After each batch, wait for it to be out of the elb and check the new
+        instances are still InService with the extra load. The last batch is left for detach_old_asg.
+        The min size of the old asg is lowered to 0 for it, and kept in the state for _rollback.
+    """
+    d = {'env': config['env']}
+    old_asg_name = state['old_asg_name']
+    old_asg = _describe_asgs(config, [old_asg_name], fresh=True).get(old_asg_name)
+    old_instance_ids = sorted(ins['InstanceId'] for ins in old_asg['Instances']) if old_asg else []
+    if _shift_batches <= 1 or len(old_instance_ids) < 2:
+        return
+    standby_ids = set(ins['InstanceId'] for ins in old_asg['Instances'] if ins['LifecycleState'] == 'Standby')
+    _asg = _client(config, 'autoscaling')
+    if old_asg['MinSize'] > 0:
+        state['old_min_size'] = old_asg['MinSize']
+        _LOG.debug('lowering old asg %s min size from %s to 0', old_asg_name, old_asg['MinSize'], extra=d)
+        _asg.update_auto_scaling_group(
+            AutoScalingGroupName=old_asg_name,
+            MinSize=0
+        )
+    batch_size = int(math.ceil(len(old_instance_ids) / float(_shift_batches)))
+    for start in range(0, len(old_instance_ids) - batch_size, batch_size):
+        batch = old_instance_ids[start:start + batch_size]
+        to_standby = [instance_id for instance_id in batch if instance_id not in standby_ids] # eg: on a resume
+        if to_standby:
+            _LOG.debug('shifting traffic: entering standby for old instances %s', to_standby, extra=d)
+            _asg.enter_standby(
+                InstanceIds=to_standby,
+                AutoScalingGroupName=old_asg_name,
+                ShouldDecrementDesiredCapacity=True
+            )
+            _invalidate_asg(config, old_asg_name)
+
+        def _batch_out():
+            in_service = set(i['InstanceId'] for i in _get_elb_health(config, config['elb'], fresh=True)
+                             if i['State'] == 'InService')
+            return not in_service.intersection(batch)
+
+        _wait_until(config, 'ShiftBatchOutOfService', _batch_out, _elb_timeout)
+        _wait_for_elb(config, config['elb'], state['asg_name'], "InService")
+        _LOG.debug('shifted %s of %s old instances', start + len(batch), len(old_instance_ids), extra=d)
+
+
+def _wait_for_old_asg_outofservice(config, state):
+    _describe_asgs(config, [state['asg_name'], state['old_asg_name']]) # one call for both memberships
+    _wait_for_elb(config, config['elb'], state['old_asg_name'], "OutOfService")
+
+
+@_traced
 def _create_lc(config, launch_config_name):
     d = {'env': config['env']}
     _LOG.debug("creating launch config %s", launch_config_name, extra=d)
-    config['session'].client('autoscaling').create_launch_configuration(
-        LaunchConfigurationName=launch_config_name,
-        ImageId=config['image_id'],
-        InstanceType='m3.large',
-        SecurityGroups=[config['sg_group']],
-        IamInstanceProfile=config['iam'] 
-    )
+    try:
+        _client(config, 'autoscaling').create_launch_configuration(
+            LaunchConfigurationName=launch_config_name,
+            ImageId=config['image_id'],
+            InstanceType=config['instance_type'],
+            SecurityGroups=[config['sg_group']],
+            IamInstanceProfile=config['iam']
+        )
+    except ClientError as err:
+        _raise_unless_exists(err, config, launch_config_name)
     _LOG.debug('created launch config %s', launch_config_name, extra=d)
 
 
-def _create_asg(config, launch_config_name):
+@_traced
+def _create_asg(config, launch_config_name, old_asg_name=None):
     d = {'env': config['env']}
     """ Step 1: Create an Auto Scaling Group
         Step 2: Create Scaling Policies
@@ -235,6 +739,7 @@ def _create_asg(config, launch_config_name):
     Args:
         launch_config_name (string): the name of the LC which will contains the
             given AMI ID.
+        old_asg_name (string): the asg currently behind the elb, to size the new one after
     Returns:
         str: the newly created auto scaling group name
     Raises:
@@ -243,51 +748,57 @@ def _create_asg(config, launch_config_name):
     _LOG.debug("creating autoscalinggroup with config %s", launch_config_name, extra=d)
     asg_name = _DELIMITER.join((_asg_prefix, launch_config_name.replace(_lc_prefix + _DELIMITER, '')))
     user_name = asg_name.split(_DELIMITER)[2]
-    azs = [i['ZoneName'] for i in config['session'].client('ec2').describe_availability_zones()['AvailabilityZones']]
-    _asg = config['session'].client('autoscaling')
-    _asg.create_auto_scaling_group(
-        AutoScalingGroupName=asg_name,
-        LaunchConfigurationName=launch_config_name,
-        MinSize=2,
-        MaxSize=4,
-        DesiredCapacity=2,
-        DefaultCooldown=300,
-        AvailabilityZones=azs,
-        HealthCheckGracePeriod=600,
-        VPCZoneIdentifier=config['subnets'],
-        TerminationPolicies=["OldestLaunchConfiguration", "OldestInstance", "Default"],
-        NewInstancesProtectedFromScaleIn=True,
-        Tags=[
-            {
-                "ResourceType": "auto-scaling-group",
-                "ResourceId": asg_name,
-                "PropagateAtLaunch": True,
-                "Value": config['env'],
-                "Key": "Environment"
-            },
-            {
-                "ResourceType": "auto-scaling-group",
-                "ResourceId": asg_name,
-                "PropagateAtLaunch": True,
-                "Value": _prefix,
-                "Key": "role"
-            },
-            {
-                "ResourceType": "auto-scaling-group",
-                "ResourceId": asg_name,
-                "PropagateAtLaunch": True,
-                "Value": _DELIMITER.join((asg_name, config['env'])),
-                "Key": "Name"
-            },
-            {
-                "ResourceType": "auto-scaling-group",
-                "ResourceId": asg_name,
-                "PropagateAtLaunch": True,
-                "Value": user_name,
-                "Key": "owner"
-            }
-        ]
-    )
+    azs = _get_azs(config)
+    min_size, desired, max_size = _new_asg_capacity(config, old_asg_name)
+    _LOG.debug("sizing autoscalinggroup %s min %s desired %s max %s", asg_name, min_size, desired, max_size, extra=d)
+    _asg = _client(config, 'autoscaling')
+    try:
+        _asg.create_auto_scaling_group(
+            AutoScalingGroupName=asg_name,
+            LaunchConfigurationName=launch_config_name,
+            MinSize=min_size,
+            MaxSize=max_size,
+            DesiredCapacity=desired,
+            DefaultCooldown=300,
+            AvailabilityZones=azs,
+            HealthCheckGracePeriod=600,
+            VPCZoneIdentifier=config['subnets'],
+            TerminationPolicies=["OldestLaunchConfiguration", "OldestInstance", "Default"],
+            NewInstancesProtectedFromScaleIn=True,
+            Tags=[
+                {
+                    "ResourceType": "auto-scaling-group",
+                    "ResourceId": asg_name,
+                    "PropagateAtLaunch": True,
+                    "Value": config['env'],
+                    "Key": "Environment"
+                },
+                {
+                    "ResourceType": "auto-scaling-group",
+                    "ResourceId": asg_name,
+                    "PropagateAtLaunch": True,
+                    "Value": _prefix,
+                    "Key": "role"
+                },
+                {
+                    "ResourceType": "auto-scaling-group",
+                    "ResourceId": asg_name,
+                    "PropagateAtLaunch": True,
+                    "Value": _DELIMITER.join((asg_name, config['env'])),
+                    "Key": "Name"
+                },
+                {
+                    "ResourceType": "auto-scaling-group",
+                    "ResourceId": asg_name,
+                    "PropagateAtLaunch": True,
+                    "Value": user_name,
+                    "Key": "owner"
+                }
+            ]
+        )
+    except ClientError as err:
+        _raise_unless_exists(err, config, asg_name)
+    _invalidate_asg(config, asg_name)
 
     # Create Scaling Policies and CloudWatch Alarms for Scale Up
     scale_up_policy_arn = _asg.put_scaling_policy(
@@ -298,7 +809,7 @@ def _create_asg(config, launch_config_name):
         ScalingAdjustment=1,
         Cooldown=300
     )['PolicyARN']
-    _cw_c = config['session'].client('cloudwatch')
+    _cw_c = _client(config, 'cloudwatch')
     _cw_c.put_metric_alarm(
         AlarmName='awsec2-%s-CPU-Utilization' % asg_name,
         MetricName='CPUUtilization',
@@ -312,7 +823,7 @@ def _create_asg(config, launch_config_name):
         ],
         Period=300,
         EvaluationPeriods=1,
-        Threshold=50.0,
+        Threshold=config['scale_up_threshold'],
         ComparisonOperator='GreaterThanOrEqualToThreshold'
     )
 
@@ -338,13 +849,47 @@ def _create_asg(config, launch_config_name):
         ],
         Period=300,
         EvaluationPeriods=1,
-        Threshold=30.0,
+        Threshold=config['scale_down_threshold'],
         ComparisonOperator='LessThanOrEqualToThreshold'
     )
     _LOG.debug('created auto scaling group %s', asg_name, extra=d)
     return asg_name
 
 
+def _new_asg_capacity(config, old_asg_name):
+    """ Size of the new asg: the 'capacity' (min, desired, max) of the env, or with the 'match' _capacity_mode at least
+        the current size of the old asg, ie: where its scaling policies have taken it, plus
+        _surge. A fleet scaled up for the peak is not cut back to the default at cutover.
+
+    Returns:
+        int, int, int: min, desired, max size
+    """
+    d = {'env': config['env']}
+    min_size, desired, max_size = config['capacity']
+    if _capacity_mode != 'match' or not old_asg_name:
+        return min_size, desired, max_size
+    old = _describe_asgs(config, [old_asg_name], fresh=True).get(old_asg_name)
+    if old is None:
+        return min_size, desired, max_size
+    _LOG.debug('old asg %s min %s desired %s max %s, suspended: %s', old_asg_name, old['MinSize'],
+               old['DesiredCapacity'], old['MaxSize'], [p['ProcessName'] for p in old.get('SuspendedProcesses', [])],
+               extra=d)
+    desired = int(math.ceil(max(desired, old['DesiredCapacity']) * (1 + _surge)))
+    min_size = max(min_size, old['MinSize'])
+    max_size = max(max_size, old['MaxSize'], desired)
+    return min_size, desired, max_size
+
+
+def _raise_unless_exists(err, config, name):
+    """ Let AlreadyExists errors through, eg: the lc / asg was created by a run that died
+        before writing the journal.
+    """
+    if err.response['Error']['Code'] != 'AlreadyExists':
+        raise err
+    _LOG.debug('%s already exists', name, extra={'env': config['env']})
+
+
+@_traced
 def _remove_protection(config, asg_name):
     d = {'env': config['env']}
     """ Remove ScaleIn protection on instances. Should only called on those that's already healthy/inservice.
@@ -356,7 +901,7 @@ def _remove_protection(config, asg_name):
 
     instance_ids = _get_instance_ids(config, asg_name)
     _LOG.debug('removing ScaleIn protection from asg %s on instances %s', asg_name, instance_ids, extra=d)
-    config['session'].client('autoscaling').set_instance_protection(
+    _client(config, 'autoscaling').set_instance_protection(
         AutoScalingGroupName=asg_name,
         InstanceIds=instance_ids,
         ProtectedFromScaleIn=False
@@ -364,6 +909,7 @@ def _remove_protection(config, asg_name):
     _LOG.debug('removed ScaleIn protection from asg %s on instances %s', asg_name, instance_ids, extra=d)
 
 
+@_traced
 def _wait_for_instances_healthy(config, asg_name):
     d = {'env': config['env']}
     """ Use the instances waiter class to wait for instances to be healthy
@@ -375,29 +921,44 @@ def _wait_for_instances_healthy(config, asg_name):
     Raises:
         Caller to handle exception on failure.
     """
-    new_instance_ids = []
-    while len(new_instance_ids) == 0:
-        time.sleep(10)  # wait a little b4 querying for new instance ids
+    def _have_instances():
         _LOG.debug('getting IDs of new instances for %s ', asg_name, extra=d)
-        new_instance_ids = _get_instance_ids(config, asg_name)
-
-    # TODO may need to wait to ensure have ids
-    _ec2_c = config['session'].client('ec2')
-    _LOG.debug('waiting for instance_running for new instances %s', new_instance_ids, extra=d)
-    _ec2_c.get_waiter('instance_running').wait(InstanceIds=new_instance_ids)
-    _LOG.debug('waiting for system_status_ok for new instances %s', new_instance_ids, extra=d)
-    _ec2_c.get_waiter('system_status_ok').wait(InstanceIds=new_instance_ids)
+        return _get_instance_ids(config, asg_name, fresh=True)
+
+    new_instance_ids = _wait_until(config, 'ASGInstancesLaunched', _have_instances, _instances_timeout)
+
+    _ec2_c = _client(config, 'ec2')
+
+    def _running_and_ok():
+        statuses = _ec2_c.describe_instance_status(
+            InstanceIds=new_instance_ids,
+            IncludeAllInstances=True
+        )['InstanceStatuses']
+        for status in statuses:
+            if status['InstanceState']['Name'] in ('shutting-down', 'terminated', 'stopping', 'stopped'):
+                raise WaiterError(name='InstancesRunningAndOk', last_response=statuses,
+                    reason='instance %s is %s' % (status['InstanceId'], status['InstanceState']['Name']))
+        not_ready = [status['InstanceId'] for status in statuses
+                     if status['InstanceState']['Name'] != 'running' or status['SystemStatus']['Status'] != 'ok']
+        if not_ready or len(statuses) < len(new_instance_ids):
+            _LOG.debug('new instances %s not running with system_status_ok yet: %s', new_instance_ids, not_ready, extra=d)
+            return False
+        return True
+
+    _LOG.debug('waiting for running and system_status_ok for new instances %s', new_instance_ids, extra=d)
+    _wait_until(config, 'InstancesRunningAndOk', _running_and_ok, _instances_timeout)
     _LOG.debug('new instances %s  are ready.', new_instance_ids, extra=d)
     _wait_for_instances_inservice(config, asg_name)
 
 
+@_traced
 def _attach_elb_to_asg(config, asg_name):
     d = {'env': config['env']}
-    _LOG.debug('attaching elb %s to asg %s', _elb, asg_name, extra=d)
-    _asg = config['session'].client('autoscaling')
+    _LOG.debug('attaching elb %s to asg %s', config['elb'], asg_name, extra=d)
+    _asg = _client(config, 'autoscaling')
     _asg.attach_load_balancers(
         AutoScalingGroupName=asg_name,
-        LoadBalancerNames=[_elb]
+        LoadBalancerNames=[config['elb']]
     )
     _LOG.debug('updating asg %s healthcheck to elb ', asg_name, extra=d)
     _asg.update_auto_scaling_group(
@@ -405,9 +966,11 @@ def _attach_elb_to_asg(config, asg_name):
         HealthCheckType='ELB',
         HealthCheckGracePeriod=600
     )
-    _LOG.debug('autoscaling group %s attached with elb %s', asg_name, _elb, extra=d)
+    _state(config).invalidate(('elb_health', config['elb']))
+    _LOG.debug('autoscaling group %s attached with elb %s', asg_name, config['elb'], extra=d)
 
 
+@_traced
 def _find_old_asg_name(config, elb, new_asg_name):
     d = {'env': config['env']}
     """ 1. Get instances from elb (this included old and new instances)
@@ -416,15 +979,18 @@ def _find_old_asg_name(config, elb, new_asg_name):
 
     Args:
         elb (str): elb name
-        new_asg_name (str): the new autoscaling group name to be filtered out from tag values
+        new_asg_name (str): the new autoscaling group name to be filtered out from tag values,
+            None when the new asg is not created (attached) yet
     Returns:
         str: old asg name, or None when no old asg name was found
     """
-    all_instances = config['session'].client('elb').describe_instance_health(
-        LoadBalancerName=elb
-    )['InstanceStates']
+    all_instances = _get_elb_health(config, elb)
     all_instance_ids = [ins['InstanceId'] for ins in all_instances]
-    instance_tags = config['session'].client('ec2').describe_tags(
+    if not all_instance_ids:
+        # first deploy behind this elb. Not asking: a resource-id filter without values may match any asg
+        _LOG.debug('no instance in elb %s, no old asg', elb, extra=d)
+        return None
+    instance_tags = _client(config, 'ec2').describe_tags(
         Filters=[
             {
                 'Name': 'resource-id',
@@ -442,20 +1008,23 @@ def _find_old_asg_name(config, elb, new_asg_name):
     return next(iter(tag_values), None)
 
 
+@_traced
 def _detach_elb_from_old_asg(config, old_asg_name):
     d = {'env': config['env']}
-    _LOG.debug('detaching elb %s from old asg %s', _elb, old_asg_name, extra=d)
-    config['session'].client('autoscaling').detach_load_balancers(
+    _LOG.debug('detaching elb %s from old asg %s', config['elb'], old_asg_name, extra=d)
+    _client(config, 'autoscaling').detach_load_balancers(
         AutoScalingGroupName=old_asg_name,
-        LoadBalancerNames=[_elb]
+        LoadBalancerNames=[config['elb']]
     )
-    _LOG.debug('detached elb %s from old asg %s', _elb, old_asg_name, extra=d)
+    _state(config).invalidate(('elb_health', config['elb']))
+    _LOG.debug('detached elb %s from old asg %s', config['elb'], old_asg_name, extra=d)
 
 
+@_traced
 def _suspend_and_terminate_old_asg(config, old_asg_name):
     d = {'env': config['env']}
     _LOG.debug('suspending AlarmNotification on old asg %s', old_asg_name, extra=d)
-    _asg = config['session'].client('autoscaling')
+    _asg = _client(config, 'autoscaling')
     _asg.suspend_processes(
         AutoScalingGroupName=old_asg_name,
         ScalingProcesses=['AlarmNotification'],
@@ -469,6 +1038,7 @@ def _suspend_and_terminate_old_asg(config, old_asg_name):
         MaxSize=0,
         DesiredCapacity=0
     )
+    _invalidate_asg(config, old_asg_name)
     _remove_protection(config, old_asg_name)
     #_LOG.debug('entering standby for old asg %s instances %s', old_asg_name, old_instance_ids, extra=d)
     #_asg.enter_standby(
@@ -479,60 +1049,258 @@ def _suspend_and_terminate_old_asg(config, old_asg_name):
     return old_instance_ids
 
 
+@_traced
 def cleanup(env_key, old_asg_name): #TODO
     """ 1. enter stand by + decreased desired cap for old asg
-        2  short wait
-        3. terminate old instances and asg
-        4. ec2 waiter for instance termination
-        4. stop base instance
-        5. TODO: cleanup oldest asg, lc, ami, snapshots (limit 10?)
-            a. query to find oldest asg
-            b. get the launch config from the oldest asg
-            c. get the ami id from lc
-            d. get snapshotS from ami_id
-            e. delete asg
-            f. delete lc
-            g. deregister ami
-            h. delete snapshots
+        2. terminate old instances concurrently, waiting for them to be drained from the elb
+           and terminated, see _terminate
+        3. stop base instance
+        4. cleanup oldest asg, lc, ami, snapshots, keeping the newest _keep_deploys, see _collect_region_garbage.
+           A dry run unless _gc_on_cleanup
 
     """
     if old_asg_name:
         old_instance_ids = _suspend_and_terminate_old_asg(_config[env_key],old_asg_name)
-        time.sleep(60)  # TODO: better wait style: ELB registration takes time
-        #_terminate(_config[env_key], old_instance_ids, old_asg_name)
+        _terminate(_config[env_key], old_instance_ids, old_asg_name)
 
-    stop_instance(False)
+    if not _warm_standby:
+        stop_instance(False)
+    if _keep_deploys is not None:
+        _collect_region_garbage(_config[env_key], _keep_deploys, dry_run=not _gc_on_cleanup)
 
 
+@_traced
 def _terminate(config, old_instance_ids, old_asg_name):
     d = {'env': config['env']}
-    if old_asg_name:
+    """ Terminate the old instances all at once, then wait (a single wait for the whole
+        fleet) until every one of them is terminated and gone from the elb, ie: its
+        connections are drained. Each check is one describe_instances of every instance
+        plus one describe_instance_health of the elb, however large the group.
+    """
+    if old_asg_name and old_instance_ids:
         _LOG.debug("terminating old asg %s instances %s", old_asg_name, old_instance_ids, extra=d)
-        _asg = config['session'].client('autoscaling')
-        for instance_id in old_instance_ids:
-            _asg.terminate_instance_in_auto_scaling_group(
-                InstanceId=instance_id,
-                ShouldDecrementDesiredCapacity=True
-            )
-        time.sleep(10)
-        _ec2_c = config['session'].client('ec2')
-        for i in range(1, 11):
-            try:
-                _LOG.debug('going to wait for terminating instances %s to be successful. trying %s...', old_instance_ids, i, extra=d) 
-                _ec2_c.get_waiter('instance_terminated').wait(InstanceIds=old_instance_ids)
-                break
-            except WaiterError as e:
-                if i == 10: 
-                    raise e
-                continue
-
-
-def _get_instance_ids(config, asg_name):
+        _in_parallel([functools.partial(_terminate_instance, config, instance_id)
+                      for instance_id in old_instance_ids])
+        _invalidate_asg(config, old_asg_name)
+        _ec2_c = _client(config, 'ec2')
+        old_ids = set(old_instance_ids)
+
+        def _gone():
+            reservations = _ec2_c.describe_instances(InstanceIds=old_instance_ids)['Reservations']
+            running = [ins['InstanceId'] for r in reservations for ins in r['Instances']
+                       if ins['State']['Name'] != 'terminated']
+            draining = [i['InstanceId'] for i in _get_elb_health(config, config['elb'], fresh=True)
+                        if i['InstanceId'] in old_ids]
+            _LOG.debug('old instances not terminated: %s, draining from elb %s: %s', running, config['elb'], draining,
+                       extra=d)
+            return not running and not draining
+
+        _LOG.debug('going to wait for old instances %s to be terminated and drained', old_instance_ids, extra=d)
+        _wait_until(config, 'OldInstancesGone', _gone, _terminate_timeout)
+        _invalidate_asg(config, old_asg_name)
+
+
+def collect_garbage(keep=None, dry_run=True, max_concurrent_regions=None):
+    """ Delete all but the newest keep deploys (asg -> lc -> ami -> snapshots chains) in
+        every region at once, see _collect_region_garbage.
+
+    Args:
+        keep (int): deploys to keep per region, defaults to _keep_deploys
+        dry_run (boolean): only report what would be deleted
+        max_concurrent_regions (int): cap of regions collected at the same time
+    Returns:
+        dict: env key -> report of _collect_region_garbage
+    """
+    keep = _keep_deploys if keep is None else keep
+    keys = list(_config.keys())
+    pool = ThreadPool(min(len(keys), max_concurrent_regions or len(keys)))
+    try:
+        reports = pool.map(lambda key: _collect_region_garbage(_config[key], keep, dry_run), keys)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(keys, reports))
+
+
+@_traced
+def _collect_region_garbage(config, keep, dry_run):
+    """ Find the deploys of the region by the naming convention and delete all but the newest keep.
+
+        1. list (paginated) every asg, lc and ami (+ its snapshots) named after _prefix:
+            asg-<image_name>, lc-<image_name>, <image_name> = prefix-<user>-<timestamp>
+        2. a chain is everything sharing an image_name, ordered by its timestamp
+        3. chains beyond the newest keep are deleted (concurrently), each in order:
+            a. delete asg (and its alarms), wait for it to be gone
+            b. delete lc
+            c. deregister ami, unless a remaining lc still uses it (eg: reused by the ami cache)
+            d. delete snapshots of the ami
+        Chains whose asg still has instances or an elb are never deleted.
+
+    Returns:
+        dict: 'kept', 'deleted', 'skipped' (image names), and 'reclaimed_gib' of snapshots
+    """
+    d = {'env': config['env']}
+    chains = _find_deploy_chains(config)
+    names = sorted(chains.keys(), key=lambda name: name.rsplit(_DELIMITER, 1)[-1], reverse=True)
+    report = {'kept': names[:keep], 'deleted': [], 'skipped': [], 'reclaimed_gib': 0, 'dry_run': dry_run}
+    doomed = []
+    for name in names[keep:]:
+        asg = chains[name]['asg']
+        if asg and (asg['Instances'] or asg['LoadBalancerNames']):
+            _LOG.debug('not collecting %s, asg %s still in use', name, asg['AutoScalingGroupName'], extra=d)
+            report['skipped'].append(name)
+        else:
+            doomed.append(name)
+
+    # amis still used by a remaining launch config are kept
+    used_images = set()
+    for name, chain in chains.items():
+        if name not in doomed and chain['lc']:
+            used_images.add(chain['lc']['ImageId'])
+    for name in doomed:
+        chain = chains[name]
+        chain['images'] = [image for image in chain['images'] if image['ImageId'] not in used_images]
+        report['reclaimed_gib'] += sum(ebs['VolumeSize'] for image in chain['images'] for ebs in _image_ebs(image))
+        report['deleted'].append(name)
+
+    _LOG.debug('%s deploys: keeping %s, deleting %s, skipping %s', len(names), report['kept'], report['deleted'],
+               report['skipped'], extra=d)
+    if not dry_run and doomed:
+        pool = ThreadPool(min(len(doomed), _gc_workers))
+        try:
+            pool.map(lambda name: _delete_deploy_chain(config, chains[name]), doomed)
+        finally:
+            pool.close()
+            pool.join()
+    return report
+
+
+def _find_deploy_chains(config):
+    """ Returns: dict image_name -> {'asg': asg or None, 'lc': lc or None, 'images': [ami]} """
+    chains = {}
+
+    def _chain(image_name):
+        return chains.setdefault(image_name, {'asg': None, 'lc': None, 'images': []})
+
+    _asg = _client(config, 'autoscaling')
+    asg_prefix = _DELIMITER.join((_asg_prefix, _prefix, ''))
+    for page in _asg.get_paginator('describe_auto_scaling_groups').paginate():
+        for asg in page['AutoScalingGroups']:
+            if asg['AutoScalingGroupName'].startswith(asg_prefix):
+                _chain(asg['AutoScalingGroupName'][len(_asg_prefix + _DELIMITER):])['asg'] = asg
+    lc_prefix = _DELIMITER.join((_lc_prefix, _prefix, ''))
+    for page in _asg.get_paginator('describe_launch_configurations').paginate():
+        for lc in page['LaunchConfigurations']:
+            if lc['LaunchConfigurationName'].startswith(lc_prefix):
+                _chain(lc['LaunchConfigurationName'][len(_lc_prefix + _DELIMITER):])['lc'] = lc
+    pages = _client(config, 'ec2').get_paginator('describe_images').paginate(
+        Owners=['self'],
+        Filters=[{'Name': 'name', 'Values': [_DELIMITER.join((_prefix, '*'))]}]
+    )
+    for page in pages:
+        for image in page['Images']:
+            _chain(image['Name'])['images'].append(image)
+    return chains
+
+
+def _image_ebs(image):
+    return [bdm['Ebs'] for bdm in image.get('BlockDeviceMappings', []) if 'Ebs' in bdm and bdm['Ebs'].get('SnapshotId')]
+
+
+def _delete_deploy_chain(config, chain):
+    d = {'env': config['env']}
+    _asg = _client(config, 'autoscaling')
+    if chain['asg']:
+        asg_name = chain['asg']['AutoScalingGroupName']
+        _LOG.debug('deleting asg %s', asg_name, extra=d)
+        _asg.delete_auto_scaling_group(AutoScalingGroupName=asg_name)
+        _client(config, 'cloudwatch').delete_alarms(AlarmNames=[
+            'awsec2-%s-CPU-Utilization' % asg_name,
+            'awsec2-%s-High-CPU-Utilization-scaledown' % asg_name
+        ])
+        _invalidate_asg(config, asg_name)
+        _wait_until(config, 'ASGDeleted', lambda: not _describe_asgs(config, [asg_name], fresh=True),
+                    _asg_delete_timeout)
+    if chain['lc']:
+        _LOG.debug('deleting launch config %s', chain['lc']['LaunchConfigurationName'], extra=d)
+        _asg.delete_launch_configuration(LaunchConfigurationName=chain['lc']['LaunchConfigurationName'])
+    _ec2_c = _client(config, 'ec2')
+    for image in chain['images']:
+        _LOG.debug('deregistering ami %s', image['ImageId'], extra=d)
+        _ec2_c.deregister_image(ImageId=image['ImageId'])
+        for ebs in _image_ebs(image):
+            _LOG.debug('deleting snapshot %s', ebs['SnapshotId'], extra=d)
+            _ec2_c.delete_snapshot(SnapshotId=ebs['SnapshotId'])
+
+
+def _state(config):
+    """ The per-deploy state cache of the region, see _do_deploy. The AZs are kept across deploys. """
+    if 'cache' not in config:
+        config['cache'] = StateCache(_state_ttl)
+    return config['cache']
+
+
+def _client(config, service):
+    return _clients.client(config['session'], service)
+
+
+def _get_azs(config):
+    return _state(config).get(
+        ('azs',),
+        lambda: [i['ZoneName'] for i in _client(config, 'ec2').describe_availability_zones()['AvailabilityZones']],
+        _azs_ttl
+    )
+
+
+def _describe_asgs(config, asg_names, fresh=False):
+    """ Describe autoscaling groups, batching the ones not cached into a single call.
+
+    Args:
+        asg_names (list): autoscaling group names
+        fresh (boolean): to skip the cache and re-describe every given group
+    Returns:
+        dict: asg name -> autoscaling group description, groups that do not exist are left out
+    """
+    cache = _state(config)
+    groups = {}
+    missing = []
+    for asg_name in asg_names:
+        group = None if fresh else cache.get(('asg', asg_name))
+        if group is None:
+            missing.append(asg_name)
+        else:
+            groups[asg_name] = group
+    if missing:
+        paginator = _client(config, 'autoscaling').get_paginator('describe_auto_scaling_groups')
+        for page in paginator.paginate(AutoScalingGroupNames=missing):
+            for group in page['AutoScalingGroups']:
+                cache.put(('asg', group['AutoScalingGroupName']), group)
+                groups[group['AutoScalingGroupName']] = group
+    return groups
+
+
+def _invalidate_asg(config, asg_name):
+    """ To be called after anything that changes the size / membership of the group. """
+    _state(config).invalidate(('asg', asg_name))
+
+
+def _get_elb_health(config, elb_name, fresh=False):
+    """ Instance states of every instance registered with the elb. """
+    if fresh:
+        _state(config).invalidate(('elb_health', elb_name))
+    return _state(config).get(
+        ('elb_health', elb_name),
+        lambda: _client(config, 'elb').describe_instance_health(LoadBalancerName=elb_name)['InstanceStates']
+    )
+
+
+def _get_instance_ids(config, asg_name, fresh=False):
     d = {'env': config['env']}
     """ Helper method to return current instance ids on an autoscaling group
 
     Args:
         asg_name (str): autoscaling group name
+        fresh (boolean): to skip the cached membership, eg: when polling for changes
 
     Returns:
         list: List of instance ids (str) in the given autoscaling group,
@@ -540,14 +1308,13 @@ def _get_instance_ids(config, asg_name):
     """
 
     if asg_name:
-        ag = config['session'].client('autoscaling').describe_auto_scaling_groups(
-            AutoScalingGroupNames=[asg_name]
-        )
-        if len(ag['AutoScalingGroups']) > 0:
-            return [ins['InstanceId'] for ins in ag['AutoScalingGroups'][0]['Instances']]
+        ag = _describe_asgs(config, [asg_name], fresh).get(asg_name)
+        if ag:
+            return [ins['InstanceId'] for ins in ag['Instances']]
     return []
 
 
+@_traced
 def _wait_for_instances_inservice(config, asg_name):
     d = {'env': config['env']}
     """ LifecycleState: 'Pending'|'Pending:Wait'|'Pending:Proceed'|'Quarantined'|'InService'|'Terminating'|
@@ -555,33 +1322,25 @@ def _wait_for_instances_inservice(config, asg_name):
         HealthStatus: 'Healthy'|'Unhealthy'
     """
     new_instance_ids = _get_instance_ids(config, asg_name)
-    _asg = config['session'].client('autoscaling')
-    num_attempts = 0
-    while num_attempts < 40:
+    _asg = _client(config, 'autoscaling')
+
+    def _inservice():
         new_ins = _asg.describe_auto_scaling_instances(
             InstanceIds=new_instance_ids
         )['AutoScalingInstances']
-        healthy_count = 0
         for ins in new_ins:
             if (ins['HealthStatus'] != 'HEALTHY') or (ins['LifecycleState'] != 'InService'):
-                _LOG.debug('instance %s not healthy: (%s, %s).',  
+                _LOG.debug('instance %s not healthy: (%s, %s).',
                     ins['InstanceId'], ins['HealthStatus'], ins['LifecycleState'], extra=d)
-                break
-            else:
-                healthy_count += 1
-        if healthy_count == len(new_ins):
-            break
-        else:
-            num_attempts += 1
-            time.sleep(15)
-    else:
-        wait_too_long = 'Wait too long for %s asg %s to have healthy instances %s' % (config['env'], asg_name, new_instance_ids)
-        raise WaiterError(name='CustomASGInstancesHealthy', reason=wait_too_long)
+                return False
+        return True
 
+    _wait_until(config, 'CustomASGInstancesHealthy', _inservice, _instances_timeout)
     _LOG.debug('auto scaling group %s instances %s Healthy and InService', asg_name, new_instance_ids, extra=d)
 
 
-def _wait_for_elb(config, elb_name, asg_name, desired_state):
+@_traced
+def _wait_for_elb(config, elb_name, asg_name, desired_state, poll_delays=(None, None)):
     d = {'env': config['env']}
     """ Wait until the desired_state ("InService"|"OutOfService") of the instances of the asg in the elb is reached
 
@@ -589,6 +1348,7 @@ def _wait_for_elb(config, elb_name, asg_name, desired_state):
         elb_name (str): the elastic load balancer to check against
         asg_name (str): the auto scaling group to check against
         desired_state (str): the desired state of the instances to be in the elb
+        poll_delays (float, float): initial and max delay between checks, the poller defaults by default
 
     Raises:
         Exception when the given desired_state is neither "InService" nor "OutOfService"
@@ -599,9 +1359,19 @@ def _wait_for_elb(config, elb_name, asg_name, desired_state):
         raise Exception("desired_state can only be InService or OutOfService'")
 
     instance_ids_list = _get_instance_ids(config, asg_name)
-    _elb_c = config['session'].client('elb')
-    num_attempts = 0
-    while num_attempts < 40:
+    _elb_c = _client(config, 'elb')
+
+    def _in_desired_state():
+        if desired_state == "OutOfService":
+            # an instance deregistered and drained (eg: by _shift_traffic) is no longer in the elb,
+            # asking for it would fail with "InvalidInstance": list the registered ones instead
+            registered = dict((state['InstanceId'], state['State']) for state in
+                              _elb_c.describe_instance_health(LoadBalancerName=elb_name)['InstanceStates'])
+            in_service = [id for id in instance_ids_list if registered.get(id, "OutOfService") != "OutOfService"]
+            if in_service:
+                _LOG.debug('instances %s NOT OutOfService', in_service, extra=d)
+                return False
+            return True
         # Note: We will get "ClientError" with "InvalidInstance" error,
         # especially right b4 attaching for "InService".  #For now just catch and
         # log it, then retry. Not consiering it an error and will not raise back
@@ -611,26 +1381,20 @@ def _wait_for_elb(config, elb_name, asg_name, desired_state):
                 LoadBalancerName=elb_name,
                 Instances=[{'InstanceId': id} for id in instance_ids_list]
             )
-            desired_state_count = 0
-            for state in states['InstanceStates']:
-                if state['State'] != desired_state:
-                    _LOG.debug('instance %s NOT %s . Current state: %s', state['InstanceId'], desired_state, state['State'], extra=d)
-                    break
-                else:
-                    _LOG.debug('instance %s is %s', state['InstanceId'], state['State'], extra=d)
-                    desired_state_count += 1
-            if desired_state_count == len(instance_ids_list):
-                break
-            else:
-                _LOG.debug('instance %s from auto scaling group %s registered with elb %s NOT in %s yet. Tried %i time.', state['InstanceId'] , asg_name, elb_name, desired_state, num_attempts + 1 , extra=d) # don't wanna rely on logging to increment the actual counter, but then don't wanna display "Tried 0 time"
-                num_attempts += 1
-                time.sleep(15)
         except ClientError as err:
             _LOG.debug('checking instances %s with elb %s for %s failed on edge case. %s', instance_ids_list, elb_name, desired_state, err, extra=d)
-            time.sleep(15)
-    else:
-        wait_too_long = 'Wait too long for %s instances %s to be in %s in %s' % (config['env'], instance_ids_list, desired_state, elb_name)
-        raise WaiterError(name='CustomASGInstancesHealthy', reason=wait_too_long)
+            return False
+        desired_state_count = 0
+        for state in states['InstanceStates']:
+            if state['State'] != desired_state:
+                _LOG.debug('instance %s NOT %s . Current state: %s', state['InstanceId'], desired_state, state['State'], extra=d)
+                return False
+            _LOG.debug('instance %s is %s', state['InstanceId'], state['State'], extra=d)
+            desired_state_count += 1
+        return desired_state_count == len(instance_ids_list)
+
+    _wait_until(config, 'ELBInstances' + desired_state, _in_desired_state, _elb_timeout,
+                initial_delay=poll_delays[0], max_delay=poll_delays[1])
 
 
 
@@ -644,9 +1408,28 @@ if __name__ == '__main__':
     _LOG.propagate = False
     d = {'env': '-'} # To be overrided by methods that has specific env
 
-    start_instance()
-    response = deploy('local.test')
+    if len(sys.argv) > 1 and sys.argv[1] == 'gc':
+        # sample.py gc [keep] [--delete], a dry run unless --delete
+        reports = collect_garbage(int(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[2].isdigit() else None,
+                                  dry_run='--delete' not in sys.argv)
+        for key in sorted(reports.keys()):
+            _LOG.info('%s: %s', key, reports[key], extra=d)
+        sys.exit(0)
+
+    try:
+        if len(sys.argv) > 2 and sys.argv[1] == 'resume':
+            # sample.py resume ~/.blue_green_deploy/<image_name>.journal
+            response = resume(sys.argv[2])
+        else:
+            response = deploy(sys.argv[1] if len(sys.argv) > 1 else 'local.test')
+    except DeployError as e:
+        # still clean up the regions that went through
+        _LOG.error("deploy failed: %s", e, extra=d)
+        response = e.response
     _LOG.debug("testing, new asg should be deployed. If execute by api, email would be sent out. clean up next. Response: %s ", _DELIMITER, extra=d)
     for key in response.keys():
         cleanup(key, response[key][0])
-
+    _LOG.debug("clients: %s", _clients.stats(), extra=d)
+    trace_file = _trace_file % int(time.time())
+    _tracer.write(trace_file)
+    _LOG.info("trace written to %s\n%s", trace_file, _tracer.summary(), extra=d)
@@ -0,0 +1,175 @@
+""" Timing / API call instrumentation for the blue/green deploy.
+
+A Tracer records
+    - phases: named, timed sections of the deploy per env (nested phases are fine)
+    - waits: every poller wait with its number of checks, charged to the phase it ran in
+    - api calls: per region / service / operation, with retries, errors and throttles,
+      collected from botocore 'after-call' events of the instrumented clients
+and exports them as a Chrome trace (chrome://tracing, ui.perfetto.dev) JSON
+file, or as a plain text summary table.
+"""
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+_THROTTLE_CODES = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException')
+
+
+class _Phase(object):
+    __slots__ = ('env', 'name', 'start', 'end', 'tid', 'checks', 'error')
+
+    def __init__(self, env, name, tid):
+        self.env = env
+        self.name = name
+        self.tid = tid
+        self.start = time.time()
+        self.end = None
+        self.checks = 0
+        self.error = None
+
+
+class Tracer(object):
+
+    def __init__(self):
+        self.started = time.time()
+        self._phases = []
+        self._waits = []
+        self._api = {} # (region, service, operation) -> [calls, retries, errors, throttled attempts]
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def phase(self, env, name):
+        """ Time the enclosed block as phase name of env. """
+        p = _Phase(env, name, threading.current_thread().name)
+        stack = self._stack()
+        stack.append(p)
+        try:
+            yield p
+        except Exception as e:
+            p.error = '%s: %s' % (type(e).__name__, e)
+            raise
+        finally:
+            p.end = time.time()
+            stack.pop()
+            with self._lock:
+                self._phases.append(p)
+
+    def wait(self, env, name, attempts, start, end):
+        """ Record a poller wait, charging its checks to the current phase of this thread. """
+        stack = self._stack()
+        if stack:
+            stack[-1].checks += attempts
+        with self._lock:
+            self._waits.append((env, name, attempts, start, end, threading.current_thread().name))
+
+    def instrument(self, client):
+        """ Count every API call made through the (botocore) client, and every throttled attempt of them. """
+        region = client.meta.region_name
+
+        def _after_call(parsed, model, **kwargs):
+            self._count(region, model, parsed)
+
+        def _needs_retry(response=None, operation=None, **kwargs):
+            # once per attempt: throttles retried successfully never reach after-call as errors
+            if response is not None and response[1].get('Error', {}).get('Code') in _THROTTLE_CODES:
+                self._count_throttle(region, operation)
+        client.meta.events.register('after-call', _after_call)
+        client.meta.events.register('needs-retry', _needs_retry)
+
+    def _count(self, region, model, parsed):
+        key = (region, model.service_model.service_name, model.name)
+        metadata = parsed.get('ResponseMetadata', {})
+        code = parsed.get('Error', {}).get('Code')
+        with self._lock:
+            counts = self._api.setdefault(key, [0, 0, 0, 0])
+            counts[0] += 1
+            counts[1] += metadata.get('RetryAttempts', 0)
+            if code:
+                counts[2] += 1
+
+    def _count_throttle(self, region, model):
+        key = (region, model.service_model.service_name, model.name)
+        with self._lock:
+            self._api.setdefault(key, [0, 0, 0, 0])[3] += 1
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def waits(self):
+        """
+        Returns:
+            list: (env, name, checks, start, end) of every recorded wait
+        """
+        with self._lock:
+            return [w[:5] for w in self._waits]
+
+    def api_calls(self):
+        """
+        Returns:
+            dict: region -> service -> {'calls', 'retries', 'errors', 'throttled', 'operations': {name: calls}},
+                throttled counting the throttled attempts, retried successfully or not
+        """
+        result = {}
+        with self._lock:
+            for (region, service, operation), counts in self._api.items():
+                svc = result.setdefault(region, {}).setdefault(
+                    service, {'calls': 0, 'retries': 0, 'errors': 0, 'throttled': 0, 'operations': {}})
+                svc['calls'] += counts[0]
+                svc['retries'] += counts[1]
+                svc['errors'] += counts[2]
+                svc['throttled'] += counts[3]
+                svc['operations'][operation] = counts[0]
+        return result
+
+    def chrome_trace(self):
+        """ The recorded phases and waits as a Chrome trace event dict, one 'process' per env. """
+        events = []
+        pids = {}
+        tids = {}
+        with self._lock:
+            phases = list(self._phases)
+            waits = list(self._waits)
+        for p in phases:
+            args = {'checks': p.checks}
+            if p.error:
+                args['error'] = p.error
+            events.append(self._event(pids, tids, p.env, p.tid, p.name, p.start, p.end, 'phase', args))
+        for env, name, attempts, start, end, tid in waits:
+            events.append(self._event(pids, tids, env, tid, name, start, end, 'wait', {'checks': attempts}))
+        for env, pid in pids.items():
+            events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': env}})
+        for (pid, thread_name), tid in tids.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread_name}})
+        return {'traceEvents': events, 'otherData': {'api_calls': self.api_calls()}}
+
+    def _event(self, pids, tids, env, thread_name, name, start, end, cat, args):
+        pid = pids.setdefault(env, len(pids) + 1)
+        tid = tids.setdefault((pid, thread_name), len(tids) + 1)
+        return {'name': name, 'cat': cat, 'ph': 'X', 'pid': pid, 'tid': tid,
+                'ts': int((start - self.started) * 1e6), 'dur': int((end - start) * 1e6), 'args': args}
+
+    def write(self, path):
+        """ Write the chrome trace json to path. """
+        with open(path, 'w') as fh:
+            json.dump(self.chrome_trace(), fh, indent=1, sort_keys=True)
+
+    def summary(self):
+        """ Plain text table of the phases per env, followed by the API calls per region/service. """
+        with self._lock:
+            phases = sorted(self._phases, key=lambda p: (p.env, p.start))
+        lines = ['%-12s %-36s %10s %7s  %s' % ('env', 'phase', 'seconds', 'checks', 'status')]
+        for p in phases:
+            lines.append('%-12s %-36s %10.1f %7d  %s' % (p.env, p.name, p.end - p.start, p.checks, p.error or 'ok'))
+        lines.append('')
+        lines.append('%-16s %-12s %7s %8s %7s %10s' % ('region', 'service', 'calls', 'retries', 'errors', 'throttled'))
+        api = self.api_calls()
+        for region in sorted(api.keys()):
+            for service in sorted(api[region].keys()):
+                s = api[region][service]
+                lines.append('%-16s %-12s %7d %8d %7d %10d' % (
+                    region, service, s['calls'], s['retries'], s['errors'], s['throttled']))
+        return '\n'.join(lines)
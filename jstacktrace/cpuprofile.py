@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#
+# Sample the java threads using CPU: every --interval seconds, for --samples samples, a jstack -l <pid>
+# and the CPU time of every thread (from /proc/<pid>/task/<tid>/stat, see procstat.py). The CPU a
+# thread used since the previous sample is attributed to its stack in the jstack of that sample,
+# threads being joined by nid (the tid in hex). Prints the hottest threads and stacks, and optionally
+# writes the stacks collapsed for flamegraph.pl (one "thread;frame;...;top frame <cpu ms>" per line).
+# Usage: cpuprofile.py [--samples 10] [--interval 1] [--collapsed /tmp/java.collapsed] <pid>
+
+import argparse
+import subprocess
+import sys
+import time
+from collections import Counter
+
+import tdparse
+from procstat import CLOCK_TICKS, thread_cpu_ticks
+
+
+def jstack(pid, command='jstack'):
+    """ ThreadDump of pid """
+    output = subprocess.check_output([command, '-l', str(pid)])
+    return tdparse.parse(output.decode('utf-8', 'replace').splitlines(True))
+
+
+class Profile(object):
+    """ CPU of the threads and their stacks, accumulated over the samples.
+
+    Attributes:
+        samples (int), seconds (float): taken so far, and over how long
+        thread_cpu (Counter): (nid, name) -> CPU seconds
+        stack_cpu (Counter): (name, frames bottom first) -> CPU seconds
+    """
+
+    def __init__(self):
+        self.samples = 0
+        self.seconds = 0.0
+        self.thread_cpu = Counter()
+        self.stack_cpu = Counter()
+
+    def add(self, dump, ticks_before, ticks_after, seconds):
+        """ Attribute the CPU used by each thread between ticks_before and ticks_after to its stack in dump """
+        self.samples += 1
+        self.seconds += seconds
+        for tid, ticks in ticks_after.items():
+            used = float(ticks - ticks_before.get(tid, ticks)) / CLOCK_TICKS
+            thread = dump.by_nid.get('0x%x' % tid)
+            if used <= 0 or thread is None:
+                continue # idle, or not a thread of the dump (exited, started since)
+            self.thread_cpu[(thread.nid, thread.name)] += used
+            self.stack_cpu[(thread.name, tuple(reversed(thread.frames)))] += used
+
+    def hot_stacks(self, depth):
+        """ Counter of the top depth frames (top first) -> CPU seconds """
+        stacks = Counter()
+        for (_, frames), used in self.stack_cpu.items():
+            stacks[tuple(reversed(frames[-depth:]))] += used
+        return stacks
+
+    def write_collapsed(self, out):
+        for (name, frames), used in sorted(self.stack_cpu.items()):
+            # ; separates the frames, and a space the count
+            out.write('%s %d\n' % (';'.join(part.replace(';', ':').replace(' ', '_') for part in (name,) + frames),
+                                   round(used * 1000)))
+
+    def report(self, out, top, depth):
+        total = sum(self.thread_cpu.values())
+        out.write('%d samples over %.1fs, %.1f CPU seconds\n' % (self.samples, self.seconds, total))
+        out.write('\nhottest threads (% of one CPU):\n')
+        for (nid, name), used in self.thread_cpu.most_common(top):
+            out.write('%6.1f%% %s nid=%s\n' % (100 * used / max(self.seconds, 1e-6), name, nid))
+        out.write('\nhottest stacks (%% of the CPU used, top %d frames):\n' % depth)
+        for frames, used in self.hot_stacks(depth).most_common(top):
+            out.write('%6.1f%% %s\n' % (100 * used / max(total, 1e-6), '\n        '.join(frames) or '(no java frame)'))
+
+
+def profile(pid, samples, interval, command='jstack'):
+    """
+    Returns:
+        Profile
+    """
+    result = Profile()
+    ticks = thread_cpu_ticks(pid)
+    started = time.time()
+    for _ in range(samples):
+        time.sleep(interval)
+        dump = jstack(pid, command)
+        ticks_after = thread_cpu_ticks(pid)
+        now = time.time()
+        result.add(dump, ticks, ticks_after, now - started)
+        ticks, started = ticks_after, now
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Sampling CPU profile of the threads of a java process')
+    parser.add_argument('pid', type=int)
+    parser.add_argument('--samples', type=int, default=10, help='jstacks taken (default 10)')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between the samples (default 1)')
+    parser.add_argument('--top', type=int, default=10, help='threads and stacks reported (default 10)')
+    parser.add_argument('--depth', type=int, default=8, help='frames of the reported stacks (default 8)')
+    parser.add_argument('--collapsed', help='write the collapsed stacks to this file, for flamegraph.pl')
+    parser.add_argument('--jstack', default='/usr/bin/jstack')
+    args = parser.parse_args(argv)
+
+    result = profile(args.pid, args.samples, args.interval, args.jstack)
+    result.report(sys.stdout, args.top, args.depth)
+    if args.collapsed:
+        with open(args.collapsed, 'w') as out:
+            result.write_collapsed(out)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,68 +1,101 @@
 #!/usr/bin/env python
 #
-# Extract a partictual thread dump by nid from the jstack -l <pid> output. 
+# Extract particular thread dumps by nid from the jstack -l <pid> output.
+# Usage: extractTD.py cpu_1 lwpid_1 [cpu_2 lwpid_2 ...] timestamp < jstack.out
+#    or: extractTD.py --pid <pid> [--threshold 75] [--top 2]
+#        to find the threads using the most CPU (procstat.py) and take the jstack -l itself.
 # Output will be written to a file called /logs/[nid]-[timestamp].threaddump where [nid] is
-# is from the input variable 
+# the one of the 1st lwpid. The threads are found in a single pass over the dump, whatever
+# their order in it, and written as they are read, so the dump is never held in memory.
 
-import sys 
+import argparse
+import sys
 import os
 import os.path
 import re
+import subprocess
+import time
 
-def startOfTDLog(nid):
-    return re.compile('^"(?!C[1-2] CompilerThread).*nid='+nid+'.*')
+# header line of a thread, but the compiler threads: "name" ... nid=0x1a2b ...
+startOfTDLog = re.compile(r'^"(?!C[1-2] CompilerThread).*\bnid=(0x[0-9a-fA-F]+)\b')
+endOfTDLog = re.compile(r'^"')
 
-def findStartOfTDLog(cpu, nid, stream):
-    line = stream.readline()
-    while line:
-        if startOfTDLog(nid).match(line):
-            return cpu +"% -" + line
-        line = stream.readline()
-    return None
+def toNid(lwpid):
+    return '0x%x' % int(lwpid)
 
-def printToEndOfTDLog(stream, output):
-    line = stream.readline()
-    while line:
+def extractTDs(stream, cpuByNid, openOutput):
+    """ Write the thread dump of every nid in cpuByNid, prefixed by its cpu, from stream to
+        the file returned by openOutput() (only called when a thread is found).
+        Returns the nids found. """
+    found = set()
+    output = None
+    writing = False
+    for line in stream:
         if endOfTDLog.match(line):
-            return line
-        output.write(line)
-        line = stream.readline()
+            if writing and len(found) == len(cpuByNid):
+                break
+            header = startOfTDLog.match(line)
+            nid = header.group(1).lower() if header else None
+            writing = nid in cpuByNid and nid not in found
+            if writing:
+                found.add(nid)
+                if output is None:
+                    output = openOutput()
+                line = cpuByNid[nid] + "% -" + line
+        if writing:
+            output.write(line)
+    if output is not None:
+        output.close()
+    return found
 
-cpu_1=sys.argv[1]
-lwpid_1=sys.argv[2]
-cpu_2=sys.argv[3]
-lwpid_2=sys.argv[4]
-timestamp=sys.argv[5]
+def writeTDs(cpuByNid, firstNid, timestamp, stream):
+    """ Extract to /logs, print the file name when a thread was found (see main) """
+    logName = firstNid + "-" + timestamp + ".threaddump"
+    logFilename = "/logs/" + logName
+    extractTDs(stream, cpuByNid, lambda: open(logFilename, "w"))
 
-nid=hex(int(lwpid_1))
-nid2=hex(int(lwpid_2))
+    # terrible hack to just print the filename as the output result so we can wrap it as an execution cmd and set the filename variable for the caller
+    if os.path.isfile(logFilename):
+        print(logName)
 
-endOfTDLog = re.compile('^".*')
-blankLine = re.compile('^$')
+def mainPid(argv):
+    # only needed here, the lwpid mode works with this file alone
+    from procstat import top_threads
 
-logFilename = "/logs/"+nid+"-"+timestamp+".threaddump"
-# write the 1st thread
-line = findStartOfTDLog(cpu_1, nid, sys.stdin)
-while line:
-#    print "Writing to ", logFilename
-    output = open(logFilename, "w")
-    output.write(line)
-    line = printToEndOfTDLog(sys.stdin, output)
-    output.close()
-    break
-# append the 2nd thread
-line =  findStartOfTDLog(cpu_2, nid2, sys.stdin)
-while line:
-#    print "Writing to ", logFilename
-    output = open(logFilename, "a")
-    output.write(line)
-    line = printToEndOfTDLog(sys.stdin, output)
-    output.close()
-    break
+    parser = argparse.ArgumentParser(description='Extract the thread dumps of the threads of pid using the most CPU')
+    parser.add_argument('--pid', type=int, required=True)
+    parser.add_argument('--threshold', type=float, default=75,
+                        help='%%CPU of the top thread under which nothing is done (default 75)')
+    parser.add_argument('--top', type=int, default=2, help='threads extracted (default 2)')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds the CPU is measured over (default 1)')
+    parser.add_argument('--jstack', default='/usr/bin/jstack')
+    args = parser.parse_args(argv[1:])
 
-#    if not ( line and startOfTDLog.match(line)):
-#        line = findStartOfTDLog(sys.stdin)
+    threads = top_threads(args.pid, args.top, args.interval)
+    # if cpu from the top thread is lower than the threshold, then don't do anything
+    if not threads or threads[0][0] < args.threshold:
+        return 0
+    timestamp = str(int(time.time()))
+    # the full thread dumps is kept such that we could use sumologic later
+    tdOut = "/tmp/%s-%s.threaddump" % (args.pid, timestamp)
+    with open(tdOut, "w") as output:
+        subprocess.check_call([args.jstack, "-l", str(args.pid)], stdout=output)
+    with open(tdOut) as stream:
+        writeTDs(dict((toNid(tid), "%.1f" % cpu) for cpu, tid in threads), toNid(threads[0][1]), timestamp, stream)
+    return 0
 
-# terrible hack to just print the filename as the output result so we can wrap it as an execution cmd and set the filename variable for the caller
-if os.path.isfile(logFilename):
-    print nid+"-"+timestamp+".threaddump"
+def main(argv):
+    if len(argv) > 1 and argv[1].startswith('--pid'):
+        return mainPid(argv)
+    if len(argv) < 4 or len(argv) % 2:
+        sys.stderr.write("usage: extractTD.py cpu_1 lwpid_1 [cpu_2 lwpid_2 ...] timestamp < jstack.out\n")
+        return 1
+    pairs = argv[1:-1]
+    timestamp = argv[-1]
+    cpuByNid = dict((toNid(pairs[i + 1]), pairs[i]) for i in range(0, len(pairs), 2))
+
+    writeTDs(cpuByNid, toNid(pairs[1]), timestamp, sys.stdin)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
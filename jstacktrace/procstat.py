@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#
+# CPU of the threads of a process, read from /proc/<pid>/task/<tid>/stat (utime + stime) instead of
+# parsing top: no dependency on the top version / columns, and a few reads per thread.
+# Prints the top K threads, "%CPU lwpid" per line as getCPULwpid used to.
+# Usage: procstat.py [-k 5] [--interval 1] <pid>
+
+import argparse
+import heapq
+import os
+import sys
+import time
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def thread_cpu_ticks(pid):
+    """ tid -> utime + stime (clock ticks) of every thread of pid """
+    ticks = {}
+    task_dir = '/proc/%s/task' % pid
+    for tid in os.listdir(task_dir):
+        try:
+            with open('%s/%s/stat' % (task_dir, tid)) as fh:
+                stat = fh.read()
+        except IOError:
+            continue # exited since the listing
+        # the name (2nd field) is in parentheses and may contain anything
+        fields = stat[stat.rindex(')') + 2:].split()
+        ticks[int(tid)] = int(fields[11]) + int(fields[12])
+    return ticks
+
+
+def thread_cpu(pid, interval=1.0):
+    """ tid -> % of one CPU used over interval seconds (measured), of the threads alive at both reads """
+    before = thread_cpu_ticks(pid)
+    started = time.time()
+    time.sleep(interval)
+    after = thread_cpu_ticks(pid)
+    seconds = max(time.time() - started, 1e-6)
+    return dict((tid, 100.0 * (ticks - before[tid]) / CLOCK_TICKS / seconds)
+                for tid, ticks in after.items() if tid in before)
+
+
+def top_threads(pid, k=5, interval=1.0, exclude_main=True):
+    """ The k threads using the most CPU over interval seconds, the main thread (tid == pid) excluded by default.
+
+    Returns:
+        list: (% of one CPU, tid), highest first
+    """
+    cpu = thread_cpu(pid, interval)
+    if exclude_main:
+        cpu.pop(int(pid), None)
+    return heapq.nlargest(k, ((percent, tid) for tid, percent in cpu.items()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Threads of a process using the most CPU, from /proc')
+    parser.add_argument('pid', type=int)
+    parser.add_argument('-k', type=int, default=5, help='threads listed (default 5)')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds the CPU is measured over (default 1)')
+    args = parser.parse_args(argv)
+    for percent, tid in top_threads(args.pid, args.k, args.interval):
+        print('%.1f %d' % (percent, tid))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+#
+# Compare successive thread dumps of one process (eg: the /tmp/<pid>-<timestamp>.threaddump of several
+# stacktrace.sh runs), threads being matched by nid:
+#  - stuck threads: RUNNABLE or BLOCKED on the same top frames in every dump they are in
+#  - deadlocks: cycles of the wait-for graph of each dump (thread -> owner of the lock it is blocked on)
+#  - contended locks: ranked by the threads blocked on them, over all the dumps: monitor entries, and parks
+#    on the synchronizers held by a thread of the dump. The threads parked on a condition (eg: idle pool
+#    workers in LinkedBlockingQueue.take) are listed apart, as idle waiters.
+# Usage: tddiff.py [--depth 5] [--top 10] dump_1 dump_2 [dump_3 ...]
+
+import argparse
+import sys
+from collections import Counter
+
+import tdparse
+
+STUCK_STATES = ('RUNNABLE', 'BLOCKED')
+
+
+def load(paths):
+    """ ThreadDump of every file, in the order given """
+    dumps = []
+    for path in paths:
+        with open(path) as stream:
+            dumps.append(tdparse.parse(stream))
+    return dumps
+
+
+def wait_for_graph(dump):
+    """ nid -> nid of the owner of the lock the thread is blocked on, for the threads blocked on an owned lock """
+    graph = {}
+    for address, waiters in dump.waiters.items():
+        owner = dump.owner_of(address)
+        if owner is None:
+            continue
+        for thread in waiters:
+            if thread is not owner: # reentrant
+                graph[thread.nid] = owner.nid
+    return graph
+
+
+def find_deadlocks(graph):
+    """ Cycles of a wait-for graph (a thread waits for a single lock, so for a single owner).
+
+    Returns:
+        list: of cycles, lists of nids in wait-for order
+    """
+    cycles = []
+    done = set()
+    for start in graph:
+        path = []
+        on_path = {}
+        nid = start
+        while nid in graph and nid not in done and nid not in on_path:
+            on_path[nid] = len(path)
+            path.append(nid)
+            nid = graph[nid]
+        if nid in on_path:
+            cycles.append(path[on_path[nid]:])
+        done.update(path)
+    return cycles
+
+
+def stuck_threads(dumps, depth=5, states=STUCK_STATES):
+    """ Threads in the same state with the same top depth frames in every dump they are in, 2 dumps at least.
+
+    Returns:
+        list: (nid, ThreadInfo of the last dump, number of dumps), most dumps first
+    """
+    seen = {} # nid -> ((state, frames), ThreadInfo of the last dump, dumps), None once it changed
+    for dump in dumps:
+        for thread in dump.threads:
+            if thread.nid is None:
+                continue
+            key = (thread.state, tuple(thread.frames[:depth]))
+            if thread.nid not in seen:
+                seen[thread.nid] = (key, thread, 1)
+            elif seen[thread.nid] is not None:
+                if seen[thread.nid][0] == key:
+                    seen[thread.nid] = (key, thread, seen[thread.nid][2] + 1)
+                else:
+                    seen[thread.nid] = None
+    stuck = []
+    for nid, value in seen.items():
+        if value is None:
+            continue
+        (state, frames), thread, count = value
+        if count > 1 and state in states and frames:
+            stuck.append((nid, thread, count))
+    return sorted(stuck, key=lambda s: (-s[2], s[1].name))
+
+
+def contended_locks(dumps):
+    """ Locks threads are blocked on, over all the dumps: the monitors, and the synchronizers held by a
+        thread of the dump (a park on one that is not, eg: a CountDownLatch, is not contention).
+
+    Returns:
+        list: (address, class name, threads blocked summed over the dumps, dumps contended in, Counter of
+            the owners names), most blocked first
+    """
+    blocked = Counter()
+    contended = Counter()
+    classes = {}
+    owners = {}
+    for dump in dumps:
+        for address, waiters in dump.waiters.items():
+            owner = dump.owner_of(address)
+            waiters = [thread for thread in waiters if thread.waiting_to_lock or owner is not None]
+            if not waiters:
+                continue
+            blocked[address] += len(waiters)
+            contended[address] += 1
+            classes[address] = dump.lock_classes.get(address)
+            owners.setdefault(address, Counter())[owner.name if owner else None] += 1
+    return [(address, classes[address], count, contended[address], owners[address])
+            for address, count in blocked.most_common()]
+
+
+def idle_waiters(dumps):
+    """ Conditions threads are parked on, over all the dumps.
+
+    Returns:
+        list: (address, class name, threads parked summed over the dumps, dumps parked in), most parked first
+    """
+    parked = Counter()
+    dumps_in = Counter()
+    classes = {}
+    for dump in dumps:
+        for address, threads in dump.idle.items():
+            parked[address] += len(threads)
+            dumps_in[address] += 1
+            classes[address] = dump.lock_classes.get(address)
+    return [(address, classes[address], count, dumps_in[address]) for address, count in parked.most_common()]
+
+
+def report(paths, dumps, out, depth=5, top=10):
+    for path, dump in zip(paths, dumps):
+        out.write('%s: %s, %d threads (%s)\n' % (path, dump.timestamp, len(dump), ', '.join(
+            '%s %d' % (state, len(dump.by_state[state])) for state in sorted(dump.by_state, key=str))))
+
+    out.write('\ndeadlocks:\n')
+    found = False
+    for path, dump in zip(paths, dumps):
+        for cycle in find_deadlocks(wait_for_graph(dump)):
+            found = True
+            out.write('  %s:\n' % path)
+            for nid in cycle:
+                thread = dump.by_nid[nid]
+                out.write('    "%s" nid=%s blocked on %s (a %s) at %s\n' % (
+                    thread.name, nid, thread.blocked_on, dump.lock_classes.get(thread.blocked_on), thread.top_frame))
+    if not found:
+        out.write('  none\n')
+
+    out.write('\nstuck threads (same state and top %d frames in every dump they are in):\n' % depth)
+    stuck = stuck_threads(dumps, depth)
+    for nid, thread, count in stuck[:top]:
+        out.write('  %d/%d dumps "%s" nid=%s %s\n' % (count, len(dumps), thread.name, nid, thread.state))
+        for frame in thread.frames[:depth]:
+            out.write('        %s\n' % frame)
+    if len(stuck) > top:
+        out.write('  ... %d more\n' % (len(stuck) - top))
+
+    out.write('\ncontended locks:\n')
+    for address, class_name, count, dumps_count, owners in contended_locks(dumps)[:top]:
+        out.write('  %5d blocked in %d/%d dumps on %s (a %s), held by %s\n' % (
+            count, dumps_count, len(dumps), address, class_name,
+            ', '.join('%s (%d)' % (name or 'no thread of the dump', n) for name, n in owners.most_common())))
+
+    out.write('\nidle waiters (parked on a condition):\n')
+    for address, class_name, count, dumps_count in idle_waiters(dumps)[:top]:
+        out.write('  %5d parked in %d/%d dumps on %s (a %s)\n' % (count, dumps_count, len(dumps), address, class_name))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stuck threads, deadlocks and contended locks of successive dumps')
+    parser.add_argument('paths', nargs='+', metavar='DUMP', help='jstack -l outputs, oldest first')
+    parser.add_argument('--depth', type=int, default=5, help='top frames compared (default 5)')
+    parser.add_argument('--top', type=int, default=10, help='stuck threads and locks listed (default 10)')
+    args = parser.parse_args(argv)
+    report(args.paths, load(args.paths), sys.stdout, args.depth, args.top)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
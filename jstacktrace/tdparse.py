@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+#
+# Parse a jstack -l <pid> output into thread records, indexed by nid, state, top frame and lock,
+# so questions like "which threads wait for the lock 0x...", "top frames of the RUNNABLE threads"
+# are answered without scanning the dump again.
+# Usage: tdparse.py [--state RUNNABLE] [--lock 0x00000000c0000001] [--top 10] < jstack.out
+
+import argparse
+import re
+import sys
+from collections import Counter
+
+# "name" #12 daemon prio=5 os_prio=0 tid=0x00007f0000001000 nid=0x1a2b waiting on condition [0x00007f0000000000]
+_HEADER = re.compile(r'^"(.*)" (.*)$')
+_HEADER_FIELD = re.compile(r'(?<!\w)(#|prio=|tid=|nid=)(0x[0-9a-fA-F]+|\d+)')
+_STATUS = re.compile(r'nid=0x[0-9a-fA-F]+ ([^\[]*)')
+_STATE = '   java.lang.Thread.State: '
+_LOCK = re.compile(r'^\t- (locked|waiting to lock|waiting on|parking to wait for|eliminated) +<(0x[0-9a-fA-F]+)> \(a (.*)\)')
+_OWNABLE = re.compile(r'^\t- <(0x[0-9a-fA-F]+)> \(a (.*)\)')
+_TIMESTAMP = re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$')
+
+
+class ThreadInfo(object):
+    """ One thread of a dump. Locks are (address, class name) tuples.
+
+    Attributes:
+        name (str), number (int): the java thread number, None for the VM threads
+        daemon (bool), priority (int)
+        tid (str), nid (str): eg: 0x1a2b, the native thread id (lwpid of top / ps) in hex
+        status (str): as in the header, eg: waiting for monitor entry
+        state (str): eg: BLOCKED, None for the VM threads
+        frames (list): eg: java.lang.Object.wait(Native Method), top first
+        locked (list): monitors held
+        waiting_to_lock (tuple): the monitor it is blocked on
+        waiting_on (tuple): the monitor of its Object.wait()
+        parking_for (tuple): the synchronizer it is parked on, eg: a ReentrantLock$NonfairSync
+        ownable (list): ownable synchronizers held, eg: write locks
+    """
+    __slots__ = ('name', 'number', 'daemon', 'priority', 'tid', 'nid', 'status', 'state', 'frames', 'locked',
+                 'waiting_to_lock', 'waiting_on', 'parking_for', 'ownable')
+
+    def __init__(self, name, number=None, daemon=False, priority=None, tid=None, nid=None, status=''):
+        self.name = name
+        self.number = number
+        self.daemon = daemon
+        self.priority = priority
+        self.tid = tid
+        self.nid = nid
+        self.status = status
+        self.state = None
+        self.frames = []
+        self.locked = []
+        self.waiting_to_lock = None
+        self.waiting_on = None
+        self.parking_for = None
+        self.ownable = []
+
+    @property
+    def top_frame(self):
+        return self.frames[0] if self.frames else None
+
+    @property
+    def blocked_on(self):
+        """ Address of the lock it cannot go on without: monitor or synchronizer, None if none """
+        lock = self.waiting_to_lock or (None if self.idle_on else self.parking_for)
+        return lock[0] if lock else None
+
+    @property
+    def idle_on(self):
+        """ Address of the condition it is parked on, eg: by the LinkedBlockingQueue.take() of an idle pool
+            worker, None if none. It waits for a signal, not for a lock. """
+        if self.parking_for and self.parking_for[1].endswith('$ConditionObject'):
+            return self.parking_for[0]
+        return None
+
+    @property
+    def holds(self):
+        """ Addresses of the monitors and synchronizers it holds """
+        # the monitor of an Object.wait() is listed as locked, but released while waiting
+        waiting_on = self.waiting_on[0] if self.waiting_on else None
+        return [address for address, _ in self.locked if address != waiting_on] + [a for a, _ in self.ownable]
+
+    def __repr__(self):
+        return '<ThreadInfo "%s" nid=%s %s>' % (self.name, self.nid, self.state)
+
+
+class ThreadDump(object):
+    """ The threads of a dump and their indexes.
+
+    Attributes:
+        timestamp (str): as printed by jstack, None if missing
+        threads (list): ThreadInfo, in the dump order
+        by_nid (dict): nid -> ThreadInfo
+        by_state (dict): state -> [ThreadInfo]
+        by_top_frame (dict): top frame -> [ThreadInfo]
+        waiters (dict): lock address -> [ThreadInfo] blocked on it (monitor entry or park)
+        idle (dict): condition address -> [ThreadInfo] parked on it
+        owners (dict): lock address -> ThreadInfo holding it
+        lock_classes (dict): lock address -> class name
+    """
+    __slots__ = ('timestamp', 'threads', 'by_nid', 'by_state', 'by_top_frame', 'waiters', 'idle', 'owners',
+                 'lock_classes')
+
+    def __init__(self, timestamp=None):
+        self.timestamp = timestamp
+        self.threads = []
+        self.by_nid = {}
+        self.by_state = {}
+        self.by_top_frame = {}
+        self.waiters = {}
+        self.idle = {}
+        self.owners = {}
+        self.lock_classes = {}
+
+    def add(self, thread):
+        self.threads.append(thread)
+        if thread.nid is not None:
+            self.by_nid[thread.nid] = thread
+        self.by_state.setdefault(thread.state, []).append(thread)
+        self.by_top_frame.setdefault(thread.top_frame, []).append(thread)
+        for address, class_name in thread.locked + thread.ownable + [
+                lock for lock in (thread.waiting_to_lock, thread.waiting_on, thread.parking_for) if lock]:
+            self.lock_classes[address] = class_name
+        if thread.blocked_on is not None:
+            self.waiters.setdefault(thread.blocked_on, []).append(thread)
+        elif thread.idle_on is not None:
+            self.idle.setdefault(thread.idle_on, []).append(thread)
+        for address in thread.holds:
+            self.owners[address] = thread
+
+    def blocked_on(self, address):
+        """ Threads blocked on the lock at address """
+        return self.waiters.get(address, [])
+
+    def owner_of(self, address):
+        """ Thread holding the lock at address, None if unknown (not held, or by a VM thread) """
+        return self.owners.get(address)
+
+    def top_frames(self, state=None):
+        """ Counter of the top frames, of the threads in state or of all of them """
+        threads = self.threads if state is None else self.by_state.get(state, [])
+        return Counter(thread.top_frame for thread in threads if thread.top_frame)
+
+    def __len__(self):
+        return len(self.threads)
+
+
+def parse_header(line):
+    """ Thread header line -> ThreadInfo, None if it is not one """
+    match = _HEADER.match(line.rstrip('\n'))
+    if not match:
+        return None
+    name, rest = match.groups()
+    fields = dict(_HEADER_FIELD.findall(rest))
+    status = _STATUS.search(rest)
+    return ThreadInfo(name, number=int(fields['#']) if '#' in fields else None, daemon=' daemon ' in ' ' + rest,
+                      priority=int(fields['prio=']) if 'prio=' in fields else None, tid=fields.get('tid='),
+                      nid=fields.get('nid=', '').lower() or None, status=status.group(1).strip() if status else '')
+
+
+def parse(stream):
+    """ Parse the jstack output read from stream (any iterable of lines), in a single pass.
+
+    Returns:
+        ThreadDump
+    """
+    dump = None
+    thread = None
+    in_ownable = False
+    for line in stream:
+        if dump is None:
+            dump = ThreadDump(line.strip() if _TIMESTAMP.match(line.strip()) else None)
+        if line.startswith('"'):
+            if thread is not None:
+                dump.add(thread)
+            thread = parse_header(line)
+            in_ownable = False
+        elif thread is None:
+            continue
+        elif line.startswith('\tat '):
+            thread.frames.append(line[4:].rstrip())
+        elif line.startswith('\t- '):
+            lock = _LOCK.match(line)
+            if lock:
+                kind, address, class_name = lock.groups()
+                if kind == 'locked':
+                    thread.locked.append((address, class_name))
+                elif kind == 'waiting to lock':
+                    thread.waiting_to_lock = (address, class_name)
+                elif kind == 'waiting on':
+                    thread.waiting_on = (address, class_name)
+                elif kind == 'parking to wait for':
+                    thread.parking_for = (address, class_name)
+            elif in_ownable:
+                ownable = _OWNABLE.match(line)
+                if ownable:
+                    thread.ownable.append(ownable.groups())
+        elif line.startswith(_STATE):
+            thread.state = line[len(_STATE):].split()[0]
+        elif line.startswith('   Locked ownable synchronizers:'):
+            in_ownable = True
+        elif line.strip() and not line.startswith(('\t', ' ')):
+            # past the threads, eg: JNI global references, the deadlock report
+            dump.add(thread)
+            thread = None
+    if dump is None:
+        dump = ThreadDump()
+    if thread is not None:
+        dump.add(thread)
+    return dump
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Summary of a jstack -l output read from stdin')
+    parser.add_argument('--state', help='only the threads in this state, eg: RUNNABLE')
+    parser.add_argument('--lock', help='the owner and the threads blocked on this lock address')
+    parser.add_argument('--top', type=int, default=10, help='top frames listed (default 10)')
+    args = parser.parse_args(argv)
+    dump = parse(sys.stdin)
+
+    print('%d threads: %s' % (len(dump), ', '.join('%s %d' % (state, len(threads))
+                                                    for state, threads in sorted(dump.by_state.items(), key=str))))
+    if args.lock:
+        owner = dump.owner_of(args.lock.lower())
+        print('%s (a %s) held by %s' % (args.lock, dump.lock_classes.get(args.lock.lower()), owner))
+        for thread in dump.blocked_on(args.lock.lower()):
+            print('  blocked: %r at %s' % (thread, thread.top_frame))
+    for frame, count in dump.top_frames(args.state).most_common(args.top):
+        print('%6d %s' % (count, frame))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
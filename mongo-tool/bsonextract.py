@@ -0,0 +1,279 @@
+#! /usr/bin/env python
+""" Extract the documents matching a simple filter from a mongodump .bson file,
+without a mongorestore of the whole collection.
+
+The file is memory-mapped and walked document by document using their int32
+length prefixes. The filter is evaluated on the raw bytes of each document:
+a document without any value of the filter is skipped with a single
+substring search, the others have only their top level elements scanned. No
+document is decoded, memory use does not depend on the file size.
+
+Supported filters: top level fields, each equal to a value, or {"$in": [values]},
+values being strings, numbers, booleans, null or ObjectId("...") / {"$oid": "..."},
+with the mongo semantics for arrays (any item) and null (also a missing field):
+    {"customer_id": ObjectId("5669b9d6e4b0a2f44a2a3b1c"), "status": {"$in": ["open", "paid"]}}
+
+Matches are written as a .bson file (--out, restorable with mongorestore), as
+JSON lines (--jsonl) or inserted in batches into a collection (--host, --db,
+--collection). The last two need pymongo.
+
+    bsonextract.py dump/db_prod/orders.bson --filter '{"customer": "c42"}' --out orders.bson
+"""
+import argparse
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import time
+
+try:
+    import bson
+    import pymongo
+    from bson.json_util import dumps as bson_dumps
+    from bson.raw_bson import RawBSONDocument
+except ImportError:
+    pymongo = None
+
+# top level element value sizes, by bson type
+_FIXED_SIZES = {0x01: 8, 0x06: 0, 0x07: 12, 0x08: 1, 0x09: 8, 0x0A: 0, 0x10: 4, 0x11: 8, 0x12: 8, 0x13: 16,
+                0xFF: 0, 0x7F: 0}
+_STRING_TYPES = (0x02, 0x0D, 0x0E) # int32 length (with the trailing NUL) then bytes
+_EMBEDDED_TYPES = (0x03, 0x04, 0x0F) # int32 length of the whole value
+_OBJECT_ID = re.compile(r'ObjectId\(\s*"([0-9a-fA-F]{24})"\s*\)')
+
+
+def parse_filter(text):
+    """ JSON filter (ObjectId("...") allowed, as in the mongo shell) -> dict """
+    return json.loads(_OBJECT_ID.sub(r'{"$oid": "\1"}', text or '{}'))
+
+
+def _encode_value(value):
+    """ Every (bson type, raw bytes) a document value equal to value may be stored as """
+    if isinstance(value, dict) and list(value.keys()) == ['$oid']:
+        oid = value['$oid']
+        if not re.match(r'^[0-9a-fA-F]{24}$', oid):
+            raise ValueError('invalid ObjectId %s' % oid)
+        return [(0x07, bytearray.fromhex(oid))]
+    if value is None:
+        return [(0x0A, b'')]
+    if isinstance(value, bool):
+        return [(0x08, b'\x01' if value else b'\x00')]
+    if isinstance(value, (int, float)) or type(value).__name__ == 'long':
+        candidates = [(0x01, struct.pack('<d', value))]
+        if value == int(value):
+            if -2 ** 31 <= value < 2 ** 31:
+                candidates.append((0x10, struct.pack('<i', int(value))))
+            if -2 ** 63 <= value < 2 ** 63:
+                candidates.append((0x12, struct.pack('<q', int(value))))
+        return candidates
+    if isinstance(value, (type(u''), str)):
+        encoded = value.encode('utf-8') if isinstance(value, type(u'')) else value
+        return [(0x02, struct.pack('<i', len(encoded) + 1) + encoded + b'\x00')]
+    raise ValueError('unsupported filter value %r' % (value,))
+
+
+class RawFilter(object):
+    """ Filter evaluated on raw bson documents, see parse_filter for what is supported.
+
+    Args:
+        query (dict): the filter
+    Raises:
+        ValueError for anything not supported
+    """
+
+    def __init__(self, query):
+        self.fields = {} # field name (bytes) -> set of (bson type, raw value bytes)
+        for field, condition in query.items():
+            if field.startswith('$') or '.' in field:
+                raise ValueError('unsupported filter field %s: only top level fields' % field)
+            if isinstance(condition, dict) and list(condition.keys()) == ['$in']:
+                values = condition['$in']
+            elif isinstance(condition, dict) and any(k.startswith('$') and k != '$oid' for k in condition):
+                raise ValueError('unsupported operator in %s: only equality and $in' % field)
+            else:
+                values = [condition]
+            candidates = set()
+            for value in values:
+                candidates.update((t, bytes(raw)) for t, raw in _encode_value(value))
+            self.fields[field.encode('utf-8')] = candidates
+        # as in mongo, null also matches a missing field
+        self.required = set(name for name, candidates in self.fields.items() if (0x0A, b'') not in candidates)
+        # the raw values of the most selective required field: a document containing none is skipped.
+        # Not the whole elements, the value may be an item of an array
+        self.needles = []
+        if self.required:
+            name = max(self.required, key=lambda n: (min(len(raw) for _, raw in self.fields[n]), -len(self.fields[n])))
+            self.needles = [raw for _, raw in self.fields[name] if raw]
+
+    def matches(self, buf, start, end):
+        if not self.fields:
+            return True
+        if self.needles and not any(buf.find(needle, start, end) != -1 for needle in self.needles):
+            return False
+        found = set()
+        for name, etype, value_start, value_end in _elements(buf, start, end):
+            candidates = self.fields.get(name)
+            if candidates is None:
+                continue
+            if (etype, buf[value_start:value_end]) not in candidates and not (
+                    etype == 0x04 and self._any_item(buf, value_start, value_end, candidates)):
+                return False
+            found.add(name)
+        return self.required.issubset(found)
+
+    def _any_item(self, buf, start, end, candidates):
+        """ As in mongo, an array matches when one of its items does """
+        return any((etype, buf[value_start:value_end]) in candidates
+                   for _, etype, value_start, value_end in _elements(buf, start, end))
+
+
+def _elements(buf, start, end):
+    """ (name, bson type, value start, value end) of the top level elements of the document at start """
+    pos = start + 4
+    while pos < end - 1:
+        etype = struct.unpack_from('<B', buf, pos)[0]
+        name_end = buf.find(b'\x00', pos + 1, end)
+        name = buf[pos + 1:name_end]
+        value = name_end + 1
+        if etype in _FIXED_SIZES:
+            size = _FIXED_SIZES[etype]
+        elif etype in _STRING_TYPES:
+            size = 4 + struct.unpack_from('<i', buf, value)[0]
+        elif etype in _EMBEDDED_TYPES:
+            size = struct.unpack_from('<i', buf, value)[0]
+        elif etype == 0x05: # binary: int32 length, subtype, bytes
+            size = 5 + struct.unpack_from('<i', buf, value)[0]
+        elif etype == 0x0B: # regex: pattern and options cstrings
+            size = buf.find(b'\x00', buf.find(b'\x00', value, end) + 1, end) + 1 - value
+        elif etype == 0x0C: # dbpointer: string then ObjectId
+            size = 4 + struct.unpack_from('<i', buf, value)[0] + 12
+        else:
+            raise ValueError('unknown bson type 0x%02x at offset %d' % (etype, pos))
+        yield name, etype, value, value + size
+        pos = value + size
+
+
+def documents(buf):
+    """ (start, end) offsets of every document of the mapped .bson file """
+    size = len(buf)
+    start = 0
+    while start < size:
+        length = struct.unpack_from('<i', buf, start)[0]
+        if length < 5 or start + length > size:
+            raise ValueError('corrupt document of %d bytes at offset %d' % (length, start))
+        yield start, start + length
+        start += length
+
+
+class BsonWriter(object):
+    """ Matches as a .bson file, as mongodump writes them """
+
+    def __init__(self, path):
+        self.fh = open(path, 'wb')
+
+    def write(self, raw):
+        self.fh.write(raw)
+
+    def close(self):
+        self.fh.close()
+
+
+class JsonlWriter(object):
+    """ Matches as mongo extended JSON, one document per line """
+
+    def __init__(self, path):
+        self.fh = sys.stdout if path == '-' else open(path, 'w')
+
+    def write(self, raw):
+        self.fh.write(bson_dumps(bson.BSON(raw).decode()) + '\n')
+
+    def close(self):
+        if self.fh is not sys.stdout:
+            self.fh.close()
+
+
+class MongoWriter(object):
+    """ Matches inserted into a collection, batch_size documents per insert, without decoding them """
+
+    def __init__(self, host, db, collection, batch_size=1000):
+        self.collection = pymongo.MongoClient(host)[db][collection]
+        self.batch_size = batch_size
+        self.batch = []
+
+    def write(self, raw):
+        self.batch.append(RawBSONDocument(raw))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.collection.insert_many(self.batch, ordered=False)
+            self.batch = []
+
+    def close(self):
+        self.flush()
+
+
+def extract(path, raw_filter, writer):
+    """ Write every document of the .bson file at path matching raw_filter.
+
+    Returns:
+        int, int: documents scanned, documents matched
+    """
+    scanned = matched = 0
+    with open(path, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return 0, 0 # an empty collection, mmap cannot map 0 bytes
+        buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for start, end in documents(buf):
+                scanned += 1
+                if raw_filter.matches(buf, start, end):
+                    matched += 1
+                    writer.write(buf[start:end])
+        finally:
+            buf.close()
+    return scanned, matched
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('path', help='the .bson file of the collection, eg: dump/db_prod/orders.bson')
+    parser.add_argument('--filter', default='{}', help='JSON filter, see the module doc for what is supported')
+    parser.add_argument('--out', help='write the matches to this .bson file')
+    parser.add_argument('--jsonl', help='write the matches as JSON lines to this file, - for stdout (pymongo)')
+    parser.add_argument('--host', help='insert the matches into this mongo (pymongo), with --db and --collection')
+    parser.add_argument('--db')
+    parser.add_argument('--collection')
+    parser.add_argument('--batch-size', type=int, default=1000, help='documents per insert (default 1000)')
+    args = parser.parse_args(argv)
+    try:
+        raw_filter = RawFilter(parse_filter(args.filter))
+    except ValueError as err:
+        parser.error('invalid filter: %s' % err)
+    if len([o for o in (args.out, args.jsonl, args.host) if o]) != 1:
+        parser.error('one of --out, --jsonl or --host is needed')
+    if (args.jsonl or args.host) and pymongo is None:
+        parser.error('--jsonl and --host need pymongo (pip install pymongo)')
+    if args.host and not (args.db and args.collection):
+        parser.error('--host needs --db and --collection')
+
+    if args.out:
+        writer = BsonWriter(args.out)
+    elif args.jsonl:
+        writer = JsonlWriter(args.jsonl)
+    else:
+        writer = MongoWriter(args.host, args.db, args.collection, args.batch_size)
+    started = time.time()
+    try:
+        scanned, matched = extract(args.path, raw_filter, writer)
+    finally:
+        writer.close()
+    sys.stderr.write('%d of %d documents matched in %.1fs\n' % (matched, scanned, time.time() - started))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
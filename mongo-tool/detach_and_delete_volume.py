@@ -1,30 +1,37 @@
 #! /usr/bin/env python
 import boto3
 import os
+import sys
 import urllib2
 
+from device_allocator import DeviceAllocator
+from volume_pool import VolumePool
+
 boto3.setup_default_session(region_name="us-west-2")
 ec2_resource = boto3.resource('ec2')
 ec2_client = boto3.client('ec2')
+home_path = os.environ.get("HOME")
+temp_db = os.environ.get("TEMP_DB")
+# see findSnapshot.py, VOLUME_POOL_SIZE=0 to always delete
+volume_pool = VolumePool(os.path.join(home_path or os.path.expanduser('~'), '.mongo-tool', 'volume-pool.json'),
+                         size=int(os.environ.get("VOLUME_POOL_SIZE", 2)),
+                         ttl=float(os.environ.get("VOLUME_POOL_TTL", 3600)))
+device_allocator = DeviceAllocator(os.path.join(home_path or os.path.expanduser('~'), '.mongo-tool', 'devices.json'))
 
 def find_volume():
-    vol=ec2_resource.volumes.filter(
-        Filters=[
-            {
-                'Name': 'attachment.instance-id',
-                'Values': [urllib2.urlopen('http://169.254.169.254/latest/meta-data/instance-id').read()]
-            },
-            {
-                'Name': 'attachment.device',
-                'Values': ['/dev/xvdz'] #TODO: what if > 1 device
-            }
-        ]
-    )
-    print "found volume to detach: %s" % list(vol)[0]
-    return list(vol)[0]
+    """ The volume attached for TEMP_DB by findSnapshot.py, see device_allocator.py """
+    allocated = device_allocator.find(temp_db)
+    if allocated is None:
+        raise Exception('no volume attached for %s' % temp_db)
+    device, volume_id = allocated
+    vol=ec2_resource.Volume(volume_id)
+    print "found volume to detach: %s on %s" % (vol, device)
+    return vol
 
 
 def detach_volume(vol):
+    if vol.state == 'available':
+        return # eg: its attach failed
     vol.detach_from_instance()
     ec2_client.get_waiter('volume_available').wait(VolumeIds=[vol.id])
     print "detached %s " % vol.id
@@ -36,10 +43,27 @@ def delete_volume(vol):
     print "deleted %s" % vol.id
 
 
+def delete_evicted(volume_ids):
+    for volume_id in volume_ids:
+        vol = ec2_resource.Volume(volume_id)
+        if vol.attachments:
+            detach_volume(vol)
+        delete_volume(vol)
+
+
 def main():
+    if '--expire' in sys.argv:
+        # only evict the pooled volumes past their ttl, and the ones leaked by dead restores, eg: from cron
+        delete_evicted(volume_pool.expire())
+        return
     volume = find_volume()
     detach_volume(volume)
-    delete_volume(volume)
+    device_allocator.release(temp_db)
+    # kept for the next restore from the same snapshot, unless evicted right away
+    evicted = volume_pool.release(volume.id, volume.snapshot_id, volume.volume_type, volume.iops, volume.throughput)
+    if volume.id not in evicted:
+        print "pooled %s of %s" % (volume.id, volume.snapshot_id)
+    delete_evicted(evicted)
 
 
 if __name__ == '__main__':
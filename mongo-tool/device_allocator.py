@@ -0,0 +1,101 @@
+""" Allocation of the device names restore volumes are attached on, so several
+restores can run at the same time on one host.
+
+A free device is one neither in the block device mapping of the instance nor
+allocated to a running restore. Allocations are recorded in a JSON file in
+HOME, locked with fcntl while it is read and updated:
+    {"/dev/xvdf": {"owner": "bob123_2016-01-15-12", "volume_id": "vol-1234", "allocated_at": 1476000000.0}, ...}
+so the teardown of a restore (owner: its TEMP_DB) finds exactly its own volume.
+"""
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+
+# /dev/sdf - /dev/sdp are the names recommended for EBS volumes, the xvd ones are what xen kernels show
+DEVICES = ['/dev/xvd%s' % letter for letter in 'fghijklmnopqrstuvwxyz']
+# an allocation whose volume is not in the block device mapping is dropped after that many seconds
+# (the attach failed or the restore died before its teardown)
+STALE_AFTER = 3600
+
+
+def _normalize(device):
+    """ /dev/sdf, sdf, /dev/xvdf -> /dev/xvdf """
+    name = device.split('/')[-1]
+    if name.startswith('sd'):
+        name = 'xvd' + name[2:]
+    return '/dev/' + name.rstrip('0123456789')
+
+
+class DeviceAllocator(object):
+    """
+    Args:
+        path (str): the allocation file, created on the first change
+        devices (list): device names to allocate from, in order
+    """
+
+    def __init__(self, path, devices=DEVICES):
+        self.path = path
+        self.devices = devices
+
+    @contextmanager
+    def _locked(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                allocations = {}
+                if os.path.exists(self.path):
+                    with open(self.path) as fh:
+                        allocations = json.load(fh)
+                yield allocations
+                tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+                with open(tmp_path, 'w') as fh:
+                    json.dump(allocations, fh, indent=1, sort_keys=True)
+                os.rename(tmp_path, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def allocate(self, owner, volume_id, block_device_mappings, now=None):
+        """ Allocate the first free device to the volume of owner.
+
+        Args:
+            owner (str): the restore, eg: its TEMP_DB
+            block_device_mappings (list): of the instance, as in describe_instances
+        Returns:
+            str: the device
+        Raises:
+            Exception when every device is taken
+        """
+        now = time.time() if now is None else now
+        mapped = dict((_normalize(m['DeviceName']), m.get('Ebs', {}).get('VolumeId')) for m in block_device_mappings)
+        with self._locked() as allocations:
+            for device, allocation in list(allocations.items()):
+                if mapped.get(device) != allocation['volume_id'] and now - allocation['allocated_at'] > STALE_AFTER:
+                    del allocations[device]
+            for device in self.devices:
+                if device not in mapped and device not in allocations:
+                    allocations[device] = {'owner': owner, 'volume_id': volume_id, 'allocated_at': now}
+                    return device
+        raise Exception('no free device: %d mapped, %d allocated' % (len(mapped), len(allocations)))
+
+    def find(self, owner):
+        """
+        Returns:
+            (str, str): device, volume id allocated to owner, None when there is none
+        """
+        with self._locked() as allocations:
+            for device, allocation in allocations.items():
+                if allocation['owner'] == owner:
+                    return device, allocation['volume_id']
+        return None
+
+    def release(self, owner):
+        """ Free the device of owner, once its volume is detached. """
+        with self._locked() as allocations:
+            for device, allocation in list(allocations.items()):
+                if allocation['owner'] == owner:
+                    del allocations[device]
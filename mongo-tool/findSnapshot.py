@@ -1,10 +1,17 @@
 #! /usr/bin/env python
-from datetime import timedelta, datetime
+from datetime import datetime
 from pytz import timezone
 import pytz
 import boto3
 import os
+import sys
 import urllib2
+from botocore.exceptions import ClientError
+
+from detach_and_delete_volume import delete_evicted, detach_volume
+from device_allocator import DeviceAllocator
+from snapshot_index import SnapshotIndex
+from volume_pool import VolumePool
 
 date_fmt="%Y-%m-%d-%H"
 pacific=timezone('America/Los_Angeles')
@@ -12,38 +19,69 @@ pacific=timezone('America/Los_Angeles')
 restore_from = os.environ.get("RESTORE_FROM")
 restore_from_dt = pacific.localize(datetime.strptime(restore_from, date_fmt))
 temp_db = os.environ.get("TEMP_DB")
+# of the restore volume: gp2, gp3, io1, io2, st1... IOPS for gp3 / io1 / io2, THROUGHPUT (MiB/s) for gp3
+volume_type = os.environ.get("VOLUME_TYPE", "gp2")
+volume_iops = os.environ.get("VOLUME_IOPS")
+volume_throughput = os.environ.get("VOLUME_THROUGHPUT")
 home_path = os.environ.get("HOME")
 boto3.setup_default_session(region_name="us-west-2")
 ec2_resource = boto3.resource('ec2')
 ec2_client = boto3.client('ec2')
-
-def func(x):
-    d = x[0]
-    delta =  d - restore_from_dt if d > restore_from_dt else timedelta.max
-    return delta
+snapshot_filters = [
+    {'Name': 'status', 'Values': ['completed']},
+    {'Name': 'tag:role', 'Values': ['mongo']},
+    {'Name': 'tag:environment', 'Values': ['prod']}
+]
+# kept in HOME (mounted from the host by mongo_restore), so every restore only lists the newest snapshots
+snapshot_index_path = os.path.join(home_path or os.path.expanduser('~'), '.mongo-tool', 'snapshot-index.json')
+# restore volumes kept by detach_and_delete_volume.py for the next restore from the same snapshot, see volume_pool.py
+volume_pool = VolumePool(os.path.join(home_path or os.path.expanduser('~'), '.mongo-tool', 'volume-pool.json'),
+                         size=int(os.environ.get("VOLUME_POOL_SIZE", 2)),
+                         ttl=float(os.environ.get("VOLUME_POOL_TTL", 3600)))
+# devices of the restores running on this host, see device_allocator.py
+device_allocator = DeviceAllocator(os.path.join(home_path or os.path.expanduser('~'), '.mongo-tool', 'devices.json'))
 
 
 def find_snapshot_to_date(restore_datetime):
-    mongo_snapshots=ec2_resource.snapshots.filter(
-        Filters=[
-            {'Name': 'status', 'Values': ['completed']},
-            {'Name': 'tag:role', 'Values': ['mongo']},
-            {'Name': 'tag:environment', 'Values': ['prod']}
-        ])
-    ms_list = [(ms.start_time, ms) for ms in mongo_snapshots.all() ]
-    snapshot = min(ms_list, key = func)
-    print "%s - %s " % (snapshot[0].strftime('%c %Z') , snapshot[1])
+    """ The first snapshot taken after restore_datetime, or the newest one when there is none yet.
+
+    Returns:
+        (datetime, ec2.Snapshot): start time, snapshot
+    """
+    index = SnapshotIndex(snapshot_index_path, snapshot_filters)
+    index.refresh(ec2_client)
+    while True:
+        found = index.after(restore_datetime) or index.before(restore_datetime)
+        if found is None:
+            raise Exception('no completed prod mongo snapshot')
+        try:
+            # the index may be older than a deletion
+            ec2_client.describe_snapshots(SnapshotIds=[found[1]])
+            break
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'InvalidSnapshot.NotFound':
+                raise
+            index.discard(found[1])
+            index.save()
+    snapshot = (found[0], ec2_resource.Snapshot(found[1]))
+    print "%s - %s " % (snapshot[0].astimezone(pacific).strftime('%c %Z') , snapshot[1])
     return snapshot
 
 
 def create_volume(snapshot):
+    options = {}
+    if volume_iops:
+        options['Iops'] = int(volume_iops)
+    if volume_throughput:
+        options['Throughput'] = int(volume_throughput)
     vol=ec2_resource.create_volume(
         DryRun=False,
         SnapshotId=snapshot[1].id,
-        VolumeType="gp2",
-        AvailabilityZone=urllib2.urlopen('http://169.254.169.254/latest/meta-data/placement/availability-zone').read()
-    )           
-    print "creating %s" % vol.id
+        VolumeType=volume_type,
+        AvailabilityZone=urllib2.urlopen('http://169.254.169.254/latest/meta-data/placement/availability-zone').read(),
+        **options
+    )
+    print "creating %s %s %s" % (volume_type, options, vol.id)
     ec2_client.get_waiter('volume_available').wait(VolumeIds=[vol.id])
     print "created %s" % vol.id
     vol.create_tags(
@@ -65,28 +103,68 @@ def create_volume(snapshot):
     return vol
 
 
+def pooled_volume(snapshot):
+    """ A pooled volume of the snapshot, None when there is none. """
+    def _available(volume_id):
+        try:
+            return ec2_client.describe_volumes(VolumeIds=[volume_id])['Volumes'][0]['State'] == 'available'
+        except ClientError:
+            return False
+
+    # only a volume as create_volume would make, eg: not a gp2 one for a gp3 restore
+    volume_id = volume_pool.acquire(snapshot[1].id, temp_db, _available, volume_type=volume_type,
+                                    iops=int(volume_iops) if volume_iops else None,
+                                    throughput=int(volume_throughput) if volume_throughput else None)
+    if volume_id is None:
+        return None
+    print "reusing pooled %s of %s" % (volume_id, snapshot[1].id)
+    vol = ec2_resource.Volume(volume_id)
+    vol.create_tags(Tags=[{'Key': 'Name', 'Value': '%s_%s' % (temp_db, restore_from)}])
+    return vol
+
+
 def attach_volume(vol):
-    #TODO: user current instance?
     current_instance=ec2_resource.Instance(urllib2.urlopen('http://169.254.169.254/latest/meta-data/instance-id').read())
-    #TODO: available_device=find_next_device(current_instance.block_device_mapping)
-    available_device='/dev/xvdz'
+    available_device=find_next_device(current_instance, vol)
     print "attaching %s to %s on %s" % (vol.id, current_instance, available_device)
-    current_instance.attach_volume(
-        DryRun=False,
-        VolumeId=vol.id,
-        Device=available_device
-    )
-    ec2_client.get_waiter('volume_in_use').wait(VolumeIds=[vol.id])
+    try:
+        current_instance.attach_volume(
+            DryRun=False,
+            VolumeId=vol.id,
+            Device=available_device
+        )
+        ec2_client.get_waiter('volume_in_use').wait(VolumeIds=[vol.id])
+    except Exception:
+        failure = sys.exc_info()
+        return_volume(vol)
+        raise failure[0], failure[1], failure[2]
     print "attached %s to %s on %s" % (vol.id, current_instance, available_device)
     return available_device
 
 
-#def find_next_device(block_device_mapping):
+def return_volume(vol):
+    """ Give back the volume of a failed attach: detached, to the pool (or deleted when evicted), then its device.
+        When that fails too, the device stays allocated for detach_and_delete_volume.py to find the volume.
+    """
+    print "attaching %s failed, returning it to the pool" % vol.id
+    try:
+        vol.reload()
+        detach_volume(vol)
+        delete_evicted(volume_pool.release(vol.id, vol.snapshot_id, vol.volume_type, vol.iops, vol.throughput))
+        device_allocator.release(temp_db)
+    except Exception as err:
+        print "returning %s failed, run detach_and_delete_volume.py with TEMP_DB=%s: %s" % (vol.id, temp_db, err)
+
+
+def find_next_device(instance, vol):
+    """ A device free on the instance and not taken by another restore, allocated to TEMP_DB """
+    instance.reload() # the mapping changes with every (concurrent) attach
+    return device_allocator.allocate(temp_db, vol.id, instance.block_device_mappings)
 
 
 def main():
     snapshot = find_snapshot_to_date(restore_from_dt)
-    volume = create_volume(snapshot)
+    volume = pooled_volume(snapshot) or create_volume(snapshot)
     device = attach_volume(volume)
     # write the device to a file so later can read this file for the mount
     with open(home_path+'/'+temp_db + ".txt", 'wb') as fh:
@@ -0,0 +1,117 @@
+#! /usr/bin/env python
+""" Pre-warm files of a volume created from a snapshot.
+
+The blocks of such a volume are only fetched from S3 on their first read, so
+the first pass over a large .bson file (ie: the mongorestore) runs at a
+fraction of the disk throughput. Reading the files beforehand, as
+`dd`/`fio` initialization does but only for the files needed, with several
+sequential readers each on its own range of a file, fetches them at full
+speed. Progress is reported every --interval seconds.
+
+    prewarm.py --workers 8 /data/dump/db_prod/users.bson /data/dump/db_prod/orders.bson
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+BLOCK_SIZE = 1024 * 1024 # bytes per read
+RANGE_SIZE = 64 * BLOCK_SIZE # bytes read sequentially by one worker before it takes the next range
+
+
+class Progress(object):
+
+    def __init__(self, total, interval=10, out=sys.stdout):
+        self.total = total
+        self.done = 0
+        self.interval = interval
+        self.out = out
+        self.started = time.time()
+        self._reported = self.started
+        self._lock = threading.Lock()
+
+    def add(self, size):
+        with self._lock:
+            self.done += size
+            if time.time() - self._reported >= self.interval:
+                self._reported = time.time()
+                self.report()
+
+    def report(self):
+        elapsed = max(time.time() - self.started, 1e-6)
+        self.out.write('prewarmed %.1f / %.1f GiB (%d%%), %.0f MiB/s\n' % (
+            self.done / 2.0 ** 30, self.total / 2.0 ** 30, 100 * self.done // max(self.total, 1),
+            self.done / 2.0 ** 20 / elapsed))
+        self.out.flush()
+
+
+def find_files(paths):
+    """ The given files and every file under the given directories """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in sorted(names))
+        else:
+            files.append(path)
+    return files
+
+
+def _ranges(files, range_size):
+    for path in files:
+        size = os.path.getsize(path)
+        for start in range(0, size, range_size):
+            yield path, start, min(range_size, size - start)
+
+
+def _read_range(path, start, length, progress, block_size):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.lseek(fd, start, os.SEEK_SET)
+        remaining = length
+        while remaining > 0:
+            data = os.read(fd, min(block_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            progress.add(len(data))
+    finally:
+        os.close(fd)
+
+
+def prewarm(paths, workers=8, range_size=RANGE_SIZE, block_size=BLOCK_SIZE, interval=10):
+    """ Read every byte of the files (or directories) in paths, workers ranges at a time.
+
+    Returns:
+        int: bytes read
+    """
+    files = find_files(paths)
+    progress = Progress(sum(os.path.getsize(path) for path in files), interval)
+    pool = ThreadPool(workers)
+    try:
+        # in file order, so the workers read neighbouring ranges
+        pool.map(lambda r: _read_range(r[0], r[1], r[2], progress, block_size), list(_ranges(files, range_size)),
+                 chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    progress.report()
+    return progress.done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('paths', nargs='+', metavar='PATH', help='file, or directory of files, to pre-warm')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent sequential readers (default 8)')
+    parser.add_argument('--range-mb', type=int, default=RANGE_SIZE // 2 ** 20,
+                        help='MiB read sequentially by a worker at a time (default %d)' % (RANGE_SIZE // 2 ** 20))
+    parser.add_argument('--interval', type=float, default=10, help='seconds between progress reports (default 10)')
+    args = parser.parse_args(argv)
+    prewarm(args.paths, args.workers, args.range_mb * 2 ** 20, interval=args.interval)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
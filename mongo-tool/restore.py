@@ -0,0 +1,212 @@
+#! /usr/bin/env python
+""" Restore several collections from the prod mongo snapshot of one point in time.
+
+Runs on the docker host (as mongo_restore_many in sample_function.sh does):
+the volume is created from the snapshot, attached and mounted once, the
+mongorestore containers of every collection run concurrently against that
+mount, then the volume is unmounted, detached and deleted once.
+With --prewarm, the .bson files of the collections are read once beforehand
+(prewarm.py), as blocks of a volume restored from a snapshot are slow on
+their first read. With --extract, the collections with a filter are extracted
+by bsonextract.py (filter evaluated on the raw .bson bytes) instead of
+mongorestore --filter.
+
+    restore.py 2016-01-15-12 users 'orders={"customer": "c42"}' --workers 4
+"""
+import argparse
+import getpass
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+CONTAINER_DATA = '/data'
+DOCKER = '/usr/bin/docker'
+
+_print_lock = threading.Lock()
+
+
+def log(message):
+    with _print_lock:
+        print(message)
+        sys.stdout.flush()
+
+
+def parse_collection(arg):
+    """ 'name' or 'name=<JSON filter>' -> (name, filter or None)
+
+    Raises:
+        ValueError on an invalid JSON filter
+    """
+    name, _, query = arg.partition('=')
+    if query:
+        # as mongo_restore: ObjectId("...") is not JSON
+        json.loads(re.sub(r'ObjectId\((.*?)\)', r'\1', query))
+    return name, query or None
+
+
+def run(cmd):
+    """ Run cmd, returning its exit code and (stdout + stderr) output. """
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    return process.returncode, output.decode('utf-8', 'replace')
+
+
+def stream(cmd, prefix=''):
+    """ Run cmd, logging each line of its (stdout + stderr) output as it comes. Returns its exit code. """
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    for line in iter(process.stdout.readline, b''):
+        log(prefix + line.decode('utf-8', 'replace').rstrip('\n'))
+    return process.wait()
+
+
+def check_run(cmd):
+    code, output = run(cmd)
+    if code != 0:
+        raise Exception('%s failed (%s): %s' % (' '.join(cmd), code, output))
+    return output
+
+
+def provision(args, home):
+    """ Find the snapshot, create and attach its volume (findSnapshot.py in the image).
+
+    Returns:
+        str: the device the volume is attached on
+    """
+    volume = ['-e', 'VOLUME_TYPE=%s' % args.volume_type]
+    if args.iops:
+        volume.extend(['-e', 'VOLUME_IOPS=%s' % args.iops])
+    if args.throughput:
+        volume.extend(['-e', 'VOLUME_THROUGHPUT=%s' % args.throughput])
+    check_run([DOCKER, 'run', '--rm', '-e', 'RESTORE_FROM=%s' % args.restore_from, '-e', 'HOME=/userhome',
+               '-e', 'TEMP_DB=%s' % args.temp_db, '-v', '%s:/userhome' % home] + volume +
+              ['--entrypoint=/mongo-restore/findSnapshot.py', args.image])
+    device_file = os.path.join(home, args.temp_db + '.txt')
+    with open(device_file) as fh:
+        device = fh.read().strip()
+    os.remove(device_file)
+    log('attached volume on %s' % device)
+    return device
+
+
+def mount(args, home, device):
+    """
+    Returns:
+        str: the mount point
+    """
+    mount_point = os.path.join(home, args.temp_db)
+    if not os.path.isdir(mount_point):
+        os.makedirs(mount_point)
+    check_run(['sudo', 'mount', device, mount_point])
+    log('mounted %s on %s' % (device, mount_point))
+    return mount_point
+
+
+def teardown(args, mount_point):
+    """ Unmount, detach and delete the volume, whatever failed before. """
+    if mount_point:
+        code, output = run(['sudo', 'umount', mount_point])
+        if code != 0:
+            log('umount %s failed: %s' % (mount_point, output))
+        else:
+            os.rmdir(mount_point)
+    # HOME for the volume pool and the device allocations, TEMP_DB to find the volume of this restore
+    check_run([DOCKER, 'run', '--rm', '-e', 'HOME=/userhome', '-e', 'TEMP_DB=%s' % args.temp_db,
+               '-v', '%s:/userhome' % os.path.expanduser('~'),
+               '--entrypoint=/mongo-restore/detach_and_delete_volume.py', args.image])
+    log('volume detached and pooled / deleted')
+
+
+def prewarm(args, mount_point, collections):
+    """ Read the dump files of the collections at full speed, see prewarm.py in the image. """
+    files = ['%s/dump/%s/%s.bson' % (CONTAINER_DATA, args.db, name) for name, _ in collections]
+    log('prewarming %s' % ', '.join(files))
+    # the progress of prewarm.py as it goes, a large dump taking minutes
+    code = stream([DOCKER, 'run', '--rm', '-v', '%s:%s' % (mount_point, CONTAINER_DATA),
+                   '--entrypoint=/mongo-restore/prewarm.py', args.image, '--workers', str(args.prewarm_workers)]
+                  + files, prefix='prewarm: ')
+    if code != 0:
+        # only slower without it
+        log('prewarm failed (%s), restoring anyway' % code)
+
+
+def restore_collection(args, mount_point, collection, query):
+    if query and args.extract:
+        return extract_collection(args, mount_point, collection, query)
+    cmd = [DOCKER, 'run', '--rm', '-v', '%s:%s' % (mount_point, CONTAINER_DATA), args.image]
+    if query:
+        cmd.extend(['--filter', query])
+    cmd.extend(['--noIndexRestore', '--noOptionsRestore', '-h', args.mongo_host, '-d', '%s_%s' % (args.db, args.temp_db),
+                '-c', collection, '%s/dump/%s/%s.bson' % (CONTAINER_DATA, args.db, collection)])
+    log('restoring %s' % collection)
+    code, output = run(cmd)
+    log('restored %s: %s' % (collection, 'ok' if code == 0 else 'FAILED (%s)\n%s' % (code, output)))
+    return collection, code
+
+
+def extract_collection(args, mount_point, collection, query):
+    """ As restore_collection, with bsonextract.py in the image. """
+    cmd = [DOCKER, 'run', '--rm', '-v', '%s:%s' % (mount_point, CONTAINER_DATA),
+           '--entrypoint=/mongo-restore/bsonextract.py', args.image,
+           '%s/dump/%s/%s.bson' % (CONTAINER_DATA, args.db, collection), '--filter', query,
+           '--host', args.mongo_host, '--db', '%s_%s' % (args.db, args.temp_db), '--collection', collection]
+    log('extracting %s' % collection)
+    code, output = run(cmd)
+    log('extracted %s: %s' % (collection, output.strip() if code == 0 else 'FAILED (%s)\n%s' % (code, output)))
+    return collection, code
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('restore_from', help='date and hour (YYYY-MM-DD-hh) to restore the data from')
+    parser.add_argument('collections', nargs='+', metavar='COLLECTION[=FILTER]',
+                        help='collection to restore, with an optional JSON filter of its documents')
+    parser.add_argument('--workers', type=int, default=4, help='collections restored at the same time (default 4)')
+    parser.add_argument('--temp-db', default=None,
+                        help='suffix of the db restored to, db_prod_<temp db> (default <user><random>_<restore from>)')
+    parser.add_argument('--image', default=os.environ.get('MONGO_TOOL_IMAGE', 'docker.repo/mongotool'))
+    parser.add_argument('--mongo-host', default=os.environ.get('MONGO_HOST', 'mongo.host'))
+    parser.add_argument('--db', default='db_prod', help='db of the dump (default db_prod)')
+    parser.add_argument('--volume-type', default='gp2', help='of the restore volume, eg: gp3, io1 (default gp2)')
+    parser.add_argument('--iops', type=int, default=None, help='provisioned IOPS of a gp3 / io1 / io2 volume')
+    parser.add_argument('--throughput', type=int, default=None, help='provisioned MiB/s of a gp3 volume')
+    parser.add_argument('--prewarm', action='store_true', help='read the dump files once before restoring')
+    parser.add_argument('--prewarm-workers', type=int, default=8, help='concurrent prewarm readers (default 8)')
+    parser.add_argument('--extract', action='store_true',
+                        help='extract the collections with a filter with bsonextract.py instead of mongorestore')
+    args = parser.parse_args(argv)
+    try:
+        collections = [parse_collection(arg) for arg in args.collections]
+    except ValueError as err:
+        parser.error('invalid json filter: %s' % err)
+    args.temp_db = args.temp_db or '%s%s_%s' % (getpass.getuser(), random.randint(0, 32767), args.restore_from)
+    home = os.path.expanduser('~')
+
+    log('restoring %s to %s_%s' % (', '.join(name for name, _ in collections), args.db, args.temp_db))
+    device = provision(args, home)
+    mount_point = None
+    try:
+        mount_point = mount(args, home, device)
+        if args.prewarm:
+            prewarm(args, mount_point, collections)
+        pool = ThreadPool(max(1, min(args.workers, len(collections))))
+        try:
+            results = pool.map(lambda c: restore_collection(args, mount_point, c[0], c[1]), collections)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        teardown(args, mount_point)
+    failed = [name for name, code in results if code != 0]
+    if failed:
+        log('FAILED: %s' % ', '.join(failed))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -48,5 +48,35 @@ function mongo_restore() {
     sudo mount \`cat \${HOME}/$TEMP_DB.txt\` \${HOME}/$TEMP_DB && 
     /usr/bin/docker run --rm -v \${HOME}/$TEMP_DB:$CONTAINER_DATA $MONGO_TOOL_IMAGE $FILTER --noIndexRestore --noOptionsRestore -h $MONGO_HOST -d db_prod_$TEMP_DB -c $COLLECTION_NAME $CONTAINER_DATA/dump/db_prod/$COLLECTION_NAME.bson &&
     sudo umount \${HOME}/$TEMP_DB &&
-    /usr/bin/docker run --rm --entrypoint=/mongo-restore/detach_and_delete_volume.py $MONGO_TOOL_IMAGE "
+    /usr/bin/docker run --rm -e HOME=/userhome -e TEMP_DB=$TEMP_DB -v \${HOME}:/userhome --entrypoint=/mongo-restore/detach_and_delete_volume.py $MONGO_TOOL_IMAGE "
+}
+
+# Restore several collections of one point in time at once: one volume for all of them, restored concurrently.
+# restore.py is taken from the image, so it always matches the findSnapshot.py / detach_and_delete_volume.py it runs.
+function mongo_restore_many() {
+    if [ $# -lt 2 ]; then
+        echo "Usage: mongo_restore_many [date and hour (YYYY-MM-DD-hh) to restore the data from] [collection[=filter]]..."
+        return
+    fi
+
+    RESTORE_FROM="${1}"
+    shift
+    GATEWAY_HOST=gateway.host
+    TEMP_DB="${USER}${RANDOM}_${RESTORE_FROM}"
+    MONGO_HOST="mongo.host"
+    MONGO_TOOL_IMAGE="docker.repo/mongotool"
+    WORKERS=${WORKERS:-4}
+    echo "Connecting to $(tput bold)${GATEWAY_HOST}$(tput sgr0) for restoring $# collection(s) to $(tput bold)db_prod_$TEMP_DB$(tput sgr0)..."
+    # quoted for the remote shell, filters are validated by restore.py
+    RESTORE_ARGS=$(printf '%q ' --workers "$WORKERS" --temp-db "$TEMP_DB" --image "$MONGO_TOOL_IMAGE" --mongo-host "$MONGO_HOST" "$RESTORE_FROM" "$@")
+    # eg: PREWARM=1 EXTRACT=1 VOLUME_TYPE=gp3 VOLUME_THROUGHPUT=500 mongo_restore_many ...
+    [ -n "$PREWARM" ] && RESTORE_ARGS="--prewarm $RESTORE_ARGS"
+    [ -n "$EXTRACT" ] && RESTORE_ARGS="--extract $RESTORE_ARGS"
+    [ -n "$VOLUME_TYPE" ] && RESTORE_ARGS="--volume-type $VOLUME_TYPE $RESTORE_ARGS"
+    [ -n "$VOLUME_IOPS" ] && RESTORE_ARGS="--iops $VOLUME_IOPS $RESTORE_ARGS"
+    [ -n "$VOLUME_THROUGHPUT" ] && RESTORE_ARGS="--throughput $VOLUME_THROUGHPUT $RESTORE_ARGS"
+    ssh -t ${GATEWAY_HOST} "/usr/bin/docker pull $MONGO_TOOL_IMAGE &&
+    /usr/bin/docker run --rm --entrypoint=cat $MONGO_TOOL_IMAGE /mongo-restore/restore.py > /tmp/restore_$TEMP_DB.py &&
+    python /tmp/restore_$TEMP_DB.py $RESTORE_ARGS;
+    rm -f /tmp/restore_$TEMP_DB.py"
 }
@@ -0,0 +1,108 @@
+""" Time sorted index of the completed snapshots matching some filters, cached
+in a local JSON file.
+
+A refresh only lists the snapshots started since the day of the newest one
+already known, using the server side start-time filter with one day wildcard
+per day (eg: 2016-01-15*). So after the first (full) listing, a refresh is a
+single small describe_snapshots call however many snapshots are kept. Lookups
+of the snapshot nearest after / before a point in time are bisects.
+"""
+import bisect
+import calendar
+import datetime
+import json
+import os
+
+import pytz
+
+# past that many days since the newest known snapshot, list every snapshot again
+MAX_DAY_FILTERS = 200
+
+
+def epoch(dt):
+    """ Seconds since the epoch of an aware datetime """
+    return calendar.timegm(dt.utctimetuple())
+
+
+class SnapshotIndex(object):
+    """
+    Args:
+        path (str): the cache file, created on the first save
+        filters (list): describe_snapshots filters of the indexed snapshots; a cache
+            file written for other filters is ignored
+    """
+
+    def __init__(self, path, filters):
+        self.path = path
+        self.filters = filters
+        self.times = [] # start times (epoch), sorted
+        self.ids = [] # snapshot ids, in the order of times
+        if os.path.exists(path):
+            with open(path) as fh:
+                cached = json.load(fh)
+            if cached.get('filters') == filters:
+                self.times = cached['times']
+                self.ids = cached['ids']
+
+    def refresh(self, ec2_client, now=None):
+        """ Add the snapshots started since the newest known one, or list them all when
+            the index is empty or too old. Then save the index.
+
+        Returns:
+            int: number of snapshots listed
+        """
+        now = now or datetime.datetime.now(pytz.utc)
+        filters = list(self.filters)
+        full = True
+        if self.times:
+            since = datetime.datetime.fromtimestamp(self.times[-1], pytz.utc).date()
+            days = (now.date() - since).days + 1
+            if days <= MAX_DAY_FILTERS:
+                full = False
+                filters.append({
+                    'Name': 'start-time',
+                    'Values': [(since + datetime.timedelta(days=day)).strftime('%Y-%m-%d*') for day in range(days)]
+                })
+        listed = {}
+        for page in ec2_client.get_paginator('describe_snapshots').paginate(OwnerIds=['self'], Filters=filters):
+            for snapshot in page['Snapshots']:
+                listed[snapshot['SnapshotId']] = epoch(snapshot['StartTime'])
+        known = {} if full else dict(zip(self.ids, self.times))
+        known.update(listed)
+        self._set(known)
+        self.save()
+        return len(listed)
+
+    def _set(self, snapshots):
+        ordered = sorted((start, snapshot_id) for snapshot_id, start in snapshots.items())
+        self.times = [start for start, _ in ordered]
+        self.ids = [snapshot_id for _, snapshot_id in ordered]
+
+    def discard(self, snapshot_id):
+        """ Forget a snapshot, eg: deleted since it was indexed. """
+        self._set(dict((i, t) for i, t in zip(self.ids, self.times) if i != snapshot_id))
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as fh:
+            json.dump({'filters': self.filters, 'times': self.times, 'ids': self.ids}, fh)
+        os.rename(tmp_path, self.path) # readers never see a partial file
+
+    def after(self, dt):
+        """ (start time, snapshot id) of the first snapshot started strictly after dt, None if there is none """
+        return self._entry(bisect.bisect_right(self.times, epoch(dt)))
+
+    def before(self, dt):
+        """ (start time, snapshot id) of the last snapshot started at or before dt, None if there is none """
+        return self._entry(bisect.bisect_right(self.times, epoch(dt)) - 1)
+
+    def _entry(self, i):
+        if i < 0 or i >= len(self.times):
+            return None
+        return datetime.datetime.fromtimestamp(self.times[i], pytz.utc), self.ids[i]
+
+    def __len__(self):
+        return len(self.times)
@@ -0,0 +1,125 @@
+""" Local pool of restore volumes, kept (available, detached) after a restore so
+the next restore from the same snapshot can attach one instead of creating
+it, and finds the blocks it reads already fetched from S3.
+
+The pool is a JSON file in HOME, next to the snapshot index, locked with
+fcntl while it is read and updated:
+    {"vol-1234": {"snapshot_id": "snap-5678", "volume_type": "gp3", "iops": 3000, "throughput": 125,
+                  "released_at": 1476000000.0, "owner": null}, ...}
+A volume is only reused by a restore asking for its type (and iops / throughput, when given).
+An idle volume (owner null) is evicted once it was released more than ttl
+seconds ago, or when there are more than size idle volumes (oldest first).
+A volume acquired more than STALE_AFTER seconds ago and never released (its
+restore died before its teardown) is evicted too.
+Evicted volumes are returned to the caller to delete.
+"""
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+
+# an acquired volume not released after that many seconds is considered leaked by a dead restore
+STALE_AFTER = 24 * 3600
+
+
+def _matches(volume, **wanted):
+    """ Whether the pooled volume has the wanted values, but the None ones. Volumes pooled without
+        them (eg: by an older version) only match when nothing is wanted. """
+    return all(value is None or volume.get(key) == value for key, value in wanted.items())
+
+
+class VolumePool(object):
+    """
+    Args:
+        path (str): the pool file, created on the first change
+        size (int): idle volumes kept, 0 to keep none
+        ttl (float): seconds an idle volume is kept
+        stale (float): seconds after which an acquired volume not released is evicted
+    """
+
+    def __init__(self, path, size=2, ttl=3600, stale=STALE_AFTER):
+        self.path = path
+        self.size = size
+        self.ttl = ttl
+        self.stale = stale
+
+    @contextmanager
+    def _locked(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                volumes = {}
+                if os.path.exists(self.path):
+                    with open(self.path) as fh:
+                        volumes = json.load(fh)
+                yield volumes
+                tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+                with open(tmp_path, 'w') as fh:
+                    json.dump(volumes, fh, indent=1, sort_keys=True)
+                os.rename(tmp_path, self.path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def acquire(self, snapshot_id, owner, usable=None, volume_type=None, iops=None, throughput=None, now=None):
+        """ Take the most recently released idle volume of snapshot_id.
+
+        Args:
+            owner (str): who takes it, eg: the TEMP_DB
+            usable (callable): volume id -> whether it can still be used (eg: still available),
+                volumes that are not are dropped from the pool
+            volume_type (str), iops (int), throughput (int): the volume must have, None for any
+        Returns:
+            str: the volume id, None when the pool has none of snapshot_id
+        """
+        now = time.time() if now is None else now
+        with self._locked() as volumes:
+            candidates = sorted((v['released_at'], volume_id) for volume_id, v in volumes.items()
+                                if v['snapshot_id'] == snapshot_id and v['owner'] is None and
+                                _matches(v, volume_type=volume_type, iops=iops, throughput=throughput))
+            for _, volume_id in reversed(candidates):
+                if usable is not None and not usable(volume_id):
+                    del volumes[volume_id]
+                    continue
+                volumes[volume_id]['owner'] = owner
+                volumes[volume_id]['acquired_at'] = now
+                return volume_id
+        return None
+
+    def release(self, volume_id, snapshot_id, volume_type=None, iops=None, throughput=None, now=None):
+        """ Put a (detached) volume back in the pool, then evict.
+
+        Args:
+            volume_type (str), iops (int), throughput (int): of the volume, matched by acquire
+
+        Returns:
+            list: ids of the evicted volumes, to be deleted by the caller (may include volume_id)
+        """
+        now = time.time() if now is None else now
+        with self._locked() as volumes:
+            volumes[volume_id] = {'snapshot_id': snapshot_id, 'volume_type': volume_type, 'iops': iops,
+                                  'throughput': throughput, 'released_at': now, 'owner': None}
+            return self._evict(volumes, now)
+
+    def expire(self, now=None):
+        """ Evict without releasing anything.
+
+        Returns:
+            list: ids of the evicted volumes, to be deleted by the caller
+        """
+        with self._locked() as volumes:
+            return self._evict(volumes, time.time() if now is None else now)
+
+    def _evict(self, volumes, now):
+        idle = sorted((v['released_at'], volume_id) for volume_id, v in volumes.items() if v['owner'] is None)
+        evicted = [volume_id for volume_id, v in volumes.items() if v['owner'] is not None and
+                   now - v.get('acquired_at', v['released_at']) > self.stale]
+        evicted.extend(volume_id for released_at, volume_id in idle if now - released_at > self.ttl)
+        kept = [volume_id for _, volume_id in idle if volume_id not in evicted]
+        evicted.extend(kept[:max(0, len(kept) - self.size)])
+        for volume_id in evicted:
+            del volumes[volume_id]
+        return evicted